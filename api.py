@@ -21,26 +21,115 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
-import cgi
-import json
 import sys
+import time
 from os import environ
 
 import config
 
-from backend.cvs import PostsaiCommitViewer
-from backend.query import Postsai
-from backend.importer import PostsaiImporter
 
+# handlers are imported on demand, because CGI starts a new process for every
+# request and most requests only need a small part of the backend
 
+methods = ["commit", "feed", "bootstrap", "history", "suggest", "activity", "metrics", "profile"]
+
+
+def read_method(environ, stdin):
+    """returns the name of the requested method and the form of GET requests"""
 
-if __name__ == '__main__':
     if environ.has_key('REQUEST_METHOD') and environ['REQUEST_METHOD'] == "POST":
-        PostsaiImporter(vars(config), json.loads(sys.stdin.read(), strict=False)).import_from_webhook()
+        import urlparse
+        if urlparse.parse_qs(environ.get("QUERY_STRING", "")).get("method", [""])[0] == "batch":
+            return "batch", None
+        return "import", None
+
+    import cgi
+    form = cgi.FieldStorage(fp=stdin, environ=environ)
+    method = form.getfirst("method", "")
+    if not method in methods:
+        method = "query"
+    return method, form
+
+
+def process(config, environ, stdin, method, form):
+    """invokes the handler of the method"""
+
+    if method == "batch":
+        import json
+        from backend.batch import PostsaiBatch
+        PostsaiBatch(config, json.loads(stdin.read())).process()
+    elif method == "import":
+        import json
+        from backend.importer import PostsaiImporter
+        PostsaiImporter(config, json.loads(stdin.read(), strict=False)).import_from_webhook(environ)
+    elif method == "commit":
+        from backend.cvs import PostsaiCommitViewer
+        PostsaiCommitViewer(config).process(form)
+    elif method == "feed":
+        from backend.feed import PostsaiFeed
+        PostsaiFeed(config).process(form, environ)
+    elif method == "bootstrap":
+        from backend.bootstrap import PostsaiBootstrap
+        PostsaiBootstrap(config).process()
+    elif method == "history":
+        from backend.history import PostsaiFileHistory
+        PostsaiFileHistory(config).process(form)
+    elif method == "suggest":
+        from backend.suggest import PostsaiSuggestions
+        PostsaiSuggestions(config).process(form)
+    elif method == "activity":
+        from backend.activity import PostsaiActivity
+        PostsaiActivity(config).process()
+    elif method == "metrics":
+        from backend.metrics import PostsaiMetrics
+        PostsaiMetrics(config).process(environ)
+    elif method == "profile":
+        from backend.profiling import PostsaiProfiles
+        PostsaiProfiles(config).process(form, environ)
     else:
-        form = cgi.FieldStorage()
-        if form.getfirst("method", "") == "commit":
-            PostsaiCommitViewer(vars(config)).process()
-        else:
-            Postsai(vars(config)).process()
+        from backend.query import Postsai
+        Postsai(config).process(form)
+
+
+def process_and_measure(config, environ, stdin, method, form):
+    """invokes the handler of the method and records its metrics"""
+
+    if not "metrics" in config:
+        process(config, environ, stdin, method, form)
+        return
 
+    from backend.metrics import Metrics
+    start = time.time()
+    try:
+        process(config, environ, stdin, method, form)
+    except Exception:
+        Metrics.increment("postsai_request_errors_total", 1, {"method": method})
+        raise
+    finally:
+        Metrics.observe("postsai_request_seconds", time.time() - start, {"method": method})
+        Metrics.flush(config)
+
+
+def dispatch(config, environ, stdin):
+    """processes a request, the output is written to stdout in CGI format"""
+
+    if "replay_log" in config:
+        from backend.replay import ReplayLog
+        body, stdin = ReplayLog.buffer_body(environ, stdin)
+        method, form = read_method(environ, stdin)
+        ReplayLog(config).record(method, environ, body)
+    else:
+        method, form = read_method(environ, stdin)
+
+    if "profiling" in config:
+        from backend.profiling import RequestProfiler
+        profiler = RequestProfiler(config)
+        if profiler.is_requested(environ):
+            profiler.run(method, environ, process_and_measure, config, environ, stdin, method, form)
+            return
+    process_and_measure(config, environ, stdin, method, form)
+
+
+
+if __name__ == '__main__':
+    dispatch(vars(config), environ, sys.stdin)
@@ -22,9 +22,38 @@
 # DEALINGS IN THE SOFTWARE.
 
 
+from backend.admission import QuerySlots
+from backend.batch import PostsaiBatch
+from backend.bootstrap import PostsaiBootstrap
 from backend.cache import Cache
-from backend.db import PostsaiDB
-import api
+from backend.cvs import PostsaiCommitViewer
+from backend.db import ConnectionPool, PoolTimeout, PostsaiDB
+from backend.eventserver import FeedHub, PostsaiEventServer
+from backend.extension import ExtensionManager
+from backend.feed import PostsaiFeed
+from backend.history import PostsaiFileHistory
+from backend.hotwindow import HotWindow
+from backend.importer import PostsaiImporter
+from backend.lookuptable import SharedLookupTable
+from backend.metrics import Metrics, PostsaiMetrics
+from backend.profiling import PostsaiProfiles, RequestProfiler
+from backend.query import FormOverlay, Postsai
+from backend.replay import ReplayLog
+from backend.resultcache import QueryResultCache
+from backend.server import PostsaiApplication
+from backend.slices import SlicedQueryExecutor
+from backend.suggest import PostsaiSuggestions, PrefixIndex, SuggestionIndex
+import backend.db
+import backend.slices
+import base64
+import datetime
+import json
+import os
+import StringIO
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 def get_permission_pattern():
@@ -52,6 +81,125 @@ class CacheTests(unittest.TestCase):
 class PostsaiDBTests(unittest.TestCase):
     "test for he db access"
 
+    class CursorMock:
+        "records executed statements"
+
+        def __init__(self):
+            self.executed = []
+
+        def execute(self, sql, data):
+            self.executed.append(data)
+
+
+    class ReplicaDBMock(PostsaiDB):
+        "connects to fake servers, whose replication delay is part of their configuration"
+
+        def attach(self, pool):
+            if self.server != None and self.server["lag"] == "down":
+                raise backend.db.load_driver().Error("unreachable")
+            self.connection_pool = None
+            self.conn = ConnectionPoolTests.ConnectionMock()
+
+        def read_replica_lag(self):
+            return self.server["lag"]
+
+
+    def test_replica_routing(self):
+        PostsaiDB.unhealthy_replicas.clear()
+        config = {"db" : {"host" : "primary", "max_replica_lag" : 30, "replicas" : [{"host" : "replica", "lag" : 2}]}}
+        db = PostsaiDBTests.ReplicaDBMock(config, read_only=True)
+        db.connect()
+        self.assertEqual(db.server["host"], "replica")
+        self.assertEqual(db.replica_lag, 2)
+
+        db = PostsaiDBTests.ReplicaDBMock(config)
+        db.connect()
+        self.assertEqual(db.server, None, "writes stay on the primary")
+
+        config["db"]["replicas"] = [{"host" : "lagging", "lag" : 60}, {"host" : "stopped", "lag" : None},
+                                    {"host" : "down", "lag" : "down"}]
+        db = PostsaiDBTests.ReplicaDBMock(config, read_only=True)
+        db.connect()
+        self.assertEqual(db.server, None, "fallback to the primary")
+        self.assertEqual(sorted(PostsaiDB.unhealthy_replicas.keys()), [0, 1, 2])
+        PostsaiDB.unhealthy_replicas.clear()
+
+
+    class ImportConnectionMock:
+        "records the statements and transactions of an import, is its own cursor"
+
+        def __init__(self):
+            self.log = []
+
+        def cursor(self):
+            return self
+
+        def execute(self, sql, data):
+            self.log.append(sql.split("(")[0])
+
+        def fetchall(self):
+            return [[1]]
+
+        def commit(self):
+            self.log.append("COMMIT")
+
+        def rollback(self):
+            self.log.append("ROLLBACK")
+
+        def close(self):
+            pass
+
+
+    def test_import_lock(self):
+        conn = PostsaiDBTests.ImportConnectionMock()
+        db = PostsaiDB({})
+        db.connect = lambda: setattr(db, "conn", conn)
+        db.disconnect = lambda: None
+        db.insert_checkins = lambda cursor, head, rows: cursor.execute("INSERT INTO checkins", [])
+        db.import_data({}, [])
+        self.assertEqual(conn.log, ["SELECT GET_LOCK", "INSERT INTO checkins", "COMMIT", "SELECT RELEASE_LOCK"],
+                         "released after the commit")
+
+        def fail(cursor, head, rows):
+            raise ValueError("broken")
+        conn.log = []
+        db.insert_checkins = fail
+        self.assertRaises(ValueError, db.import_data, {}, [])
+        self.assertEqual(conn.log, ["SELECT GET_LOCK", "ROLLBACK", "SELECT RELEASE_LOCK"], "released after a failure")
+
+        PostsaiDB.recorded.statements = []
+        try:
+            db.insert_checkins = lambda cursor, head, rows: cursor.execute("INSERT INTO checkins", [])
+            db.import_data({}, [])
+            self.assertEqual([statement[0] for statement in PostsaiDB.recorded.statements],
+                             ["SELECT GET_LOCK('postsai_import', %s)", "INSERT INTO checkins", "SELECT RELEASE_LOCK('postsai_import')"],
+                             "statements of profiled imports are recorded")
+        finally:
+            PostsaiDB.recorded.statements = None
+
+
+    def test_update_latest_activity(self):
+        db = PostsaiDB({})
+        db.cache = Cache()
+        for column, value, id in [("repository", "postsai", 1), ("branch", "", 2), ("branch", "dev", 3),
+                                  ("who", "me", 4), ("description", "old", 5), ("description", "new", 6),
+                                  ("hash", "a", 7), ("hash", "b", 8)]:
+            db.cache.put(column, value, id)
+
+        def row(branch, description, commitid, ci_when):
+            return {"repository" : "postsai", "branch" : branch, "who" : "me", "description" : description,
+                    "commitid" : commitid, "ci_when" : ci_when}
+
+        cursor = PostsaiDBTests.CursorMock()
+        db.update_latest_activity(cursor, [
+            row("", "new", "b", "2016-02-22T10:00:01"),
+            row("", "old", "a", "2016-02-22T10:00:00"),
+            row("dev", "old", "a", "2016-02-22T10:00:00")])
+        self.assertEqual(sorted(cursor.executed), [
+            [1, 2, 4, 6, 8, "2016-02-22T10:00:01"],
+            [1, 3, 4, 5, 7, "2016-02-22T10:00:00"]], "newest commit per branch")
+
+
     def test_rewrite(self):
         db = PostsaiDB({})
 
@@ -68,6 +216,28 @@ class PostsaiDBTests(unittest.TestCase):
             "Rewriting on ViewVC databases")
 
 
+    def test_query_with_timeout(self):
+        db = PostsaiDB({})
+        db.query = lambda sql, data: [["row"]]
+        self.assertEqual(db.query_with_timeout("SELECT 1", [], 0), ([["row"]], False), "no timeout")
+
+        killed = threading.Event()
+        def slow_query(sql, data):
+            killed.wait(5)
+            raise backend.db.load_driver().OperationalError(PostsaiDB.ER_QUERY_INTERRUPTED, "Query execution was interrupted")
+
+        db.query = slow_query
+        db.kill_query = killed.set
+        self.assertEqual(db.query_with_timeout("SELECT 1", [], 0.1), ([], True), "query cancelled on timeout")
+        self.assertTrue(killed.is_set(), "query was killed")
+
+        def failing_query(sql, data):
+            raise backend.db.load_driver().ProgrammingError(1146, "Table doesn't exist")
+
+        db.query = failing_query
+        self.assertRaises(backend.db.load_driver().ProgrammingError, db.query_with_timeout, "SELECT 1", [], 0)
+
+
     def test_guess_repository_urls(self):
         db = PostsaiDB({})
 
@@ -151,6 +321,276 @@ class PostsaiDBTests(unittest.TestCase):
 
 
 
+class SharedLookupTableTests(unittest.TestCase):
+    "test for the memory-mapped lookup table"
+
+    def test_put_get(self):
+        filename = tempfile.mkdtemp() + "/lookup"
+        table = SharedLookupTable(filename, 64, "localhost:3306/postsai")
+        table.put("who", u"m\xfcller", 3)
+        table.put("who", u"m\xfcller", 4)
+        self.assertEqual(table.get("who", u"m\xfcller"), 3, "ids do not change")
+        self.assertEqual(table.get("branch", u"m\xfcller"), None, "separated by lookup table")
+        self.assertEqual(table.get("who", None), None)
+
+        self.assertEqual(SharedLookupTable(filename, 0, "localhost:3306/postsai").get("who", u"m\xfcller"), 3, "shared")
+        self.assertEqual(SharedLookupTable(filename, 0, "localhost:3306/other").get("who", u"m\xfcller"), None, "other database")
+
+        table.clear()
+        self.assertEqual(table.get("who", u"m\xfcller"), None, "cleared")
+
+
+    def test_eviction(self):
+        table = SharedLookupTable(tempfile.mkdtemp() + "/lookup", 1, "")
+        self.assertEqual(table.buckets, 1)
+        for i in range(SharedLookupTable.slots_per_bucket + 1):
+            table.put("file", "file" + str(i), i)
+        self.assertEqual(len([i for i in range(10) if table.get("file", "file" + str(i)) != None]),
+                         SharedLookupTable.slots_per_bucket, "bounded")
+        self.assertEqual(table.get("file", "file8"), 8, "newest kept")
+
+
+
+class MetricsTests(unittest.TestCase):
+    "test for the metrics"
+
+    def test_flush(self):
+        config = {"metrics" : {"file" : tempfile.mkdtemp() + "/metrics.json"}}
+        Metrics.take_pending()
+        Metrics.increment("postsai_imported_rows_total", 3)
+        Metrics.observe("postsai_request_seconds", 0.02, {"method" : "query"})
+        Metrics.flush(config)
+        self.assertEqual(Metrics.take_pending(), {"counters" : {}, "histograms" : {}}, "written")
+
+        # another process
+        Metrics.increment("postsai_imported_rows_total", 2)
+        Metrics.observe("postsai_request_seconds", 2, {"method" : "query"})
+        Metrics.flush(config)
+
+        text = Metrics.format_text(Metrics.read_totals(config))
+        self.assertIn("postsai_imported_rows_total 5\n", text)
+        self.assertIn("postsai_request_seconds_bucket{method=\"query\",le=\"0.01\"} 0\n", text)
+        self.assertIn("postsai_request_seconds_bucket{method=\"query\",le=\"0.025\"} 1\n", text)
+        self.assertIn("postsai_request_seconds_bucket{method=\"query\",le=\"+Inf\"} 2\n", text)
+        self.assertIn("postsai_request_seconds_count{method=\"query\"} 2\n", text)
+
+
+    def test_is_allowed(self):
+        metrics = PostsaiMetrics({"metrics" : {"allowed_addresses" : ["10.0.0.1"]}})
+        self.assertTrue(metrics.is_allowed({"REMOTE_ADDR" : "10.0.0.1"}))
+        self.assertFalse(metrics.is_allowed({"REMOTE_ADDR" : "127.0.0.1"}))
+        self.assertFalse(PostsaiMetrics({}).is_allowed({"REMOTE_ADDR" : "127.0.0.1"}), "denied by default")
+
+        metrics = PostsaiMetrics({"metrics" : {"token" : "secret"}})
+        self.assertTrue(metrics.is_allowed({"HTTP_AUTHORIZATION" : "Bearer secret"}), "token")
+        self.assertFalse(metrics.is_allowed({"HTTP_AUTHORIZATION" : "Bearer other"}), "wrong token")
+
+
+
+class RequestProfilerTests(unittest.TestCase):
+    "test for the profiling of requests"
+
+    class ConnectionMock:
+        "returns an empty result for every statement"
+
+        def cursor(self, cursor_type=None):
+            return self
+
+        def execute(self, sql, data):
+            pass
+
+        def fetchall(self):
+            return []
+
+        def close(self):
+            pass
+
+
+    def test_is_requested(self):
+        profiler = RequestProfiler({"profiling" : {"folder" : "/tmp"}})
+        self.assertFalse(profiler.is_requested({"QUERY_STRING" : "who=me&profile=1", "REMOTE_ADDR" : "127.0.0.1"}),
+                         "denied by default")
+
+        profiler = RequestProfiler({"profiling" : {"folder" : "/tmp", "allowed_addresses" : ["127.0.0.1"]}})
+        self.assertTrue(profiler.is_requested({"QUERY_STRING" : "who=me&profile=1", "REMOTE_ADDR" : "127.0.0.1"}))
+        self.assertFalse(profiler.is_requested({"QUERY_STRING" : "who=me&profile=1", "REMOTE_ADDR" : "10.0.0.1"}), "not allowed")
+        self.assertFalse(profiler.is_requested({"QUERY_STRING" : "who=me", "REMOTE_ADDR" : "127.0.0.1"}))
+        self.assertTrue(profiler.is_requested({"POSTSAI_PROFILE" : "1"}), "environment switch")
+        self.assertFalse(RequestProfiler({}).is_requested({"POSTSAI_PROFILE" : "1"}), "not configured")
+
+
+    def test_run(self):
+        config = {"profiling" : {"folder" : tempfile.mkdtemp(), "allowed_addresses" : ["127.0.0.1"]}}
+        db = PostsaiDB({})
+        db.is_viewvc_database = False
+        db.conn = RequestProfilerTests.ConnectionMock()
+        def work(value):
+            db.query("SELECT id FROM people WHERE who = %s", [value])
+            db.query_with_timeout("SELECT id FROM files", [], 0)
+
+        sys.stderr, stderr = StringIO.StringIO(), sys.stderr
+        try:
+            RequestProfiler(config).run("history", {"QUERY_STRING" : "method=history"}, work, "me")
+        finally:
+            sys.stderr = stderr
+        db.query("SELECT 1", [])
+        self.assertEqual(getattr(PostsaiDB.recorded, "statements", None), None, "only the profiled request is recorded")
+
+        names = os.listdir(config["profiling"]["folder"])
+        self.assertEqual(len(names), 2, "profile and summary")
+        name = [name for name in names if name.endswith(".txt")][0][:-4]
+        with open(config["profiling"]["folder"] + "/" + name + ".txt") as f:
+            summary = f.read()
+        self.assertIn("SELECT id FROM people WHERE who = %s ['me']", summary)
+        self.assertIn("SELECT id FROM files []", summary, "statement of a helper thread")
+        self.assertIn("(work)", summary)
+
+        sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        try:
+            PostsaiProfiles(config).process(FormOverlay(None, {}), {"REMOTE_ADDR" : "127.0.0.1"})
+            listing = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertIn(name, listing)
+
+
+
+class ReplayLogTests(unittest.TestCase):
+    "test for the recording of requests"
+
+    def test_record(self):
+        config = {"replay_log" : {"file" : tempfile.mkdtemp() + "/replay.log", "max_size" : 200}}
+        body, stdin = ReplayLog.buffer_body({"REQUEST_METHOD" : "POST"}, StringIO.StringIO("{}"))
+        self.assertEqual(body, "{}")
+        self.assertEqual(stdin.read(), "{}", "body can be read again")
+        self.assertEqual(ReplayLog.buffer_body({"REQUEST_METHOD" : "GET"}, sys.stdin), (None, sys.stdin))
+
+        log = ReplayLog(config)
+        log.record("import", {"QUERY_STRING" : ""}, body)
+        log.record("feed", {"QUERY_STRING" : "method=feed"}, None)
+        log.record("query", {"QUERY_STRING" : "who=me"}, None)
+        entries = ReplayLog.read_entries(config["replay_log"]["file"])
+        self.assertEqual([(entry["method"], entry["query"], entry["body"]) for entry in entries],
+                         [("import", "", base64.b64encode("{}")), ("query", "who=me", None)], "streams are ignored")
+
+        for i in range(10):
+            log.record("query", {"QUERY_STRING" : "who=" + str(i)}, None)
+        entries = ReplayLog.read_entries(config["replay_log"]["file"])
+        self.assertLess(len(entries), 12, "truncated")
+        self.assertEqual(entries[-1]["query"], "who=9", "newest kept")
+
+        log.record("import", {"QUERY_STRING" : ""}, "{\"message\": \"caf\xe9\"}")
+        log.record("query", {"QUERY_STRING" : "who=\xff"}, None)
+        entries = ReplayLog.read_entries(config["replay_log"]["file"])
+        self.assertEqual(base64.b64decode(entries[-1]["body"]), "{\"message\": \"caf\xe9\"}", "body which is not UTF-8")
+
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    "test for the connection pool"
+
+    class ConnectionMock:
+        "a connection, which may be broken"
+
+        def __init__(self):
+            self.broken = False
+            self.closed = False
+
+        def ping(self):
+            if self.broken:
+                raise backend.db.load_driver().Error("gone away")
+
+        def begin(self):
+            pass
+
+        def rollback(self):
+            pass
+
+        def close(self):
+            self.closed = True
+
+
+    def test_reuse(self):
+        pool = ConnectionPool({}, ConnectionPoolTests.ConnectionMock)
+        conn = pool.acquire()
+        pool.release(conn)
+        self.assertIs(pool.acquire(), conn, "reused")
+
+        pool.release(conn)
+        conn.broken = True
+        self.assertIsNot(pool.acquire(), conn, "broken connection replaced")
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.size, 1)
+
+
+    def test_limits(self):
+        pool = ConnectionPool({"db" : {"pool" : {"max_size" : 1, "timeout" : 0, "max_idle" : 0}}},
+                              ConnectionPoolTests.ConnectionMock)
+        conn = pool.acquire()
+        self.assertRaises(PoolTimeout, pool.acquire)
+
+        pool.release_thread()
+        self.assertEqual(pool.owners, {}, "leaked connection returned")
+        time.sleep(0.01)
+        self.assertIsNot(pool.acquire(), conn, "idle for too long")
+        self.assertTrue(conn.closed)
+
+
+
+class SlicedQueryExecutorTests(unittest.TestCase):
+    "test for the parallel execution of date slices"
+
+    class DBMock:
+        "returns the data of the query as rows"
+
+        ER_QUERY_INTERRUPTED = PostsaiDB.ER_QUERY_INTERRUPTED
+        ER_QUERY_TIMEOUT = PostsaiDB.ER_QUERY_TIMEOUT
+        record_in_thread = staticmethod(lambda target: target)
+
+        def __init__(self, config, read_only=False):
+            pass
+
+        def connect(self):
+            pass
+
+        def disconnect(self):
+            pass
+
+        def kill_query(self):
+            pass
+
+        def query(self, sql, data):
+            if isinstance(data, Exception):
+                raise data
+            if sql == "slow":
+                time.sleep(0.1)
+            return data
+
+
+    def execute(self, queries, limit):
+        db_class, backend.slices.PostsaiDB = backend.slices.PostsaiDB, SlicedQueryExecutorTests.DBMock
+        try:
+            return SlicedQueryExecutor({}, queries, limit, 3).execute()
+        finally:
+            backend.slices.PostsaiDB = db_class
+
+
+    def test_merge_order(self):
+        self.assertEqual(self.execute([("slow", [1, 2]), ("fast", [3]), ("fast", [4])], None), ([1, 2, 3, 4], False),
+                         "rows in the order of the slices")
+
+
+    def test_limit(self):
+        self.assertEqual(self.execute([("fast", [1, 2]), ("fast", [3, 4]), ("fast", [5])], 3), ([1, 2, 3], False))
+
+
+    def test_errors(self):
+        interrupted = backend.db.load_driver().OperationalError(PostsaiDB.ER_QUERY_INTERRUPTED, "Query execution was interrupted")
+        self.assertEqual(self.execute([("slow", [1]), ("fast", interrupted)], None), ([1], True), "rows of newer slices on timeout")
+        self.assertRaises(ValueError, self.execute, [("fast", [1]), ("fast", ValueError())], None)
+
+
+
 class PostsaiTests(unittest.TestCase):
     "test for the api"
 
@@ -163,13 +603,16 @@ class PostsaiTests(unittest.TestCase):
         def getfirst(self, key, default=None):
             return self.data.get(key, default)
 
+        def keys(self):
+            return self.data.keys()
+
 
     def test_validate_input(self):
-        postsai = api.Postsai({})
+        postsai = Postsai({})
         form = self.FormMock({"who" : "postman"})
         self.assertEqual(postsai.validate_input(form), "", "no filter")
 
-        postsai = api.Postsai({"filter" : { "who" : "^cvsscript$" }})
+        postsai = Postsai({"filter" : { "who" : "^cvsscript$" }})
         form = self.FormMock({"who" : "postman"})
         self.assertNotEqual(postsai.validate_input(form), "", "postman is not a permitted user")
 
@@ -182,17 +625,34 @@ class PostsaiTests(unittest.TestCase):
         form = self.FormMock({})
         self.assertEqual(postsai.validate_input(form), "", "parameter is not present")
 
+        form = self.FormMock({"timeout" : "soon"})
+        self.assertNotEqual(postsai.validate_input(form), "", "timeout is not a number")
+        self.assertNotEqual(postsai.validate_input(self.FormMock({"timeout" : "1e400"})), "", "infinite timeout")
+        self.assertNotEqual(postsai.validate_input(self.FormMock({"timeout" : "nan"})), "", "timeout is not a number")
+        self.assertNotEqual(postsai.validate_input(self.FormMock({"timeout" : "-1"})), "", "negative timeout")
+        self.assertEqual(postsai.validate_input(self.FormMock({"timeout" : "2.5"})), "", "valid timeout")
+
+        form = self.FormMock({"since" : "1 OR 1=1"})
+        self.assertNotEqual(postsai.validate_input(form), "", "since is not a checkin id")
+
 
     def test_get_read_permission_pattern(self):
-        postsai = api.Postsai({})
+        postsai = Postsai({})
         self.assertEqual(postsai.get_read_permission_pattern(), ".*", "no read permission function")
 
-        postsai = api.Postsai({"get_read_permission_pattern" : get_permission_pattern})
+        postsai = Postsai({"get_read_permission_pattern" : get_permission_pattern})
         self.assertEqual(postsai.get_read_permission_pattern(), "^test$", "read permission function defined")
 
+        postsai = Postsai({"get_read_permission_pattern" : lambda environ: environ["REMOTE_USER"]})
+        Postsai.request.environ = {"REMOTE_USER" : "^me$"}
+        try:
+            self.assertEqual(postsai.get_read_permission_pattern(), "^me$", "environment of the request")
+        finally:
+            Postsai.request.environ = None
+
 
     def test_create_where_for_column(self):
-        postsai = api.Postsai({})
+        postsai = Postsai({})
 
         postsai.sql = ""
         postsai.data = []
@@ -224,7 +684,7 @@ class PostsaiTests(unittest.TestCase):
 
 
     def test_create_where_for_date(self):
-        postsai = api.Postsai({})
+        postsai = Postsai({})
         postsai.data = []
 
         postsai.sql = ""
@@ -260,31 +720,118 @@ class PostsaiTests(unittest.TestCase):
         self.assertEqual(postsai.sql, "")
 
 
+    def test_create_where_for_since(self):
+        postsai = Postsai({})
+        postsai.data = []
+
+        postsai.sql = ""
+        postsai.create_where_for_since(self.FormMock({}))
+        self.assertEqual(postsai.sql, "", "no since parameter")
+
+        postsai.sql = ""
+        postsai.create_where_for_since(self.FormMock({"since" : "42"}))
+        self.assertEqual(postsai.sql, " AND checkins.id > %s")
+        self.assertEqual(postsai.data, [42])
+
+        postsai.sql = ""
+        postsai.data = []
+        postsai.last_id = 50
+        postsai.create_where_for_since(self.FormMock({"since" : "42"}))
+        self.assertEqual(postsai.sql, " AND checkins.id > %s AND checkins.id <= %s", "upper bound by last_id")
+        self.assertEqual(postsai.data, [42, 50])
+
+
+    def test_estimate_days(self):
+        self.assertEqual(Postsai.estimate_days(self.FormMock({})), 1, "default is one day")
+        self.assertEqual(Postsai.estimate_days(self.FormMock({"date" : "none"})), 0)
+        self.assertEqual(Postsai.estimate_days(self.FormMock({"date" : "month"})), 31)
+        self.assertEqual(Postsai.estimate_days(self.FormMock({"date" : "hours", "hours" : "48"})), 2)
+        self.assertEqual(Postsai.estimate_days(self.FormMock({"date" : "explicit", "mindate" : "2016-01-01", "maxdate" : "2016-12-31"})), 366)
+        self.assertGreater(Postsai.estimate_days(self.FormMock({"date" : "explicit", "maxdate" : "2016-12-31"})), 366, "open start")
+        self.assertEqual(Postsai.estimate_days(self.FormMock({"date" : "invalid21345"})), float("inf"))
+
+
+    def test_create_date_slices(self):
+        postsai = Postsai({"db" : {"slice_days" : 10}})
+        self.assertEqual(postsai.create_date_slices(self.FormMock({"date" : "month"})), [], "not an explicit date range")
+        self.assertEqual(postsai.create_date_slices(self.FormMock({"date" : "explicit", "maxdate" : "2016-02-22"})), [], "open start")
+        self.assertEqual(postsai.create_date_slices(self.FormMock({"date" : "explicit", "mindate" : "2016-01-01", "group" : "commit"})),
+                         [], "commits are not split across slices")
+        self.assertEqual(
+            postsai.create_date_slices(self.FormMock({"date" : "explicit", "mindate" : "2016-01-01", "maxdate" : "2016-01-25"})),
+            [("2016-01-15 00:00:01", "2016-01-25 00:00:00"),
+             ("2016-01-05 00:00:01", "2016-01-15 00:00:00"),
+             ("2016-01-01 00:00:00", "2016-01-05 00:00:00")],
+            "newest slice first without gaps or overlaps")
+        self.assertEqual(
+            postsai.create_date_slices(self.FormMock({"date" : "explicit", "mindate" : "2016-01-01", "maxdate" : "2016-01-31 23:59"})),
+            [], "maxdate in a format, which is left to the database")
+
+
+    def test_form_overlay(self):
+        form = FormOverlay(self.FormMock({"date" : "explicit", "mindate" : "2016-01-01"}), {"mindate" : "2016-02-01"})
+        self.assertEqual(form.getfirst("date"), "explicit", "parameter of the form")
+        self.assertEqual(form.getfirst("mindate"), "2016-02-01", "replaced parameter")
+        self.assertEqual(form.getfirst("maxdate", ""), "", "default value")
+
+
+    def test_is_expensive_query(self):
+        postsai = Postsai({"admission" : {}})
+        self.assertFalse(postsai.is_expensive_query(self.FormMock({"date" : "day", "file" : ".*", "filetype" : "regexp"})), "short date range")
+        self.assertTrue(postsai.is_expensive_query(self.FormMock({"date" : "month", "file" : ".*", "filetype" : "regexp", "limit" : "10"})), "regexp on month")
+        self.assertFalse(postsai.is_expensive_query(self.FormMock({"date" : "month", "file" : "api.py", "limit" : "10"})), "equal match with limit")
+        self.assertTrue(postsai.is_expensive_query(self.FormMock({"date" : "month", "file" : "api.py"})), "no limit")
+
+
+    def test_is_affected_by_import(self):
+        postsai = Postsai({})
+        self.assertTrue(postsai.is_affected_by_import(self.FormMock({}), ["postsai"]), "all repositories")
+        self.assertTrue(postsai.is_affected_by_import(self.FormMock({"repository" : "postsai"}), ["postsai"]), "same repository")
+        self.assertFalse(postsai.is_affected_by_import(self.FormMock({"repository" : "other"}), ["postsai"]), "other repository")
+        self.assertTrue(postsai.is_affected_by_import(self.FormMock({"repository" : "^post", "repositorytype" : "regexp"}), ["postsai"]), "regexp")
+
+
     def test_create_query(self):
-        postsai = api.Postsai({})
+        postsai = Postsai({})
         postsai.create_query(self.FormMock({"limit" : "10"}))
         self.assertTrue("LIMIT 10" in postsai.sql, "Limit")
+        self.assertFalse("MAX_EXECUTION_TIME" in postsai.sql, "no timeout")
+
+        postsai = Postsai({"db" : {"query_timeout" : 30}})
+        postsai.create_query(self.FormMock({}))
+        self.assertTrue(postsai.sql.startswith("SELECT /*+ MAX_EXECUTION_TIME(30000) */ "), "timeout hint")
+
+
+    def test_get_timeout(self):
+        postsai = Postsai({})
+        self.assertEqual(postsai.get_timeout(self.FormMock({})), 0, "no timeout")
+        self.assertEqual(postsai.get_timeout(self.FormMock({"timeout" : "5"})), 5, "requested timeout")
+
+        postsai = Postsai({"db" : {"query_timeout" : 30}})
+        self.assertEqual(postsai.get_timeout(self.FormMock({})), 30, "configured timeout")
+        self.assertEqual(postsai.get_timeout(self.FormMock({"timeout" : "5"})), 5, "shorter requested timeout")
+        self.assertEqual(postsai.get_timeout(self.FormMock({"timeout" : "60"})), 30, "longer requested timeout")
 
 
     def test_extract_commits(self):
-        self.assertEqual(api.Postsai.extract_commits([]), [], "empty result")
+        self.assertEqual(Postsai.extract_commits([]), [], "empty result")
         commit1 = ["repo", "", "", "file 1", "1.1", "", "", "", "", "commitid"]
         commit2 = ["repo", "", "", "file 2", "1.2", "", "", "", "", "commitid"]
         commit3 = ["repo", "", "", "file 3", "1.3", "", "", "", "", "commitid 2"]
         commit4 = ["repo2", "", "", "file 3", "1.3", "", "", "", "", "commitid 2"]
 
         self.assertEqual(
-            api.Postsai.extract_commits([commit1]),
+            Postsai.extract_commits([commit1]),
             [["repo", "", "", ["file 1"], ["1.1"], "", "", "", "", "commitid"]],
             "one row")
 
         self.assertEqual(
-            api.Postsai.extract_commits([commit1, commit2]),
+            Postsai.extract_commits([commit1, commit2]),
             [["repo", "", "", ["file 1", "file 2"], ["1.1", "1.2"], "", "", "", "", "commitid"]],
             "one commit")
 
         self.assertEqual(
-            api.Postsai.extract_commits([commit1, commit2, commit3, commit4]),
+            Postsai.extract_commits([commit1, commit2, commit3, commit4]),
             [["repo", "", "", ["file 1", "file 2"], ["1.1", "1.2"], "", "", "", "", "commitid"],
              ["repo", "", "", ["file 3"], ["1.3"], "", "", "", "", "commitid 2"],
              ["repo2", "", "", ["file 3"], ["1.3"], "", "", "", "", "commitid 2"]],
@@ -292,13 +839,688 @@ class PostsaiTests(unittest.TestCase):
 
 
 
+    def test_tag_query(self):
+        postsai = Postsai({})
+        self.assertFalse(postsai.is_tag_query(self.FormMock({"repository" : "postsai"})))
+
+        form = self.FormMock({"repository" : "postsai", "fromtag" : "v1.0", "totag" : "v1.1", "date" : "day"})
+        self.assertTrue(postsai.is_tag_query(form))
+        self.assertEqual(postsai.estimate_days(form), 0, "indexed")
+        postsai.create_query(form)
+        self.assertFalse("INTERVAL" in postsai.sql, "date is ignored")
+        self.assertTrue("AND checkins.id > (SELECT MAX(tagged.id)" in postsai.sql)
+        self.assertEqual(postsai.data, [".*", "postsai", "postsai", "postsai", "v1.0", "postsai", "v1.1"])
+
+
+    def test_grouped_query(self):
+        postsai = Postsai({})
+        self.assertFalse(postsai.is_grouped_query(self.FormMock({})), "grouping not requested")
+        self.assertTrue(postsai.is_grouped_query(self.FormMock({"group" : "commit"})), "grouping requested")
+        self.assertFalse(postsai.is_grouped_query(self.FormMock({"group" : "commit", "limit" : "10"})), "limit counts files")
+
+        postsai.create_query(self.FormMock({"group" : "commit"}))
+        self.assertTrue("GROUP BY" in postsai.sql, "grouped in database")
+        group_by = postsai.sql[postsai.sql.index("GROUP BY"):postsai.sql.index("ORDER BY")]
+        self.assertFalse("ci_when" in group_by, "files of a CVS commit have different timestamps")
+
+        commit1 = ["repo", "", "", "file 1", "1.1", "", "", "", "", "commitid"]
+        commit2 = ["repo", "", "", "file 2", "1.2", "", "", "", "", "commitid"]
+        commit3 = ["repo", "", "", "file 3", "1.3", "", "", "", "", None]
+        self.assertEqual(
+            Postsai.split_grouped_rows([["repo", "", "", "file 1\x00file 2", "1.1\x001.2", "", "", "", "", "commitid"], commit3]),
+            Postsai.extract_commits([commit1, commit2, commit3]),
+            "same result as extract_commits")
+        self.assertEqual(len(Postsai.extract_commits([commit1, commit3, commit2])), 3,
+                         "extract_commits only merges adjacent rows, the database merges the whole commit")
+
+
+
+class HotWindowTests(unittest.TestCase):
+    "test for the in memory window of recent commits"
+
+    def create_row(self, minutes, path, commit, repository="postsai"):
+        ci_when = datetime.datetime.now() - datetime.timedelta(minutes=minutes)
+        folder, file = PostsaiImporter.split_full_path(path)
+        return {"repository": repository, "ci_when": ci_when.strftime("%Y-%m-%dT%H:%M:%S"),
+                "who": "myself@example.com", "dir": folder, "file": file, "revision": commit,
+                "branch": "", "addedlines": "0", "removedlines": "0", "description": "message " + commit,
+                "hash": commit, "forked_from": ""}
+
+
+    def test_query(self):
+        window = HotWindow({})
+        window.add_row(self.create_row(20, "backend/query.py", "a"))
+        window.add_row(self.create_row(10, "backend/db.py", "b"))
+        window.add_row(self.create_row(10, "api.py", "b"))
+        window.add_row(self.create_row(10, "api.py", "b"))
+        window.add_row(self.create_row(5, "README.md", "c", "secret"))
+
+        rows = window.query(PostsaiTests.FormMock({}), ".*")
+        self.assertEqual([row[3] for row in rows], ["README.md", "api.py", "backend/db.py", "backend/query.py"],
+                         "newest first, duplicates ignored")
+        self.assertEqual(Postsai.extract_commits(rows)[1][3], ["api.py", "backend/db.py"], "commit merged")
+
+        rows = window.query(PostsaiTests.FormMock({}), "^postsai$")
+        self.assertEqual(len(rows), 3, "read permission")
+
+        rows = window.query(PostsaiTests.FormMock({"dir": "^back", "dirtype": "regexp", "limit": "1"}), ".*")
+        self.assertEqual([row[3] for row in rows], ["backend/db.py"], "regexp and limit")
+
+
+    def test_query_order(self):
+        window = HotWindow({})
+        first = self.create_row(10, "api.py", "a")
+        first["descid"] = 2
+        second = self.create_row(10, "README.md", "b")
+        second["descid"] = 1
+        window.add_row(first)
+        window.add_row(second)
+
+        rows = window.query(PostsaiTests.FormMock({}), ".*")
+        self.assertEqual([row[3] for row in rows], ["api.py", "README.md"], "ties ordered by descid like the database")
+
+        window.add_row(self.create_row(20, "setup.py", "c"))
+        window.add_row(self.create_row(1, "install.py", "d"))
+        rows = window.query(PostsaiTests.FormMock({}), ".*")
+        self.assertEqual([row[3] for row in rows], ["install.py", "api.py", "README.md", "setup.py"], "inserted in order")
+
+        window.compact(HotWindow.to_timestamp(datetime.datetime.now()) - 900)
+        rows = window.query(PostsaiTests.FormMock({}), ".*")
+        self.assertEqual([row[3] for row in rows], ["install.py", "api.py", "README.md"], "order kept by compaction")
+
+        window.compact(HotWindow.to_timestamp(datetime.datetime.now()) - 30)
+        self.assertEqual(window.query(PostsaiTests.FormMock({}), ".*"), [], "old rows removed")
+
+
+    def test_can_answer(self):
+        window = HotWindow({"hot_window" : {"days" : 7}})
+        self.assertTrue(window.can_answer(PostsaiTests.FormMock({"date" : "day"}), ".*"), "day")
+        self.assertTrue(window.can_answer(PostsaiTests.FormMock({"date" : "week"}), ".*"), "week")
+        self.assertFalse(window.can_answer(PostsaiTests.FormMock({"date" : "month"}), ".*"), "month")
+        self.assertFalse(window.can_answer(PostsaiTests.FormMock({"date" : "day", "since" : "1"}), ".*"), "since needs checkin ids")
+        self.assertFalse(window.can_answer(PostsaiTests.FormMock({"date" : "explicit", "mindate" : "2016-01-01"}), ".*"), "old date")
+        self.assertFalse(window.can_answer(PostsaiTests.FormMock({"description" : "feed", "descriptiontype" : "search"}), ".*"),
+                         "fulltext search")
+        self.assertFalse(window.can_answer(PostsaiTests.FormMock({"dir" : "b\\d", "dirtype" : "regexp"}), ".*"),
+                         "escape unknown to MySQL")
+        self.assertFalse(window.can_answer(PostsaiTests.FormMock({"who" : "[[:<:]]me", "whotype" : "regexp"}), ".*"),
+                         "POSIX character class")
+        self.assertFalse(window.can_answer(PostsaiTests.FormMock({"who" : u"j\u00f6rg"}), ".*"), "accents")
+        self.assertFalse(window.can_answer(PostsaiTests.FormMock({}), "^(?!secret)"), "read permission")
+        self.assertTrue(window.can_answer(PostsaiTests.FormMock({"dir" : "^back(end)?$", "dirtype" : "regexp"}), ".*"),
+                        "portable regexp")
+
+
+
+class PostsaiBatchTests(unittest.TestCase):
+    "test for batch queries"
+
+    def test_parse_forms(self):
+        batch = PostsaiBatch({}, [{"repository" : "postsai"}, {"who" : "myself"}])
+        forms = batch.parse_forms()
+        self.assertEqual(len(forms), 2)
+        self.assertEqual(forms[0].getfirst("repository"), "postsai")
+        self.assertEqual(forms[1].getfirst("repository", ""), "", "missing parameter")
+        self.assertFalse(batch.is_parallel(), "list of queries")
+
+        forms = PostsaiBatch({}, [{"since" : 5, "limit" : 10, "who" : None}]).parse_forms()
+        self.assertEqual(forms[0].getfirst("since"), "5", "numbers are converted to strings")
+        self.assertEqual(forms[0].getfirst("who", ""), "", "null is a missing parameter")
+        self.assertIsNone(PostsaiBatch({}, [1, 2]).parse_forms(), "not a list of objects")
+        self.assertIsNone(PostsaiBatch({}, {"queries" : "who=me"}).parse_forms(), "not a list of objects")
+
+        batch = PostsaiBatch({}, {"queries" : [{"repository" : "postsai"}], "parallel" : True})
+        self.assertEqual(len(batch.parse_forms()), 1)
+        self.assertTrue(batch.is_parallel(), "parallel execution requested")
+
+
+    def test_query_with_invalid_input(self):
+        batch = PostsaiBatch({"filter" : { "who" : "^cvsscript$" }}, [])
+        result = batch.query(batch.postsai, None, FormOverlay(None, {"who" : "postman"}), {})
+        self.assertNotEqual(result, "", "validation error is returned per query")
+
+
+
+    def test_process_with_invalid_input(self):
+        sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        try:
+            PostsaiBatch({}, [1, 2]).process()
+            PostsaiBatch({}, [{"since" : "x"}]).process()
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(output.startswith("Status: 400 Bad Request"), "not a list of objects")
+        self.assertIn("Status: 403 Forbidden", output, "validated before the headers")
+
+
+
+class PostsaiFileHistoryTests(unittest.TestCase):
+    "test for the file history"
+
+    def test_cursor(self):
+        row = [42, datetime.datetime(2016, 2, 22, 10, 30, 0)]
+        cursor = PostsaiFileHistory.create_cursor(row)
+        self.assertEqual(cursor, "2016-02-22 10:30:00,42")
+        self.assertEqual(PostsaiFileHistory.parse_cursor(cursor), ("2016-02-22 10:30:00", 42))
+        self.assertIsNone(PostsaiFileHistory.parse_cursor(""), "first page")
+        self.assertIsNone(PostsaiFileHistory.parse_cursor("invalid"), "invalid cursor")
+
+
+    def test_create_query(self):
+        ids = {"repository" : 1, "dir" : 2, "file" : 3}
+        sql, data = PostsaiFileHistory.create_query(ids, None, 10)
+        self.assertEqual(data, [3, 2, 1, 11], "one additional row to detect the next page")
+        self.assertTrue("ORDER BY checkins.ci_when DESC, checkins.id DESC" in sql)
+
+        sql, data = PostsaiFileHistory.create_query(ids, ("2016-02-22 10:30:00", 42), 10)
+        self.assertTrue("checkins.ci_when < %s OR (checkins.ci_when = %s AND checkins.id < %s)" in sql)
+        self.assertEqual(data, [3, 2, 1, "2016-02-22 10:30:00", "2016-02-22 10:30:00", 42, 11])
+
+
+    def test_get_limit(self):
+        history = PostsaiFileHistory({"history" : {"max_limit" : 50}})
+        self.assertEqual(history.get_limit(PostsaiTests.FormMock({})), 50, "capped default")
+        self.assertEqual(history.get_limit(PostsaiTests.FormMock({"limit" : "20"})), 20)
+        self.assertEqual(history.get_limit(PostsaiTests.FormMock({"limit" : "x"})), 50, "invalid limit")
+
+
+    def test_process_with_invalid_input(self):
+        history = PostsaiFileHistory({"filter" : { "who" : "^cvsscript$" }})
+        sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        try:
+            history.process(PostsaiTests.FormMock({"who" : "postman"}))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(output.startswith("Status: 403 Forbidden"), "filter is applied")
+
+
+
+class SuggestionTests(unittest.TestCase):
+    "test for suggestions"
+
+    def test_prefix_index(self):
+        index = PrefixIndex()
+        index.add([(1, u"src"), (2, u"Setup"), (3, u"doc")])
+        index.add([(4, u"source")])
+        self.assertEqual(index.find("s", lambda id: True, 10), [u"Setup", u"source", u"src"], "case insensitive")
+        self.assertEqual(index.find("s", lambda id: True, 2), [u"Setup", u"source"], "limit")
+        self.assertEqual(index.find("so", lambda id: id != 4, 10), [], "filtered")
+
+
+    def test_read_permission(self):
+        index = SuggestionIndex({})
+        index.add_values("repository", [(1, u"postsai"), (2, u"secret")])
+        index.add_values("dir", [(1, u"backend"), (2, u"backup")])
+        index.add_usage("dir", [(1, 1), (2, 2)])
+        self.assertEqual(index.query("dir", "back", ".*", 10), [u"backend", u"backup"])
+        self.assertEqual(index.query("dir", "back", "^postsai$", 10), [u"backend"], "used in secret repository only")
+        self.assertEqual(index.query("repository", "", "^postsai$", 10), [u"postsai"])
+
+        index.add_usage("dir", [(2, 1)])
+        self.assertEqual(index.query("dir", "back", "^postsai$", 10), [u"backend", u"backup"], "now used in postsai, too")
+
+
+    def test_escape_like(self):
+        self.assertEqual(PostsaiSuggestions.escape_like("a_b%c"), "a\\_b\\%c")
+
+
+    def test_get_limit(self):
+        self.assertEqual(PostsaiSuggestions.get_limit(PostsaiTests.FormMock({})), 20, "default")
+        self.assertEqual(PostsaiSuggestions.get_limit(PostsaiTests.FormMock({"limit" : "1000"})), 100, "capped")
+        self.assertEqual(PostsaiSuggestions.get_limit(PostsaiTests.FormMock({"limit" : "-5"})), 1, "negative limit")
+        self.assertEqual(PostsaiSuggestions.get_limit(PostsaiTests.FormMock({"limit" : "x"})), 20, "invalid limit")
+
+
+
+    def test_process_with_invalid_input(self):
+        suggestions = PostsaiSuggestions({"filter" : { "who" : "^cvsscript$" }})
+        sys.stdout, stdout = StringIO.StringIO(), sys.stdout
+        try:
+            suggestions.process(PostsaiTests.FormMock({"column" : "who", "prefix" : "post"}))
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertTrue(output.startswith("Status: 403 Forbidden"), "filter is applied to the prefix")
+
+
+class PostsaiApplicationTests(unittest.TestCase):
+    "test for the WSGI application"
+
+    def tearDown(self):
+        sys.stdout = sys.stdout.default
+        backend.db.PostsaiDB.pool = None
+        ExtensionManager.keep_loaded = False
+        ExtensionManager.loaded = None
+
+
+    def test_request(self):
+        def dispatch(config, environ, stdin):
+            print("Status: 403 Forbidden\r")
+            print("Content-Type: text/plain\r")
+            print("\r")
+            sys.stdout.flush()
+            print(environ["QUERY_STRING"] + " " + stdin.read())
+
+        application = PostsaiApplication({}, dispatch)
+        response = {}
+        def start_response(status, headers):
+            response["status"] = status
+            response["headers"] = headers
+
+        body = application({"QUERY_STRING" : "method=test", "CONTENT_LENGTH" : "4",
+                            "wsgi.input" : StringIO.StringIO("data")}, start_response)
+        self.assertEqual("".join(body), "method=test data\n")
+        self.assertEqual(response["status"], "403 Forbidden")
+        self.assertEqual(response["headers"], [("Content-Type", "text/plain")])
+
+
+    def test_error(self):
+        def dispatch(config, environ, stdin):
+            raise ValueError("failed")
+
+        application = PostsaiApplication({}, dispatch)
+        response = {}
+        def start_response(status, headers):
+            response["status"] = status
+
+        sys.stderr, stderr = StringIO.StringIO(), sys.stderr
+        try:
+            application({"wsgi.input" : StringIO.StringIO("")}, start_response)
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(response["status"], "500 Internal Server Error")
+
+
+
+class PostsaiEventServerTests(unittest.TestCase):
+    "test for the event driven server"
+
+    class ChannelMock:
+        "collects the response"
+
+        def __init__(self):
+            self.output = ""
+            self.connected = True
+            self.closed = False
+
+        def start_response(self, status, headers):
+            self.status = status
+
+        def push(self, data):
+            self.output = self.output + data
+
+        def close_when_done(self):
+            self.closed = True
+
+
+    def test_create_environ(self):
+        environ = PostsaiEventServer.create_environ(
+            "GET /api.py?method=feed HTTP/1.1\r\nLast-Event-ID: 42\r\nContent-Length: 0", ("127.0.0.1", 1234))
+        self.assertEqual(environ["REQUEST_METHOD"], "GET")
+        self.assertEqual(environ["QUERY_STRING"], "method=feed")
+        self.assertEqual(environ["HTTP_LAST_EVENT_ID"], "42")
+        self.assertEqual(environ["CONTENT_LENGTH"], "0")
+        self.assertEqual(environ["REMOTE_ADDR"], "127.0.0.1")
+
+
+    def test_send_unknown_commit(self):
+        channel = PostsaiEventServerTests.ChannelMock()
+        PostsaiEventServer.send_commit(channel, PostsaiTests.FormMock({}), [])
+        self.assertEqual(channel.status, "404 Not Found")
+        self.assertTrue(channel.closed, "connection closed")
+
+    def test_feed_hub(self):
+        config = {"feed" : {"file" : tempfile.mkdtemp() + "/feed.json", "poll_interval" : 0}}
+        hub = FeedHub(config)
+        channel = PostsaiEventServerTests.ChannelMock()
+        hub.subscribe(channel, PostsaiTests.FormMock({"repository" : "postsai"}), {})
+        self.assertEqual(channel.status, "200 OK")
+
+        row = {"repository" : "postsai", "ci_when" : "2016-02-22 10:30:00", "who" : "me", "dir" : "",
+               "file" : "README.md", "revision" : "1.1", "branch" : "", "addedlines" : 1, "removedlines" : 0,
+               "description" : "text", "hash" : "a", "forked_from" : ""}
+        PostsaiFeed(config).publish([row])
+        hub.poll()
+        self.assertTrue("data: " in channel.output, "commit sent")
+
+        hub.unsubscribe(channel)
+        self.assertEqual(hub.subscribers, {})
+
+
+    def test_feed_hub_resume(self):
+        config = {"feed" : {"file" : tempfile.mkdtemp() + "/feed.json", "poll_interval" : 0}}
+        row = {"repository" : "postsai", "ci_when" : "2016-02-22 10:30:00", "who" : "me", "dir" : "",
+               "file" : "README.md", "revision" : "1.1", "branch" : "", "addedlines" : 1, "removedlines" : 0,
+               "description" : "text", "hash" : "a", "forked_from" : ""}
+        feed = PostsaiFeed(config)
+        feed.publish([row])
+        generation, end = feed.find_start_offset("")
+        start = feed.read_header(open(config["feed"]["file"]))[1]
+
+        self.assertEqual(feed.find_start_offset(str(generation) + "-" + str(start)), (generation, start), "start of a row")
+        self.assertEqual(feed.find_start_offset(str(generation) + "-" + str(start + 3)), (generation, end), "middle of a row")
+        self.assertEqual(feed.find_start_offset(str(generation) + "-" + str(end + 100)), (generation, end), "beyond the end")
+        self.assertEqual(feed.find_start_offset("42"), (generation, end), "invalid id")
+        self.assertEqual(feed.find_start_offset("1-10"), (generation, start), "older generation")
+
+        hub = FeedHub(config)
+        channel = PostsaiEventServerTests.ChannelMock()
+        hub.subscribe(channel, PostsaiTests.FormMock({}), {"HTTP_LAST_EVENT_ID" : "42"})
+        hub.subscribers[channel]["position"] = 42
+        hub.poll()
+        self.assertEqual(hub.subscribers, {}, "broken subscriber dropped")
+
+
+    def test_feed_hub_permissions(self):
+        config = {"feed" : {"file" : tempfile.mkdtemp() + "/feed.json"},
+                  "get_read_permission_pattern" : lambda environ: environ["REMOTE_USER"]}
+        hub = FeedHub(config)
+        channel = PostsaiEventServerTests.ChannelMock()
+        hub.subscribe(channel, PostsaiTests.FormMock({}), {"REMOTE_USER" : "^me$"})
+        self.assertEqual(hub.subscribers[channel]["read_permission_pattern"], "^me$", "environment of the subscriber")
+
+
+
 class PostsaiCommitViewerTest(unittest.TestCase):
 
     def test_calculate_previous_cvs_revision(self):
-        self.assertEqual(api.PostsaiCommitViewer.calculate_previous_cvs_revision("1.2"), "1.1")
-        self.assertEqual(api.PostsaiCommitViewer.calculate_previous_cvs_revision("1.3.2.4"), "1.3.2.3")
-        self.assertEqual(api.PostsaiCommitViewer.calculate_previous_cvs_revision("1.3.2.1"), "1.3")
-        self.assertEqual(api.PostsaiCommitViewer.calculate_previous_cvs_revision("1.1"),     "1.0")
+        self.assertEqual(PostsaiCommitViewer.calculate_previous_cvs_revision("1.2"), "1.1")
+        self.assertEqual(PostsaiCommitViewer.calculate_previous_cvs_revision("1.3.2.4"), "1.3.2.3")
+        self.assertEqual(PostsaiCommitViewer.calculate_previous_cvs_revision("1.3.2.1"), "1.3")
+        self.assertEqual(PostsaiCommitViewer.calculate_previous_cvs_revision("1.1"),     "1.0")
+
+
+
+class QuerySlotsTests(unittest.TestCase):
+    "test for the admission control"
+
+    def test_acquire(self):
+        config = {"admission" : {"lock_folder" : tempfile.mkdtemp(), "max_expensive_queries" : 1, "queue_timeout" : 0}}
+        first = QuerySlots(config)
+        second = QuerySlots(config)
+        self.assertTrue(first.acquire(), "free slot")
+        self.assertFalse(second.acquire(), "no free slot")
+        first.release()
+        self.assertTrue(second.acquire(), "slot was released")
+        second.release()
+
+
+
+class QueryResultCacheTests(unittest.TestCase):
+    "test for the query result cache"
+
+    def test_create_key(self):
+        cache = QueryResultCache({})
+        key1 = cache.create_key(PostsaiTests.FormMock({"repository" : "postsai", "branch" : "HEAD", "_" : "123"}), ".*")
+        key2 = cache.create_key(PostsaiTests.FormMock({"branch" : "HEAD", "repository" : "postsai"}), ".*")
+        key3 = cache.create_key(PostsaiTests.FormMock({"branch" : "HEAD", "repository" : "postsai"}), "^postsai$")
+        self.assertEqual(key1, key2, "order and cache buster are ignored")
+        self.assertNotEqual(key1, key3, "read permission is part of the key")
+        self.assertEqual(cache.parse_key(key1), (".*", {"repository" : "postsai", "branch" : "HEAD"}))
+
+
+    def test_generations(self):
+        cache = QueryResultCache({"result_cache" : {"folder" : tempfile.mkdtemp(), "prewarm" : 1}})
+        generation = cache.read_generation()
+        cache.put("key1", generation, {"data" : []})
+        cache.put("key2", generation, {"data" : []})
+        self.assertEqual(cache.get("key1", generation), {"data" : []}, "cached")
+        self.assertIsNone(cache.get("key3", generation), "not cached")
+
+        cache.invalidate()
+        self.assertNotEqual(cache.read_generation(), generation, "new generation")
+        self.assertEqual(cache.read_previous_generation(), generation)
+        self.assertIsNone(cache.get("key1", cache.read_generation()), "invalidated by import")
+
+        cache.carry_over("key2", generation, cache.read_generation())
+        self.assertEqual(cache.get("key2", cache.read_generation()), {"data" : []}, "not affected by import")
+
+
+    def test_find_popular_queries(self):
+        cache = QueryResultCache({"result_cache" : {"folder" : tempfile.mkdtemp(), "prewarm" : 2}})
+        self.assertEqual(cache.find_popular_queries(), [], "nothing recorded")
+        for key in ["a", "b", "b", "c", "c", "c"]:
+            cache.record(key)
+        self.assertEqual(cache.find_popular_queries(), ["c", "b"])
+
+
+    def test_remove_outdated(self):
+        folder = tempfile.mkdtemp()
+        cache = QueryResultCache({"result_cache" : {"folder" : folder, "max_age" : 60}})
+        cache.put("old", 0, {"data" : []})
+        cache.put("expired", 0, {"data" : []})
+        os.utime(cache.filename("old"), (1, 1))
+        cache.invalidate()
+        cache.invalidate()
+        os.utime(cache.filename("expired"), (time.time() - 120, time.time() - 120))
+        cache.put("current", cache.read_generation(), {"data" : []})
+        open(folder + "/extensions.json", "w").close()
+
+        cache.remove_outdated()
+        self.assertFalse(os.path.exists(cache.filename("old")), "older generation")
+        self.assertFalse(os.path.exists(cache.filename("expired")), "past max_age")
+        self.assertTrue(os.path.exists(cache.filename("current")))
+        self.assertTrue(os.path.exists(folder + "/extensions.json"), "other files are kept")
+
+
+
+class PostsaiBootstrapTests(unittest.TestCase):
+    "test for the bootstrap endpoint"
+
+    class BootstrapMock(PostsaiBootstrap):
+        "counts the computations instead of accessing the database"
+
+        computations = 0
+
+        def create_result(self, read_permission_pattern):
+            self.computations = self.computations + 1
+            return {"repositories" : {"postsai" : {"id" : 1}}, "pattern" : read_permission_pattern}
+
+
+    def test_get_result(self):
+        config = {"result_cache" : {"folder" : tempfile.mkdtemp()}}
+        bootstrap = PostsaiBootstrapTests.BootstrapMock(config)
+        self.assertEqual(bootstrap.get_result()["pattern"], ".*")
+        bootstrap.get_result()
+        QueryResultCache(config).invalidate()
+        bootstrap.get_result()
+        self.assertEqual(bootstrap.computations, 1, "cached, imports do not invalidate")
+
+        QueryResultCache(config).invalidate_repositories()
+        bootstrap.get_result()
+        self.assertEqual(bootstrap.computations, 2, "recomputed for new repository")
+
+
+
+class ExtensionManagerTests(unittest.TestCase):
+    "test for the manifest of the extensions"
+
+    def write_manifest(self, folder, signature):
+        with open(folder + "/extensions.json", "w") as f:
+            json.dump({"signature" : signature, "extensions" : [{"name" : "example", "methods" : ["query_extension_setup"], "files" : []}]}, f)
+
+
+    def test_manifest(self):
+        folder = tempfile.mkdtemp()
+        config = {"result_cache" : {"folder" : folder}}
+        self.assertFalse(ExtensionManager(config).has_method("query_extension_setup"), "no extensions installed")
+        self.assertTrue(os.path.isfile(folder + "/extensions.json"), "manifest stored")
+
+        self.write_manifest(folder, ExtensionManager.read_signature())
+        manager = ExtensionManager(config)
+        self.assertEqual(manager.find_extensions("query_extension_setup"), ["example"], "manifest used")
+        self.assertFalse(manager.has_method("install_post"))
+
+        self.write_manifest(folder, [])
+        self.assertFalse(ExtensionManager(config).has_method("query_extension_setup"), "outdated manifest replaced")
+
+
+    def test_read_signature(self):
+        folder = tempfile.mkdtemp()
+        os.makedirs(folder + "/example")
+        with open(folder + "/example/__init__.py", "w") as f:
+            f.write("")
+        os.utime(folder + "/example/__init__.py", (1000, 1000))
+        os.utime(folder + "/example", (1000, 1000))
+        extensions_folder, ExtensionManager.extensions_folder = ExtensionManager.extensions_folder, folder
+        try:
+            signature = ExtensionManager.read_signature()
+            self.assertEqual(signature[1], ["example", 1000, 1000])
+
+            os.utime(folder + "/example/__init__.py", (2000, 2000))
+            self.assertNotEqual(ExtensionManager.read_signature(), signature, "modified __init__.py")
+
+            signature = ExtensionManager.read_signature()
+            with open(folder + "/example/helper.py", "w") as f:
+                f.write("")
+            os.utime(folder + "/example", (3000, 3000))
+            self.assertNotEqual(ExtensionManager.read_signature(), signature, "added file")
+        finally:
+            ExtensionManager.extensions_folder = extensions_folder
+
+
+    class ExampleExtension:
+        "records its calls"
+
+        def __init__(self):
+            self.calls = []
+
+        def query_extension_setup(self, config):
+            self.calls.append(config)
+
+
+    def test_call_all(self):
+        manager = ExtensionManager({"extensions" : {"slow_hook_ms" : 60000}})
+        manager.manifest = {"extensions" : [{"name" : "example", "methods" : ["query_extension_setup"], "files" : ["query.js"]}]}
+        extension = ExtensionManagerTests.ExampleExtension()
+        manager.extensions["example"] = extension
+        Metrics.take_pending()
+
+        manager.call_all("query_extension_setup", [1])
+        manager.call_all("query_extension_setup", [2])
+        manager.call_all("query_post_process_result", [])
+        self.assertEqual(extension.calls, [1, 2])
+        self.assertEqual(len(manager.hooks["query_extension_setup"]), 1, "dispatch table")
+        self.assertEqual(manager.hooks["query_post_process_result"], [])
+        self.assertEqual(Metrics.take_pending()["counters"]["postsai_extension_calls_total"],
+                         {"method=\"example.query_extension_setup\"" : 2}, "calls counted")
+        self.assertEqual(manager.list_extension_files("query.js"), ["extensions/example/query.js"])
+        self.assertEqual(manager.list_extension_files("install.js"), [])
+
+
+
+class ContributionTests(unittest.TestCase):
+    "test for cacheable contributions of extensions"
+
+    class ContributingExtension:
+        "contributes the number of its computations"
+
+        def __init__(self):
+            self.computations = 0
+
+        def query_contribution_key(self, postsai, form):
+            if form.getfirst("who", "") == "":
+                return None
+            return form.getfirst("who", "")
+
+        def query_contribution(self, postsai, form, db):
+            self.computations = self.computations + 1
+            return {"computations" : self.computations}
+
+
+    def test_add_contributions(self):
+        config = {"result_cache" : {"folder" : tempfile.mkdtemp()}}
+        postsai = Postsai(config)
+        postsai.extension_manager.manifest = {"extensions" : [{"name" : "example", "methods" : ["query_contribution"], "files" : []}]}
+        postsai.extension_manager.hooks = {}
+        extension = ContributionTests.ContributingExtension()
+        postsai.extension_manager.extensions = {"example" : extension}
+
+        form = FormOverlay(None, {"who" : "me"})
+        self.assertEqual(postsai.complete_result("db", form, {})["extension"], {"computations" : 1})
+        self.assertEqual(postsai.complete_result("db", form, {})["extension"], {"computations" : 1}, "cached")
+        postsai.complete_result("db", FormOverlay(None, {"who" : "other"}), {})
+        self.assertEqual(extension.computations, 2, "key derived from the form")
+
+        QueryResultCache(config).invalidate()
+        self.assertEqual(postsai.complete_result("db", form, {})["extension"], {"computations" : 3}, "invalidated by import")
+        postsai.complete_result("db", FormOverlay(None, {}), {})
+        postsai.complete_result("db", FormOverlay(None, {}), {})
+        self.assertEqual(extension.computations, 5, "not cacheable")
+
+
+
+class PostsaiFeedTests(unittest.TestCase):
+    "test for the feed"
+
+    row = {"repository": "postsai", "ci_when": "2016-03-12T13:46:45", "who": "myself@example.com",
+           "dir": "backend", "file": "feed.py", "revision": "1.1", "branch": "",
+           "addedlines": "0", "removedlines": "0", "description": "Added feed",
+           "hash": "abc", "forked_from": ""}
+
+
+    def test_matches_column(self):
+        self.assertTrue(Postsai.matches_column("postsai", "postsai", "match"), "equal")
+        self.assertFalse(Postsai.matches_column("postsai", "post", "match"), "not equal")
+        self.assertTrue(Postsai.matches_column("postsai", "^post", "regexp"), "regexp")
+        self.assertFalse(Postsai.matches_column("postsai", "^post", "notregexp"), "notregexp")
+        self.assertTrue(Postsai.matches_column("Added Feed", "feed", "search"), "search")
+        self.assertTrue(Postsai.matches_column("Postsai ", "postsai", "match"), "case and trailing spaces are ignored")
+        self.assertTrue(Postsai.matches_column("Postsai", "^post", "regexp"), "case insensitive regexp")
+        self.assertFalse(Postsai.matches_column("Postsai", "^post", "notregexp"), "case insensitive notregexp")
+        self.assertFalse(Postsai.matches_column("postsai", "(", "regexp"), "invalid regexp")
+
+
+    def test_matches(self):
+        feed = PostsaiFeed({})
+        self.assertTrue(feed.matches(PostsaiTests.FormMock({}), ".*", self.row), "no filter")
+        self.assertFalse(feed.matches(PostsaiTests.FormMock({}), "^test$", self.row), "no read permission")
+        self.assertTrue(feed.matches(PostsaiTests.FormMock({"branch": "HEAD"}), ".*", self.row), "HEAD branch")
+        self.assertFalse(feed.matches(PostsaiTests.FormMock({"who": "other"}), ".*", self.row), "other author")
+        self.assertTrue(feed.matches(PostsaiTests.FormMock({"dir": "^back", "dirtype": "regexp"}), ".*", self.row), "dir regexp")
+
+
+    def test_publish_and_read(self):
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            feed = PostsaiFeed({"feed": {"file": filename}})
+            offset, rows = feed.read_new_rows(None)
+            self.assertEqual(rows, [], "empty feed")
+
+            feed.publish([self.row, self.row])
+            offset, rows = feed.read_new_rows(offset)
+            self.assertEqual(len(rows), 2, "two rows published")
+            self.assertEqual(rows[0]["file"], "feed.py")
+
+            commits = feed.extract_matching_commits(PostsaiTests.FormMock({}), ".*", rows)
+            self.assertEqual(len(commits), 1, "rows of the same commit are merged")
+            self.assertEqual(commits[0][3], ["backend/feed.py", "backend/feed.py"])
+
+            self.assertEqual(feed.read_new_rows(offset), (offset, []), "nothing new")
+        finally:
+            os.remove(filename)
+
+
+    def test_read_after_truncation(self):
+        (handle, filename) = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            feed = PostsaiFeed({"feed": {"file": filename, "max_size": 1}})
+            feed.publish([self.row, self.row, self.row])
+            position, rows = feed.read_new_rows(None)
+            self.assertEqual(len(rows), 3)
+
+            # the feed starts over and grows beyond the old position
+            feed.publish([self.row])
+            feed.publish([self.row, self.row, self.row, self.row])
+            new_position, rows = feed.read_new_rows(position)
+            self.assertNotEqual(new_position[0], position[0], "new generation")
+            self.assertGreater(new_position[1], position[1])
+            self.assertEqual(len(rows), 4, "rows of the new generation")
+        finally:
+            os.remove(filename)
 
 
 
@@ -307,7 +1529,7 @@ class PostsaiImporterTests(unittest.TestCase):
 
 
     def test_parse_timestamp(self):
-        postsai = api.PostsaiImporter({}, {})
+        postsai = PostsaiImporter({}, {})
 
         a = postsai.parse_timestamp("2015-05-05T19:40:15+04:00")
         b = postsai.parse_timestamp("2015-05-05T19:40:15")
@@ -318,7 +1540,7 @@ class PostsaiImporterTests(unittest.TestCase):
 
 
     def test_split_full_path(self):
-        postsai = api.PostsaiImporter({}, {})
+        postsai = PostsaiImporter({}, {})
         folder, file = postsai.split_full_path("README.md")
         self.assertEquals(folder, "", "empty folder on README.md")
         self.assertEquals(file, "README.md", "file README.md on README.md")
@@ -333,7 +1555,7 @@ class PostsaiImporterTests(unittest.TestCase):
 
 
     def test_filter_out_folders(self):
-        postsai = api.PostsaiImporter({}, {})
+        postsai = PostsaiImporter({}, {})
         res = postsai.filter_out_folders({"content" : "change", "content/game" : "change", "content/game/sourcelog.php" : "change" })
         self.assertIn("content/game/sourcelog.php", res, "file remained in list")
         self.assertNotIn("content", res, "folder was removed from list")
@@ -341,14 +1563,14 @@ class PostsaiImporterTests(unittest.TestCase):
 
 
     def test_file_revision(self):
-        postsai = api.PostsaiImporter({}, {})
+        postsai = PostsaiImporter({}, {})
         self.assertEqual(postsai.file_revision({"id" : "r2"}, {}), "2", "Subversion version without r")
         self.assertEqual(postsai.file_revision({"id" : "eef37d923574175c5606d04af19793f63c056f82"}, {}), "eef37d923574175c5606d04af19793f63c056f82", "Git revision")
         self.assertEqual(postsai.file_revision({"revisions" : {"bla" : "1.1"}}, "bla"), "1.1", "CVS file revision")
 
 
     def test_extract_branch(self):
-        importer = api.PostsaiImporter({}, {})
+        importer = PostsaiImporter({}, {})
         self.assertEqual(importer.extract_branch(), "", "no branch")
 
         importer.data["ref"] = "HEAD"
@@ -364,40 +1586,55 @@ class PostsaiImporterTests(unittest.TestCase):
         self.assertEqual(importer.extract_branch(), "bugfix/1", "branch name with slash")
 
 
+    def test_extract_tag(self):
+        importer = PostsaiImporter({}, {"ref" : "refs/heads/dev"})
+        self.assertIsNone(importer.extract_tag(), "branch push")
+
+        importer.data = {"ref" : "refs/tags/v1.0", "after" : "abc", "head_commit" : {"id" : "def"}}
+        self.assertEqual(importer.extract_tag(), "v1.0")
+        self.assertEqual(importer.extract_tagged_commit(), "def", "commit of annotated tag")
+
+        importer.data = {"ref" : "refs/tags/v1.0", "after" : "abc"}
+        self.assertEqual(importer.extract_tagged_commit(), "abc")
+
+        importer.data = {"ref" : "refs/tags/v1.0", "after" : "0000000000000000000000000000000000000000"}
+        self.assertIsNone(importer.extract_tagged_commit(), "deleted tag")
+
+
     def test_extract_repo_name(self):
-        importer = api.PostsaiImporter({}, {"repository" : { "full_name" : "arianne/stendhal"}})
+        importer = PostsaiImporter({}, {"repository" : { "full_name" : "arianne/stendhal"}})
         self.assertEqual(importer.extract_repo_name(), "arianne/stendhal", "GitHub repository")
 
-        importer = api.PostsaiImporter({}, {"repository" : { "full_name" : "/p/arianne/stendhal-website/"}})
+        importer = PostsaiImporter({}, {"repository" : { "full_name" : "/p/arianne/stendhal-website/"}})
         self.assertEqual(importer.extract_repo_name(), "p/arianne/stendhal-website", "SourceForge repository")
 
-        importer = api.PostsaiImporter({}, {"project" : { "path_with_namespace" : "cs.sys/cs.sys.portal"},
+        importer = PostsaiImporter({}, {"project" : { "path_with_namespace" : "cs.sys/cs.sys.portal"},
                                             "repository": { "name": "cs.sys.portal"}})
         self.assertEqual(importer.extract_repo_name(), "cs.sys/cs.sys.portal", "Gitlab repository")
 
-        importer = api.PostsaiImporter({}, {"repository" : { "name" : "gittest"}})
+        importer = PostsaiImporter({}, {"repository" : { "name" : "gittest"}})
         self.assertEqual(importer.extract_repo_name(), "gittest", "Git repository")
 
 
     def test_extract_repo_url(self):
-        importer = api.PostsaiImporter({}, {"repository" : {}})
+        importer = PostsaiImporter({}, {"repository" : {}})
         self.assertEqual(importer.extract_repo_url(), "", "No repository url")
 
-        importer = api.PostsaiImporter({}, {"repository" : { "clone_url": "https://github.com/arianne/stendhal.git"}})
+        importer = PostsaiImporter({}, {"repository" : { "clone_url": "https://github.com/arianne/stendhal.git"}})
         self.assertEqual(importer.extract_repo_url(), "https://github.com/arianne/stendhal.git", "GitHub repository")
 
-        importer = api.PostsaiImporter({}, {"repository" : { "git_ssh_url" : "git@example.com:cs.sys/cs.sys.portal.git"}})
+        importer = PostsaiImporter({}, {"repository" : { "git_ssh_url" : "git@example.com:cs.sys/cs.sys.portal.git"}})
         self.assertEqual(importer.extract_repo_url(), "git@example.com:cs.sys/cs.sys.portal.git", "Gitlab repository")
 
-        importer = api.PostsaiImporter({}, {"repository" : { "url" : ":pserver:anonymous:@cvs.example.com/srv/cvs/repository"}})
+        importer = PostsaiImporter({}, {"repository" : { "url" : ":pserver:anonymous:@cvs.example.com/srv/cvs/repository"}})
         self.assertEqual(importer.extract_repo_url(), ":pserver:anonymous:@cvs.example.com/srv/cvs/repository", "CVS repository")
 
 
     def test_extract_url(self):
-        importer = api.PostsaiImporter({}, {"repository" : { "url" : "https://github.com/arianne/stendhal"}})
+        importer = PostsaiImporter({}, {"repository" : { "url" : "https://github.com/arianne/stendhal"}})
         self.assertEqual(importer.extract_url(), "https://github.com/arianne/stendhal", "GitHub repository")
 
-        importer = api.PostsaiImporter({}, {"repository" : { "home_url" : "https://cvs.example.com/viewvc"}})
+        importer = PostsaiImporter({}, {"repository" : { "home_url" : "https://cvs.example.com/viewvc"}})
         self.assertEqual(importer.extract_url(), "https://cvs.example.com/viewvc", "CVS")
 
         importer.data = {"project": { "web_url":"https://example.com/arianne/stendhal" }}
@@ -405,7 +1642,7 @@ class PostsaiImporterTests(unittest.TestCase):
 
 
     def test_extract_files(self):
-        self.assertEqual(api.PostsaiImporter.extract_files(
+        self.assertEqual(PostsaiImporter.extract_files(
             {
                 "added": [],
                 "removed": [],
@@ -415,16 +1652,19 @@ class PostsaiImporterTests(unittest.TestCase):
 
 
     def test_check_permission(self):
-        importer = api.PostsaiImporter({}, {})
+        importer = PostsaiImporter({}, {})
         self.assertTrue(importer.check_permission("something"), "no permission pattern defined")
 
-        importer = api.PostsaiImporter({"get_write_permission_pattern" : get_permission_pattern}, {})
+        importer = PostsaiImporter({"get_write_permission_pattern" : get_permission_pattern}, {})
         self.assertTrue(importer.check_permission("test"), "matching permission pattern defined")
         self.assertFalse(importer.check_permission("something"), "not matching permission defined")
 
+        importer = PostsaiImporter({"get_write_permission_pattern" : lambda environ: environ["REMOTE_USER"]}, {})
+        self.assertTrue(importer.check_permission("me", {"REMOTE_USER" : "^me$"}), "environment of the request")
+
 
     def test_extract_email(self):
-        importer = api.PostsaiImporter({}, {})
+        importer = PostsaiImporter({}, {})
         self.assertEqual(importer.extract_email({"email": "Name@example.com"}), "name@example.com")
         self.assertEqual(importer.extract_email({"email": "", "name": "bla"}), "bla")
         self.assertEqual(importer.extract_email({"name": "Name@example.com"}), "name@example.com")
@@ -432,22 +1672,22 @@ class PostsaiImporterTests(unittest.TestCase):
 
 
     def test_extract_sender_user(self):
-        importer = api.PostsaiImporter({}, {"user_email": "me@example.com"})
+        importer = PostsaiImporter({}, {"user_email": "me@example.com"})
         self.assertEqual(importer.extract_sender_user(), "me@example.com")
 
-        importer = api.PostsaiImporter({}, {"user_id": "12345"})
+        importer = PostsaiImporter({}, {"user_id": "12345"})
         self.assertEqual(importer.extract_sender_user(), "12345")
 
-        importer = api.PostsaiImporter({}, {"user_name": "username"})
+        importer = PostsaiImporter({}, {"user_name": "username"})
         self.assertEqual(importer.extract_sender_user(), "username")
 
-        importer = api.PostsaiImporter({}, {"sender": {}})
+        importer = PostsaiImporter({}, {"sender": {}})
         self.assertEqual(importer.extract_sender_user(), "")
 
 
 
     def test_parse_data(self):
-        importer = api.PostsaiImporter({},
+        importer = PostsaiImporter({},
             {
                 "ref": "refs/heads/HEAD",
                 "after": "10056E40FB51177B8D0",
@@ -0,0 +1,91 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import json
+
+from db import PostsaiDB
+from query import Postsai, convert_to_builtin_type
+from resultcache import QueryResultCache
+
+
+class PostsaiActivity:
+    """Lists the latest commit of every repository and branch.
+
+       The latestactivity table is maintained by the importer, so this reads
+       one row per branch instead of grouping the checkins."""
+
+    def __init__(self, config):
+        """Creates a PostsaiActivity instance"""
+
+        self.config = config
+
+
+    @staticmethod
+    def convert_row(row):
+        """converts a database row into an entry of the result"""
+
+        return {
+            "repository": row[0],
+            "branch": row[1],
+            "ci_when": row[2],
+            "who": row[3],
+            "description": row[4],
+            "commit": row[5]
+        }
+
+
+    def read_activity(self, db, read_permission_pattern):
+        """reads the latest activity of all repositories which may be read, newest first"""
+
+        sql = """SELECT repositories.repository, branches.branch, latestactivity.ci_when, people.who,
+            descs.description, commitids.hash
+            FROM latestactivity
+            JOIN repositories ON latestactivity.repositoryid = repositories.id
+            JOIN branches ON latestactivity.branchid = branches.id
+            JOIN people ON latestactivity.whoid = people.id
+            JOIN descs ON latestactivity.descid = descs.id
+            LEFT JOIN commitids ON latestactivity.commitid = commitids.id
+            WHERE repositories.repository REGEXP %s
+            ORDER BY latestactivity.ci_when DESC"""
+        return [self.convert_row(row) for row in db.query(sql, [read_permission_pattern])]
+
+
+    def process(self):
+        """processes a latest activity request"""
+
+        read_permission_pattern = Postsai.get_configured_read_permission_pattern(self.config)
+        cache = QueryResultCache(self.config)
+        key = json.dumps(["activity", read_permission_pattern])
+        generation = cache.read_generation()
+
+        result = cache.get(key, generation)
+        if result == None:
+            db = PostsaiDB(self.config, read_only=True)
+            db.connect()
+            result = {"activity": self.read_activity(db, read_permission_pattern)}
+            db.disconnect()
+            cache.put(key, generation, result)
+
+        print("Content-Type: text/json; charset='utf-8'\r")
+        print("Cache-Control: max-age=60\r")
+        print("\r")
+        print(json.dumps(result, default=convert_to_builtin_type))
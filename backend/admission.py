@@ -0,0 +1,80 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import fcntl
+import os
+import time
+
+
+class QuerySlots:
+    """Limits the number of expensive queries which are executed at the same time.
+
+       Every slot is a lock file, so the limit is shared by all processes on
+       this host. Locks are released by the operating system, if a process dies."""
+
+    def __init__(self, config):
+        """Creates a QuerySlots instance"""
+
+        self.admission_config = config.get("admission", {})
+        self.handle = None
+
+
+    def try_acquire(self):
+        """tries to lock a free slot without waiting"""
+
+        folder = self.admission_config.get("lock_folder", "/var/tmp/postsai-admission")
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+        for i in range(self.admission_config.get("max_expensive_queries", 2)):
+            handle = open(folder + "/slot-" + str(i), "a")
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.handle = handle
+                return True
+            except IOError:
+                handle.close()
+        return False
+
+
+    def acquire(self):
+        """waits in the queue for a free slot, returns False on timeout"""
+
+        deadline = time.time() + self.admission_config.get("queue_timeout", 10)
+        while not self.try_acquire():
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+
+    def release(self):
+        """releases the slot"""
+
+        if self.handle != None:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+            self.handle.close()
+            self.handle = None
@@ -0,0 +1,200 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import copy
+import json
+import threading
+
+from db import PostsaiDB
+from query import Postsai, FormOverlay, convert_to_builtin_type
+
+
+class PostsaiBatch:
+    """Executes several queries in one request, e. g. for dashboards.
+
+       The request body is either a list of query parameters or an object
+       {"queries": [...], "parallel": true}."""
+
+    # parts of the result which are the same for all queries
+    shared_keys = ("config", "repositories", "additional_scripts")
+
+
+    def __init__(self, config, data):
+        """Creates a PostsaiBatch instance"""
+
+        self.config = config
+        self.data = data
+        self.postsai = Postsai(config)
+
+
+    def parse_forms(self):
+        """converts the queries of the request into forms, returns None if the request is malformed"""
+
+        queries = self.data
+        if isinstance(self.data, dict):
+            queries = self.data.get("queries", [])
+        if not isinstance(queries, list):
+            return None
+
+        forms = []
+        for query in queries:
+            if not isinstance(query, dict):
+                return None
+            # JSON numbers are passed as strings like the parameters of a query string
+            params = {}
+            for key, value in query.items():
+                if isinstance(value, basestring):
+                    params[key] = value
+                elif value != None:
+                    params[key] = json.dumps(value)
+            forms.append(FormOverlay(None, params))
+        return forms
+
+
+    def is_parallel(self):
+        """checks whether the client asked for parallel execution"""
+
+        return isinstance(self.data, dict) and self.data.get("parallel", False)
+
+
+    def query(self, postsai, db, form, repositories):
+        """executes a single query of the batch"""
+
+        error = postsai.validate_input(form)
+        if error != "":
+            return error
+
+        result = postsai.create_result(db, form, repositories)
+        for key in self.shared_keys:
+            del result[key]
+        return result
+
+
+    def query_sequential(self, db, forms, repositories):
+        """executes the queries one after another on the shared connection"""
+
+        results = []
+        for form in forms:
+            results.append(self.query(self.postsai, db, form, repositories))
+        return results
+
+
+    def query_parallel(self, forms, repositories):
+        """executes the queries on several connections at the same time"""
+
+        results = [None] * len(forms)
+        errors = []
+        state = {"next": 0}
+        lock = threading.Lock()
+
+        def work():
+            # the query is built in attributes of the Postsai instance, so every thread needs its own
+            postsai = copy.copy(self.postsai)
+            try:
+                db = PostsaiDB(self.config, read_only=True)
+                db.connect()
+            except Exception as err:
+                errors.append(err)
+                return
+
+            try:
+                while True:
+                    with lock:
+                        index = state["next"]
+                        if index >= len(forms):
+                            return
+                        state["next"] = index + 1
+                    results[index] = self.query(postsai, db, forms[index], repositories)
+            except Exception as err:
+                errors.append(err)
+            finally:
+                db.disconnect()
+
+        threads = []
+        for i in range(min(self.config.get("db", {}).get("parallel_queries", 4), len(forms))):
+            thread = threading.Thread(target=PostsaiDB.record_in_thread(work))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+
+    def process(self):
+        """processes a batch request"""
+
+        forms = self.parse_forms()
+        if forms == None:
+            print("Status: 400 Bad Request\r")
+            print("Content-Type: text/plain; charset='utf-8'\r")
+            print("\r")
+            print("Expected a list of queries")
+            return
+
+        for form in forms:
+            error = self.postsai.validate_input(form)
+            if error != "":
+                print("Status: 403 Forbidden\r")
+                print("Content-Type: text/plain; charset='utf-8'\r")
+                print("\r")
+                print(error)
+                return
+
+        # one slot is enough because the queries are executed by this process
+        admission_form = FormOverlay(None, {"date" : "none"})
+        for form in forms:
+            if self.postsai.is_expensive_query(form):
+                admission_form = form
+                break
+        slots = self.postsai.admit(admission_form)
+        if slots == None:
+            self.postsai.print_busy_response()
+            return
+
+        print("Content-Type: text/json; charset='utf-8'\r")
+        print("Cache-Control: max-age=60\r")
+        print("\r")
+
+        try:
+            db = PostsaiDB(self.config, read_only=True)
+            db.connect()
+            self.postsai.last_id = self.postsai.read_last_id(db)
+            repositories = self.postsai.read_repositories(db)
+            if self.is_parallel():
+                results = self.query_parallel(forms, repositories)
+            else:
+                results = self.query_sequential(db, forms, repositories)
+            db.disconnect()
+        finally:
+            slots.release()
+
+        result = {
+            "config" : self.config.get("ui", {}),
+            "repositories": repositories,
+            "last_id": self.postsai.last_id,
+            "results": results,
+            "additional_scripts": self.postsai.extension_manager.list_extension_files("query.js")
+        }
+        print(json.dumps(result, default=convert_to_builtin_type))
@@ -0,0 +1,112 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import json
+import os
+import time
+
+from db import PostsaiDB
+from extension import ExtensionManager
+from query import Postsai, convert_to_builtin_type
+from resultcache import QueryResultCache
+
+
+class PostsaiBootstrap:
+    """Provides the configuration, the repositories and the scripts of extensions,
+       which the user interface needs on startup.
+
+       The response is stored in the result cache and only recomputed, if the
+       configuration, the extensions or the repositories table changed."""
+
+    def __init__(self, config):
+        """Creates a PostsaiBootstrap instance"""
+
+        self.config = config
+        self.cache = QueryResultCache(config)
+
+
+    def read_config_timestamp(self):
+        """returns the modification time of the configuration file"""
+
+        filename = self.config.get("__file__", "")
+        if filename.endswith(".pyc"):
+            filename = filename[:-1]
+        try:
+            return os.path.getmtime(filename)
+        except OSError:
+            return 0
+
+
+    def create_signature(self):
+        """returns a signature, which changes whenever the response has to be recomputed"""
+
+        return [self.read_config_timestamp(), ExtensionManager.read_signature(),
+                self.cache.read_repositories_generation()]
+
+
+    def create_result(self, read_permission_pattern):
+        """reads the repositories from the database and creates the response"""
+
+        db = PostsaiDB(self.config, read_only=True)
+        db.connect()
+        repositories = db.read_repositories(read_permission_pattern)
+        db.disconnect()
+
+        return {
+            "config" : self.config.get("ui", {}),
+            "repositories": repositories,
+            "additional_scripts": ExtensionManager(self.config).list_extension_files("query.js")
+        }
+
+
+    def get_result(self):
+        """returns the precomputed response, computing it if it is missing or outdated"""
+
+        read_permission_pattern = Postsai.get_configured_read_permission_pattern(self.config)
+        key = json.dumps(["bootstrap", read_permission_pattern])
+        signature = self.create_signature()
+
+        if self.cache.is_enabled():
+            entry = self.cache.read_entry(key)
+            if entry != None and entry["generation"] == signature:
+                return entry["result"]
+
+        result = self.create_result(read_permission_pattern)
+        if self.cache.is_enabled():
+            self.cache.write_entry({
+                "key": key,
+                "generation": signature,
+                "created": time.time(),
+                "result": result
+            })
+        return result
+
+
+    def process(self):
+        """processes a bootstrap request"""
+
+        result = self.get_result()
+
+        print("Content-Type: text/json; charset='utf-8'\r")
+        print("Cache-Control: max-age=60\r")
+        print("\r")
+        print(json.dumps(result, default=convert_to_builtin_type))
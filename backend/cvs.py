@@ -20,12 +20,13 @@
 # DEALINGS IN THE SOFTWARE.
 
 
-import cgi
 import json
 import sys
 import subprocess
+import time
 
 from db import PostsaiDB
+from metrics import Metrics
 
 
 def convert_to_builtin_type(obj):
@@ -47,7 +48,7 @@ class PostsaiCommitViewer:
     def read_commit(self, form):
         """reads a commmit from the database"""
 
-        db = PostsaiDB(self.config)
+        db = PostsaiDB(self.config, read_only=True)
         db.connect()
         sql = """SELECT repositories.repository, checkins.ci_when, people.who,
             trim(leading '/' from concat(concat(dirs.dir, '/'), files.file)),
@@ -95,33 +96,47 @@ class PostsaiCommitViewer:
         return ".".join(split)
 
 
+    @staticmethod
+    def create_diff_command(file):
+        """returns the command which creates the diff of a file, None for deleted files"""
+
+        if file[4] == "" or "." not in file[4]:
+            return None
+        return [
+            "cvs",
+            "-d",
+            file[8],
+            "rdiff",
+            "-u",
+            "-r",
+            PostsaiCommitViewer.calculate_previous_cvs_revision(file[4]),
+            "-r",
+            file[4],
+            file[3]]
+
+
     @staticmethod
     def dump_commit_diff(commit):
         """dumps the diff generates by invoking CVS to the browser"""
 
         for file in commit:
-            if file[4] == "" or "." not in file[4]:
+            command = PostsaiCommitViewer.create_diff_command(file)
+            if command == None:
                 sys.stdout.flush()
                 print("Index: " + file[3] + " deleted\r")
                 sys.stdout.flush()
             else:
-                subprocess.call([
-                    "cvs",
-                    "-d",
-                    file[8],
-                    "rdiff",
-                    "-u",
-                    "-r",
-                    PostsaiCommitViewer.calculate_previous_cvs_revision(file[4]),
-                    "-r",
-                    file[4],
-                    file[3]])
-
-
-    def process(self):
+                # the output is copied through sys.stdout, which is not a real file in server mode
+                process = subprocess.Popen(command, stdout=subprocess.PIPE)
+                for line in process.stdout:
+                    sys.stdout.write(line)
+                process.wait()
+                sys.stdout.flush()
+
+
+    def process(self, form):
         """Returns information about a commit"""
 
-        form = cgi.FieldStorage()
         commit = self.read_commit(form)
 
         print("Content-Type: text/plain; charset='utf-8'\r")
@@ -133,4 +148,6 @@ class PostsaiCommitViewer:
 
         print("#" + json.dumps(PostsaiCommitViewer.format_commit_header(commit), default=convert_to_builtin_type))
         sys.stdout.flush()
+        start = time.time()
         PostsaiCommitViewer.dump_commit_diff(commit)
+        Metrics.observe("postsai_commit_diff_seconds", time.time() - start)
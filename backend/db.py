@@ -20,11 +20,30 @@
 # DEALINGS IN THE SOFTWARE.
 
 
-import MySQLdb as mdb
 import datetime
-from os import environ
+import random
+import signal
+import threading
+import time
 
 from cache import Cache
+from lookuptable import SharedLookupTable
+from metrics import Metrics
+
+
+# the driver is imported on the first connection, so that responses from the cache do not load it
+mdb = None
+
+
+def load_driver():
+    """imports the MySQL driver, if that did not happen yet"""
+
+    global mdb
+    if mdb == None:
+        import MySQLdb
+        import MySQLdb.cursors
+        mdb = MySQLdb
+    return mdb
 
 
 class PostsaiDB:
@@ -41,30 +60,166 @@ class PostsaiDB:
     }
 
 
-    def __init__(self, config):
-        """Creates a Postsai api instance"""
+    def __init__(self, config, read_only=False):
+        """Creates a Postsai api instance, read only instances may connect to a replica"""
 
         self.config = config
+        self.read_only = read_only
+        self.created_repository = False
+        self.lookup_table = None
+        self.looked_up = []
 
+        # connection parameters of the replica, None for the primary
+        self.server = None
+        self.replica_lag = 0
 
-    def connect(self):
-        """connects to the database"""
-
-        self.conn = mdb.connect(
-            host    = self.config["db"]["host"],
-            user    = self.config["db"]["user"],
-            passwd  = self.config["db"]["password"],
-            db      = self.config["db"]["database"],
-            port    = self.config["db"].get("port", 3306),
+
+    # MySQL error codes of interrupted queries
+    ER_QUERY_INTERRUPTED = 1317
+    ER_QUERY_TIMEOUT = 3024
+
+
+    def get_replica_config(self, replica):
+        """returns the connection parameters of a replica, which default to those of the primary"""
+
+        server = dict(self.config["db"])
+        server["connect_timeout"] = 2
+        server.update(replica)
+        return server
+
+
+    def open_connection(self):
+        """opens a new connection to the database"""
+
+        server = self.server or self.config["db"]
+        options = {}
+        if "connect_timeout" in server:
+            options["connect_timeout"] = server["connect_timeout"]
+        return load_driver().connect(
+            host    = server["host"],
+            user    = server["user"],
+            passwd  = server["password"],
+            db      = server["database"],
+            port    = server.get("port", 3306),
             use_unicode = True,
-            charset = "utf8")
+            charset = "utf8",
+            **options)
+
+
+    # set by long-lived servers to reuse connections, replica_pools is in the order of the replicas
+    pool = None
+    replica_pools = []
+
+    # replicas which are skipped until the specified time, shared by all threads of long-lived servers
+    unhealthy_replicas = {}
+
+    # the statements of a profiled request are recorded in its thread and its helper threads
+    recorded = threading.local()
+    recorded_lock = threading.Lock()
+
+
+    @staticmethod
+    def release_thread():
+        """returns the connections, which the current thread did not release, into the pools"""
+
+        for pool in [PostsaiDB.pool] + PostsaiDB.replica_pools:
+            if pool != None:
+                pool.release_thread()
+
+
+    def open_session(self):
+        """opens a new connection and applies the session settings"""
+
+        conn = self.open_connection()
+        cursor = conn.cursor()
+        cursor.execute("SET SESSION innodb_lock_wait_timeout = 500, group_concat_max_len = 16777216")
+        cursor.close()
+        return conn
+
+
+    def detect_viewvc_database(self):
+        """checks whether this is a ViewVC database instead of a Bonsai database"""
 
-        # checks whether this is a ViewVC database instead of a Bonsai database
         cursor = self.conn.cursor()
         cursor.execute("show tables like 'commits'")
-        self.is_viewvc_database = (cursor.rowcount == 1)
-        cursor.execute("SET SESSION innodb_lock_wait_timeout = 500")
+        result = (cursor.rowcount == 1)
         cursor.close()
+        return result
+
+
+    def attach(self, pool):
+        """takes a connection from the pool or opens a new one, if there is no pool"""
+
+        self.connection_pool = pool
+        if pool != None:
+            self.conn = pool.acquire()
+            if pool.is_viewvc_database == None:
+                pool.is_viewvc_database = self.detect_viewvc_database()
+            self.is_viewvc_database = pool.is_viewvc_database
+        else:
+            self.conn = self.open_session()
+            self.is_viewvc_database = self.detect_viewvc_database()
+
+
+    def release(self):
+        """returns the connection into its pool or closes it"""
+
+        if self.connection_pool != None:
+            self.connection_pool.release(self.conn)
+        else:
+            self.conn.close()
+
+
+    def read_replica_lag(self):
+        """returns the replication delay in seconds or None, if replication is not running"""
+
+        cursor = self.conn.cursor(mdb.cursors.DictCursor)
+        cursor.execute("SHOW SLAVE STATUS")
+        row = cursor.fetchone()
+        cursor.close()
+        if row == None:
+            return None
+        return row.get("Seconds_Behind_Master", row.get("Seconds_Behind_Source"))
+
+
+    def connect_to_replica(self):
+        """connects to a random healthy replica, returns False if none is available"""
+
+        db_config = self.config.get("db", {})
+        replicas = db_config.get("replicas", [])
+        candidates = [i for i in range(len(replicas)) if self.unhealthy_replicas.get(i, 0) <= time.time()]
+        random.shuffle(candidates)
+
+        for i in candidates:
+            self.server = self.get_replica_config(replicas[i])
+            self.conn = None
+            pool = None
+            if len(self.replica_pools) > i:
+                pool = self.replica_pools[i]
+            try:
+                self.attach(pool)
+                lag = self.read_replica_lag()
+                if lag != None and lag <= db_config.get("max_replica_lag", 30):
+                    self.replica_lag = lag
+                    return True
+                self.release()
+            except Exception:
+                # unreachable, broken or missing permission for SHOW SLAVE STATUS
+                if pool != None and self.conn != None:
+                    pool.discard(self.conn)
+                elif self.conn != None:
+                    ConnectionPool.close_quietly(self.conn)
+            PostsaiDB.unhealthy_replicas[i] = time.time() + db_config.get("replica_retry_after", 30)
+
+        self.server = None
+        return False
+
+
+    def connect(self):
+        """connects to the database, read only instances prefer a healthy replica"""
+
+        if not self.read_only or not self.connect_to_replica():
+            self.attach(self.pool)
         self.conn.begin()
 
 
@@ -72,7 +227,7 @@ class PostsaiDB:
         """commits transactions and closes database connection"""
 
         self.conn.commit()
-        self.conn.close()
+        self.release()
 
 
     def rewrite_sql(self, sql):
@@ -86,13 +241,103 @@ class PostsaiDB:
     def query(self, sql, data, cursor_type=None):
         """queries the database"""
 
+        start = time.time()
         cursor = self.conn.cursor(cursor_type)
         cursor.execute(self.rewrite_sql(sql), data)
         rows = cursor.fetchall()
         cursor.close()
+        Metrics.observe("postsai_db_query_seconds", time.time() - start)
+        self.record_statement(sql, data, time.time() - start)
         return rows
 
 
+    @staticmethod
+    def record_statement(sql, data, duration):
+        """adds a statement to the profile of the current request, if it is profiled"""
+
+        statements = getattr(PostsaiDB.recorded, "statements", None)
+        if statements != None:
+            with PostsaiDB.recorded_lock:
+                statements.append((sql, data, duration))
+
+
+    @staticmethod
+    def record_in_thread(target):
+        """returns the target of a helper thread, which records its statements for the request of the calling thread"""
+
+        statements = getattr(PostsaiDB.recorded, "statements", None)
+        if statements == None:
+            return target
+
+        def run(*args):
+            PostsaiDB.recorded.statements = statements
+            try:
+                target(*args)
+            finally:
+                PostsaiDB.recorded.statements = None
+        return run
+
+
+    def kill_query(self):
+        """cancels the query, which is currently running on this connection"""
+
+        conn = self.open_connection()
+        cursor = conn.cursor()
+        cursor.execute("KILL QUERY %s", [self.conn.thread_id()])
+        cursor.close()
+        conn.close()
+
+
+    def query_with_timeout(self, sql, data, timeout):
+        """queries the database and cancels the query, if it exceeds the timeout
+           or if the request is aborted. Returns the rows and whether the query was cancelled."""
+
+        result = {}
+        def run_query():
+            try:
+                result["rows"] = self.query(sql, data)
+            except Exception as err:
+                # raised in the calling thread
+                result["error"] = err
+
+        thread = threading.Thread(target=self.record_in_thread(run_query))
+        thread.daemon = True
+        thread.start()
+
+        # the web server sends SIGTERM, if the client has gone away
+        cancelled = []
+        handler_installed = False
+        try:
+            previous_handler = signal.signal(signal.SIGTERM, lambda signum, frame: cancelled.append(signum))
+            handler_installed = True
+        except ValueError:
+            # signal handlers can only be installed in the main thread
+            pass
+
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
+
+        killed = False
+        while thread.is_alive():
+            thread.join(0.05)
+            if thread.is_alive() and (len(cancelled) > 0 or (deadline != None and time.time() > deadline)):
+                self.kill_query()
+                killed = True
+                thread.join()
+
+        if handler_installed:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+        if "error" in result:
+            err = result["error"]
+            if killed or (isinstance(err, load_driver().OperationalError)
+                          and err.args[0] in (self.ER_QUERY_INTERRUPTED, self.ER_QUERY_TIMEOUT)):
+                return [], True
+            raise err
+        return result["rows"], False
+
+
     def query_as_double_map(self, sql, key, data=None):
         """queries the database and returns a dict"""
 
@@ -103,6 +348,15 @@ class PostsaiDB:
         return res
 
 
+    def read_repositories(self, read_permission_pattern):
+        """reads the configuration of all repositories which may be read"""
+
+        return self.query_as_double_map(
+            "SELECT id, repository, base_url, file_url, commit_url, tracker_url, icon_url FROM repositories WHERE repositories.repository REGEXP %s",
+            "repository",
+            [read_permission_pattern])
+
+
     @staticmethod
     def guess_repository_urls(row):
         """guesses the repository urls"""
@@ -186,19 +440,34 @@ class PostsaiDB:
         """fills the id-cache"""
 
         if self.cache.has(column, value):
+            Metrics.increment("postsai_lookups_total", 1, {"source": "process"})
             return
 
+        if self.lookup_table != None:
+            id = self.lookup_table.get(column, value)
+            if id != None:
+                self.cache.put(column, value, id)
+                Metrics.increment("postsai_lookups_total", 1, {"source": "shared"})
+                return
+
+        Metrics.increment("postsai_lookups_total", 1, {"source": "database"})
+
         data, extra_column, extra_data = self.extra_data_for_key_tables(cursor, column, row, value)
 
         sql = "SELECT id FROM " + self.column_table_mapping[column] + " WHERE " + column + " = %s"
         cursor.execute(sql, [value])
         rows = cursor.fetchall()
+        Metrics.increment("postsai_db_import_statements_total")
         if len(rows) > 0:
             self.cache.put(column, value, rows[0][0])
         else:
             sql = "INSERT INTO " + self.column_table_mapping[column] + " (" + column + extra_column + ") VALUE (%s" + extra_data + ")"
             cursor.execute(sql, data)
+            Metrics.increment("postsai_db_import_statements_total")
             self.cache.put(column, value, cursor.lastrowid)
+            if column == "repository":
+                self.created_repository = True
+        self.looked_up.append((column, value))
 
 
     def import_data(self, head, rows):
@@ -206,11 +475,39 @@ class PostsaiDB:
 
         self.connect()
         self.cache = Cache()
-        cursor = self.conn.cursor()
+        self.lookup_table = SharedLookupTable.open(self.config)
+        self.looked_up = []
+        cursor = RecordingCursor(self.conn.cursor())
+
+        # InnoDB assigns auto increment ids on insert, not on commit. Imports are committed one after
+        # another, so that no checkin with an id below the last_id of a query becomes visible later.
+        cursor.execute("SELECT GET_LOCK('postsai_import', %s)", [self.config.get("db", {}).get("import_lock_timeout", 60)])
+        if cursor.fetchall()[0][0] != 1:
+            raise RuntimeError("Timeout waiting for other imports")
+        try:
+            self.insert_checkins(cursor, head, rows)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('postsai_import')", [])
+            cursor.fetchall()
+        cursor.close()
+        self.disconnect()
+
+        # inserted ids are shared after the commit, because a rollback would make them invalid
+        if self.lookup_table != None:
+            for (column, value) in self.looked_up:
+                self.lookup_table.put(column, value, self.cache.get(column, value))
+
+
+    def insert_checkins(self, cursor, head, rows):
+        """inserts the import action and the checkins of an import"""
 
         sql = """INSERT INTO importactions (remote_addr, remote_user, sender_addr, sender_user, ia_when) VALUES (%s, %s, %s, %s, %s)"""
         cursor.execute(sql, [
-            environ.get("REMOTE_ADDR", ""), environ.get("REMOTE_USER", ""),
+            head.get("remote_addr", ""), head.get("remote_user", ""),
             head["sender_addr"],head["sender_user"],
             datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
         ])
@@ -239,6 +536,215 @@ class PostsaiDB:
                 self.cache.get("hash", row["commitid"]),
                 str(importactionid)
                 ])
+            # subscribers of the feed order commits like the database
+            row["branchid"] = self.cache.get("branch", row["branch"])
+            row["descid"] = self.cache.get("description", row["description"])
+        Metrics.increment("postsai_db_import_statements_total", len(rows))
+
+        self.update_latest_activity(cursor, rows)
+
 
+    def update_latest_activity(self, cursor, rows):
+        """remembers the newest commit of every repository and branch"""
+
+        latest = {}
+        for row in rows:
+            key = (row["repository"], row["branch"])
+            if not key in latest or row["ci_when"] >= latest[key]["ci_when"]:
+                latest[key] = row
+
+        # ci_when is updated last, because MySQL evaluates the assignments from left to right
+        sql = """INSERT INTO latestactivity (repositoryid, branchid, whoid, descid, commitid, ci_when)
+            VALUE (%s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+            whoid = IF(VALUES(ci_when) >= ci_when, VALUES(whoid), whoid),
+            descid = IF(VALUES(ci_when) >= ci_when, VALUES(descid), descid),
+            commitid = IF(VALUES(ci_when) >= ci_when, VALUES(commitid), commitid),
+            ci_when = GREATEST(VALUES(ci_when), ci_when)"""
+        for row in latest.values():
+            cursor.execute(sql, [
+                self.cache.get("repository", row["repository"]),
+                self.cache.get("branch", row["branch"]),
+                self.cache.get("who", row["who"]),
+                self.cache.get("description", row["description"]),
+                self.cache.get("hash", row["commitid"]),
+                row["ci_when"]
+            ])
+        Metrics.increment("postsai_db_import_statements_total", len(latest))
+
+
+    def import_tag(self, repository, tag, hash):
+        """Imports a tag of a known repository, hash is None for deleted tags"""
+
+        self.connect()
+        cursor = RecordingCursor(self.conn.cursor())
+        cursor.execute("SELECT id FROM repositories WHERE repository = %s", [repository])
+        rows = cursor.fetchall()
+        if len(rows) > 0:
+            if hash == None:
+                sql = "DELETE FROM committags WHERE repositoryid = %s AND tag = %s"
+                cursor.execute(sql, [rows[0][0], tag])
+            else:
+                sql = """INSERT INTO committags (repositoryid, tag, hash) VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE hash = VALUES(hash)"""
+                cursor.execute(sql, [rows[0][0], tag, hash])
         cursor.close()
         self.disconnect()
+
+
+
+class RecordingCursor:
+    """Adds the statements of the importer to the profile of the request like the ones of queries"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+
+    def execute(self, sql, data):
+        """executes and records a statement"""
+
+        start = time.time()
+        result = self.cursor.execute(sql, data)
+        PostsaiDB.record_statement(sql, data, time.time() - start)
+        return result
+
+
+    def __getattr__(self, name):
+        """delegates everything else to the cursor"""
+
+        return getattr(self.cursor, name)
+
+
+
+class PoolTimeout(Exception):
+    """Raised if no connection became available in time"""
+    pass
+
+
+
+class ConnectionPool:
+    """Keeps database connections open between the requests of long-lived servers.
+
+       Idle connections are checked before they are handed out and closed after
+       max_idle seconds. At most max_size connections are open at the same time,
+       further requests wait up to timeout seconds for a free one."""
+
+    def __init__(self, config, open_connection):
+        """Creates an empty ConnectionPool, which uses open_connection to connect"""
+
+        pool_config = config.get("db", {}).get("pool", {})
+        self.max_size = pool_config.get("max_size", 10)
+        self.max_idle = pool_config.get("max_idle", 300)
+        self.timeout = pool_config.get("timeout", 10)
+        self.open_connection = open_connection
+        self.condition = threading.Condition()
+        self.idle = []
+        self.owners = {}
+        self.size = 0
+
+        # the schema is the same for all connections, so it is detected only once
+        self.is_viewvc_database = None
+
+
+    def checkout(self, deadline):
+        """takes an idle connection or reserves space for a new one, which is indicated by None"""
+
+        with self.condition:
+            while True:
+                while len(self.idle) > 0:
+                    # the most recently used connection is the least likely to have timed out
+                    (conn, released) = self.idle.pop()
+                    if time.time() - released <= self.max_idle:
+                        return conn
+                    self.size = self.size - 1
+                    self.close_quietly(conn)
+
+                if self.size < self.max_size:
+                    self.size = self.size + 1
+                    return None
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout("No database connection available")
+                self.condition.wait(remaining)
+
+
+    @staticmethod
+    def is_usable(conn):
+        """checks whether the connection is still alive and discards leftovers of failed requests"""
+
+        try:
+            conn.ping()
+            conn.rollback()
+            return True
+        except mdb.Error:
+            return False
+
+
+    @staticmethod
+    def close_quietly(conn):
+        """closes a connection, which might be broken already"""
+
+        try:
+            conn.close()
+        except mdb.Error:
+            pass
+
+
+    def discard(self, conn):
+        """closes a connection and frees its space in the pool"""
+
+        if conn != None:
+            self.close_quietly(conn)
+        with self.condition:
+            self.owners.pop(id(conn), None)
+            self.size = self.size - 1
+            self.condition.notify()
+
+
+    def acquire(self):
+        """returns a healthy connection"""
+
+        deadline = time.time() + self.timeout
+        while True:
+            conn = self.checkout(deadline)
+            if conn == None:
+                try:
+                    conn = self.open_connection()
+                except Exception:
+                    self.discard(None)
+                    raise
+                break
+            if self.is_usable(conn):
+                break
+            self.discard(conn)
+
+        with self.condition:
+            self.owners[id(conn)] = (conn, threading.current_thread().ident)
+        return conn
+
+
+    def release(self, conn):
+        """returns a connection into the pool"""
+
+        with self.condition:
+            self.owners.pop(id(conn), None)
+            self.idle.append((conn, time.time()))
+            self.condition.notify()
+
+
+    def release_thread(self):
+        """returns the connections, which the current thread did not release because of an error"""
+
+        ident = threading.current_thread().ident
+        with self.condition:
+            leaked = [conn for (conn, owner) in self.owners.values() if owner == ident]
+        for conn in leaked:
+            try:
+                conn.rollback()
+            except mdb.Error:
+                with self.condition:
+                    self.owners.pop(id(conn), None)
+                self.discard(conn)
+                continue
+            self.release(conn)
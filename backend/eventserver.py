@@ -0,0 +1,449 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import asynchat
+import asyncore
+import cgi
+import json
+import os
+import Queue
+import socket
+import StringIO
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import urlparse
+
+from cvs import PostsaiCommitViewer
+from db import PostsaiDB
+from feed import PostsaiFeed
+from query import Postsai, convert_to_builtin_type
+from server import PostsaiApplication, ResponseWriter
+
+
+class Waker(asyncore.file_dispatcher):
+    """Runs functions, which are passed from other threads, in the event loop"""
+
+    def __init__(self, map):
+        (read_fd, self.write_fd) = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map)
+        self.lock = threading.Lock()
+        self.calls = []
+
+
+    def call_soon(self, function):
+        """schedules the function, may be called from any thread"""
+
+        with self.lock:
+            self.calls.append(function)
+        os.write(self.write_fd, "x")
+
+
+    def handle_read(self):
+        self.recv(4096)
+        with self.lock:
+            calls = self.calls
+            self.calls = []
+        for function in calls:
+            try:
+                function()
+            except Exception:
+                # the waker has to survive errors of single requests
+                traceback.print_exc(file=sys.stderr)
+
+
+    def writable(self):
+        return False
+
+
+
+class ChannelQueue:
+    """Passes the output of a request thread to its connection in the event loop"""
+
+    def __init__(self, waker, channel):
+        self.waker = waker
+        self.channel = channel
+
+
+    def put(self, chunk):
+        self.waker.call_soon(lambda: self.channel.send_output(chunk))
+
+
+
+class HttpChannel(asynchat.async_chat):
+    """A client connection, which reads one request and is closed after the response"""
+
+    def __init__(self, server, sock, addr):
+        asynchat.async_chat.__init__(self, sock, server.map)
+        self.server = server
+        self.addr = addr
+        self.incoming = []
+        self.environ = None
+        self.writer = None
+        self.pending = ""
+        self.header_sent = False
+        self.set_terminator("\r\n\r\n")
+
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+
+    def found_terminator(self):
+        data = "".join(self.incoming)
+        self.incoming = []
+        if self.environ == None:
+            self.environ = self.server.create_environ(data, self.addr)
+            length = self.environ.get("CONTENT_LENGTH", "")
+            if length.isdigit() and int(length) > 0:
+                self.set_terminator(int(length))
+                return
+            data = ""
+        self.set_terminator(None)
+        self.server.handle_request(self, self.environ, data)
+
+
+    def start_response(self, status, headers):
+        """sends the status line and the headers"""
+
+        lines = ["HTTP/1.0 " + status]
+        for (name, value) in headers:
+            lines.append(name + ": " + value)
+        lines.append("Connection: close")
+        self.push("\r\n".join(lines) + "\r\n\r\n")
+        self.header_sent = True
+
+
+    def send_output(self, chunk):
+        """sends output of a request in CGI format, None or an exception mark the end"""
+
+        if not self.connected:
+            return
+        if chunk == None or isinstance(chunk, Exception):
+            if not self.header_sent:
+                self.start_response("500 Internal Server Error", [("Content-Type", "text/plain")])
+                self.push("Internal Server Error")
+            self.close_when_done()
+            return
+
+        if self.header_sent:
+            self.push(chunk)
+            return
+
+        # the CGI output starts with the headers
+        self.pending = self.pending + chunk
+        if self.pending.find("\r\n\r\n") >= 0:
+            (header, output) = self.pending.split("\r\n\r\n", 1)
+            self.pending = ""
+            self.start_response(*PostsaiApplication.parse_headers(header))
+            if output != "":
+                self.push(output)
+
+
+    def handle_close(self):
+        # stops the request thread on its next output
+        if self.writer != None:
+            self.writer.closed = True
+        self.server.hub.unsubscribe(self)
+        self.close()
+
+
+
+class DiffStream(asyncore.file_dispatcher):
+    """Copies the output of cvs subprocesses to a connection without blocking the event loop"""
+
+    def __init__(self, channel, commit):
+        self.channel = channel
+        self.files = list(commit)
+        self.process = None
+        self.next_file()
+
+
+    def next_file(self):
+        """starts the diff of the next file"""
+
+        while len(self.files) > 0:
+            file = self.files.pop(0)
+            command = PostsaiCommitViewer.create_diff_command(file)
+            if command == None:
+                self.channel.push("Index: " + file[3] + " deleted\r\n")
+                continue
+            self.process = subprocess.Popen(command, stdout=subprocess.PIPE)
+            asyncore.file_dispatcher.__init__(self, self.process.stdout.fileno(), self.channel.server.map)
+            return
+        self.channel.close_when_done()
+
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not self.channel.connected:
+            # the client has disconnected
+            self.process.kill()
+        elif data != "":
+            self.channel.push(data)
+
+
+    def handle_close(self):
+        self.close()
+        self.process.stdout.close()
+        self.process.wait()
+        if self.channel.connected:
+            self.next_file()
+        else:
+            self.process = None
+
+
+    def writable(self):
+        return False
+
+
+
+class FeedHub:
+    """Sends newly imported commits to all subscribers of the feed from the event loop.
+
+       The feed file is read once per poll interval for all subscribers, so an
+       idle subscriber costs a connection, but no thread."""
+
+    def __init__(self, config):
+        self.config = config
+        self.feed = PostsaiFeed(config)
+        self.feed_config = config.get("feed", {})
+        self.postsai = Postsai(config)
+        self.subscribers = {}
+        self.position = None
+        if self.feed.is_enabled():
+            self.position = self.feed.find_start_offset("")
+        self.next_poll = 0
+
+
+    def subscribe(self, channel, form, environ):
+        """starts the event stream of a client"""
+
+        if not self.feed.is_enabled():
+            channel.start_response("404 Not Found", [("Content-Type", "text/plain; charset='utf-8'")])
+            channel.push("Feed is not configured")
+            channel.close_when_done()
+            return
+
+        result = self.postsai.validate_input(form)
+        if result != "":
+            channel.start_response("403 Forbidden", [("Content-Type", "text/plain; charset='utf-8'")])
+            channel.push(result)
+            channel.close_when_done()
+            return
+
+        channel.start_response("200 OK", [("Content-Type", "text/event-stream; charset='utf-8'"),
+                                          ("Cache-Control", "no-cache")])
+        channel.push("retry: " + str(self.feed_config.get("retry", 3000)) + "\n\n")
+        now = time.time()
+        self.subscribers[channel] = {
+            "form": form,
+            "read_permission_pattern": Postsai.get_configured_read_permission_pattern(self.config, environ),
+            "position": self.feed.find_start_offset(environ.get("HTTP_LAST_EVENT_ID", "")),
+            "start": now,
+            "last_output": now
+        }
+
+
+    def unsubscribe(self, channel):
+        """removes a client, which has disconnected"""
+
+        self.subscribers.pop(channel, None)
+
+
+    def poll(self):
+        """sends new commits and heartbeats, if the poll interval has passed"""
+
+        now = time.time()
+        if now < self.next_poll:
+            return
+        self.next_poll = now + self.feed_config.get("poll_interval", 1)
+
+        shared_position = self.position
+        self.position, shared_rows = self.feed.read_new_rows(self.position)
+        for channel, subscriber in self.subscribers.items():
+            if now - subscriber["start"] > self.feed_config.get("max_duration", 600):
+                self.unsubscribe(channel)
+                channel.close_when_done()
+                continue
+
+            try:
+                self.poll_subscriber(channel, subscriber, now, shared_position, shared_rows)
+            except Exception:
+                # a broken subscriber must not stop the event loop
+                traceback.print_exc(file=sys.stderr)
+                self.unsubscribe(channel)
+                channel.close_when_done()
+
+
+    def poll_subscriber(self, channel, subscriber, now, shared_position, shared_rows):
+        """sends new commits and heartbeats to a single subscriber"""
+
+        # resuming clients read from their own position
+        if subscriber["position"] == shared_position:
+            subscriber["position"], rows = self.position, shared_rows
+        else:
+            subscriber["position"], rows = self.feed.read_new_rows(subscriber["position"])
+
+        commits = self.feed.extract_matching_commits(subscriber["form"], subscriber["read_permission_pattern"], rows)
+        if len(commits) > 0:
+            channel.push(self.feed.format_event(subscriber["position"], commits))
+            subscriber["last_output"] = now
+        elif now - subscriber["last_output"] > self.feed_config.get("heartbeat_interval", 15):
+            channel.push(self.feed.format_event(subscriber["position"], None))
+            subscriber["last_output"] = now
+
+
+
+class PostsaiEventServer(asyncore.dispatcher):
+    """An event driven HTTP server for long-lived processes.
+
+       Connections are handled by a single event loop. Blocking work like
+       database queries is done by a fixed number of worker threads, so the
+       number of database connections is bounded. Feed subscribers and cvs
+       subprocesses are served by the event loop, without a thread of their own."""
+
+    def __init__(self, config, dispatch, host, port):
+        """Creates a PostsaiEventServer, which listens on the specified port"""
+
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.config = config
+        self.application = PostsaiApplication(config, dispatch)
+        self.waker = Waker(self.map)
+        self.hub = FeedHub(config)
+        self.tasks = Queue.Queue()
+        for i in range(config.get("server", {}).get("workers", 8)):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(1024)
+
+
+    def work(self):
+        """executes tasks of the worker queue"""
+
+        while True:
+            task = self.tasks.get()
+            try:
+                task()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                PostsaiDB.release_thread()
+
+
+    @staticmethod
+    def create_environ(header, addr):
+        """parses the request line and the headers into a CGI environment"""
+
+        lines = header.split("\r\n")
+        (method, path, version) = lines[0].split(" ", 2)
+        url = urlparse.urlsplit(path)
+        environ = {
+            "REQUEST_METHOD": method,
+            "PATH_INFO": url.path,
+            "QUERY_STRING": url.query,
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": addr[0]
+        }
+        for line in lines[1:]:
+            if line.find(":") < 0:
+                continue
+            (name, value) = line.split(":", 1)
+            name = name.strip().upper().replace("-", "_")
+            if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+                environ[name] = value.strip()
+            else:
+                environ["HTTP_" + name] = value.strip()
+        return environ
+
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair != None:
+            HttpChannel(self, pair[0], pair[1])
+
+
+    def handle_request(self, channel, environ, body):
+        """processes a request, which has been read completely"""
+
+        method = ""
+        if environ["REQUEST_METHOD"] == "GET":
+            form = cgi.FieldStorage(fp=StringIO.StringIO(""), environ=environ)
+            method = form.getfirst("method", "")
+
+        if method == "feed":
+            self.hub.subscribe(channel, form, environ)
+        elif method == "commit":
+            self.tasks.put(lambda: self.read_commit(channel, form))
+        else:
+            channel.writer = ResponseWriter()
+            channel.writer.chunks = ChannelQueue(self.waker, channel)
+            self.tasks.put(lambda: self.application.process(environ, StringIO.StringIO(body), channel.writer))
+
+
+    def read_commit(self, channel, form):
+        """reads a commit from the database in a worker thread, the diff is created in the event loop"""
+
+        try:
+            commit = PostsaiCommitViewer(self.config).read_commit(form)
+        except Exception as err:
+            self.waker.call_soon(lambda: channel.send_output(err))
+            return
+        self.waker.call_soon(lambda: self.send_commit(channel, form, commit))
+
+
+    @staticmethod
+    def send_commit(channel, form, commit):
+        """sends the commit header and starts the diff"""
+
+        if not channel.connected:
+            return
+        if len(commit) == 0:
+            channel.start_response("404 Not Found", [("Content-Type", "text/plain; charset='utf-8'")])
+            channel.push("Commit not found")
+            channel.close_when_done()
+            return
+        headers = [("Content-Type", "text/plain; charset='utf-8'"), ("Cache-Control", "max-age=60")]
+        if form.getfirst("download", "false") == "true":
+            headers.append(("Content-Disposition", "attachment; filename=\"patch.txt\""))
+        channel.start_response("200 OK", headers)
+        channel.push("#" + json.dumps(PostsaiCommitViewer.format_commit_header(commit), default=convert_to_builtin_type) + "\n")
+        DiffStream(channel, commit)
+
+
+    def serve_forever(self):
+        """runs the event loop"""
+
+        while True:
+            asyncore.loop(timeout=0.5, map=self.map, count=1)
+            try:
+                self.hub.poll()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
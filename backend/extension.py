@@ -19,41 +19,169 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
 # DEALINGS IN THE SOFTWARE.
 
+import json
 import os
+import sys
+import time
+
+from metrics import Metrics
+from resultcache import QueryResultCache
 
 class ExtensionManager:
-    """Manages extensions"""
+    """Manages extensions
+
+       Extensions are imported when one of their methods is invoked for the first time.
+       The methods and files of every extension are listed in a manifest, which is stored in
+       the result cache folder, so that a request only imports the extensions it needs."""
+
+    extensions_folder = "extensions"
+
+    # long-lived servers load the extensions only once
+    keep_loaded = False
+    loaded = None
+
+
+    def __init__(self, config=None):
+        """reads the manifest of the extensions"""
+
+        self.config = config or {}
+        if ExtensionManager.loaded != None:
+            (self.manifest, self.extensions, self.hooks) = ExtensionManager.loaded
+            return
+
+        self.extensions = {}
+        self.hooks = {}
+        self.manifest = self.read_manifest(config)
+
+        if ExtensionManager.keep_loaded:
+            # import everything up front, so that all threads share the same dispatch table
+            for entry in self.manifest["extensions"]:
+                for method in entry["methods"]:
+                    self.get_hooks(method)
+            ExtensionManager.loaded = (self.manifest, self.extensions, self.hooks)
+
+
+    @staticmethod
+    def read_signature():
+        """returns the modification times of the extension folders and their __init__.py files.
+
+           They change when extensions or files are added, removed or renamed and when
+           __init__.py is modified. This is cheap enough to be checked on every request,
+           so changes to other files of an extension require a touch of its folder."""
+
+        folder = ExtensionManager.extensions_folder
+        signature = [["", os.path.getmtime(folder)]]
+        for name in sorted(os.listdir(folder)):
+            init = folder + "/" + name + "/__init__.py"
+            signature.append([name, os.path.getmtime(folder + "/" + name),
+                              os.path.getmtime(init) if os.path.isfile(init) else None])
+        return signature
+
+
+    def create_manifest(self, signature):
+        """imports all extensions to find out which methods they implement"""
+
+        entries = []
+        for name in sorted(os.listdir(self.extensions_folder)):
+            folder = self.extensions_folder + "/" + name
+            if not os.path.isdir(folder):
+                continue
+            methods = []
+            if os.path.isfile(folder + "/__init__.py"):
+                extension = self.get_extension(name)
+                methods = [method for method in dir(extension)
+                           if not method.startswith("_") and callable(getattr(extension, method))]
+            entries.append({"name": name, "methods": methods, "files": sorted(os.listdir(folder))})
+        return {"signature": signature, "extensions": entries}
+
+
+    def read_manifest(self, config):
+        """returns the stored manifest, creating a new one if it is missing or outdated"""
+
+        signature = self.read_signature()
+        cache = QueryResultCache(config or {})
+        filename = cache.folder + "/extensions.json"
 
-    def __init__(self):
-        """loads extensions"""
+        if cache.is_enabled():
+            try:
+                with open(filename, "r") as f:
+                    manifest = json.load(f)
+                if manifest["signature"] == signature:
+                    return manifest
+            except (IOError, ValueError, KeyError):
+                pass
 
-        self.extensions = []
+        manifest = self.create_manifest(signature)
+        if cache.is_enabled():
+            cache.create_folder()
+            temp_filename = filename + "." + str(os.getpid())
+            with open(temp_filename, "w") as f:
+                json.dump(manifest, f)
+            os.rename(temp_filename, filename)
+        return manifest
 
-        extensions_folder = "extensions"
-        for extension_folder in os.listdir(extensions_folder):
-            if os.path.isfile(extensions_folder + "/" + extension_folder + "/__init__.py"):
-                mod = __import__("extensions." + extension_folder, fromlist=["Extension"])
-                self.extensions.append(getattr(mod, "Extension")())
+
+    def get_extension(self, name):
+        """returns the instance of an extension, importing it on first use"""
+
+        extension = self.extensions.get(name)
+        if extension == None:
+            mod = __import__(self.extensions_folder + "." + name, fromlist=["Extension"])
+            extension = getattr(mod, "Extension")()
+            self.extensions[name] = extension
+        return extension
+
+
+    def find_extensions(self, method):
+        """returns the names of all extensions which implement the method"""
+
+        return [entry["name"] for entry in self.manifest["extensions"] if method in entry["methods"]]
+
+
+    def get_hooks(self, method):
+        """returns the entry of the dispatch table for a method, a list of (extension name, bound method) tuples"""
+
+        hooks = self.hooks.get(method)
+        if hooks == None:
+            hooks = [(name, getattr(self.get_extension(name), method)) for name in self.find_extensions(method)]
+            self.hooks[method] = hooks
+        return hooks
+
+
+    def record_timing(self, name, method, seconds):
+        """counts a call of an extension method and logs it, if it was slow"""
+
+        key = name + "." + method
+        Metrics.increment("postsai_extension_calls_total", 1, {"method": key})
+        Metrics.increment("postsai_extension_seconds_total", seconds, {"method": key})
+
+        if seconds * 1000 >= self.config.get("extensions", {}).get("slow_hook_ms", 1000):
+            # ends up in the error log of the web server
+            sys.stderr.write("postsai: extension method " + key + " took " + str(int(seconds * 1000)) + " ms\n")
 
 
     def call_all(self, method, params):
         """invokes a method on all extensions"""
 
-        for extension in self.extensions:
-            method_pointer = getattr(extension, method, None)
-            if method_pointer != None:
+        for (name, method_pointer) in self.get_hooks(method):
+            start = time.time()
+            try:
                 method_pointer(*params)
+            finally:
+                self.record_timing(name, method, time.time() - start)
 
-    @staticmethod
-    def list_extension_files(filename):
-        """returns a list of all files with the specified name that exist in extensions"""
 
-        res = []
-        extensions_folder = "extensions"
+    def has_method(self, method):
+        """checks whether at least one extension implements the method"""
 
-        for extension_folder in os.listdir(extensions_folder):
-            possible_filename = extensions_folder + "/" + extension_folder + "/" + filename
-            if os.path.isfile(possible_filename):
-                res.append(possible_filename)
+        return len(self.find_extensions(method)) > 0
 
-        return res
\ No newline at end of file
+
+    def list_extension_files(self, filename):
+        """returns a list of all files with the specified name that exist in extensions"""
+
+        res = []
+        for entry in self.manifest["extensions"]:
+            if filename in entry["files"]:
+                res.append(self.extensions_folder + "/" + entry["name"] + "/" + filename)
+        return res
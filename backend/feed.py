@@ -0,0 +1,291 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import fcntl
+import json
+import os
+import sys
+import time
+
+from query import Postsai, convert_to_builtin_type
+
+
+class PostsaiFeed:
+    """Pushes newly imported commits to subscribers using Server-Sent Events.
+
+       The importer appends the imported rows to a local feed file. Subscribers
+       follow that file and filter the rows themselves, so they do not need to
+       query the database.
+
+       The first line of the file contains its generation, which changes whenever
+       the file is truncated. Positions in the feed are (generation, offset) tuples,
+       so that readers notice the truncation even after the file grew again."""
+
+    # maps query parameters to the keys of rows in the feed
+    column_mapping = {
+        "repository" : "repository",
+        "cvsroot" : "repository",
+        "who" : "who",
+        "dir" : "dir",
+        "file" : "file",
+        "branch" : "branch",
+        "description" : "description",
+        "commit" : "hash",
+        "forked_from" : "forked_from"
+    }
+
+    row_keys = ["repository", "ci_when", "who", "dir", "file", "revision", "branch",
+                "addedlines", "removedlines", "description", "hash", "forked_from", "branchid", "descid"]
+
+
+    def __init__(self, config):
+        """Creates a PostsaiFeed instance"""
+
+        self.config = config
+        self.feed_config = config.get("feed", {})
+
+
+    def is_enabled(self):
+        """checks whether a feed file is configured"""
+
+        return "file" in self.feed_config
+
+
+    @staticmethod
+    def read_header(f):
+        """returns the generation of the feed file and the offset of its first row"""
+
+        f.seek(0)
+        line = f.readline()
+        if line.endswith("\n"):
+            try:
+                header = json.loads(line)
+            except ValueError:
+                header = None
+            if isinstance(header, dict) and "generation" in header:
+                return header["generation"], len(line)
+
+        # empty file or a file of an older version without header
+        return 0, 0
+
+
+    def publish(self, rows):
+        """appends newly imported rows to the feed file"""
+
+        if not self.is_enabled() or len(rows) == 0:
+            return
+
+        with open(self.feed_config["file"], "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+            # start over in a new generation
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0 or size > self.feed_config.get("max_size", 1048576):
+                generation = max(int(time.time() * 1000), self.read_header(f)[0] + 1)
+                f.truncate(0)
+                f.write(json.dumps({"generation": generation}) + "\n")
+
+            for row in rows:
+                entry = {}
+                for key in self.row_keys:
+                    entry[key] = row.get(key, "")
+                f.write(json.dumps(entry, default=convert_to_builtin_type) + "\n")
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def read_new_rows(self, position):
+        """reads all rows which were published after the position, None reads from the start of the feed"""
+
+        if not self.is_enabled():
+            return position, []
+
+        try:
+            f = open(self.feed_config["file"], "r")
+        except IOError:
+            return position, []
+
+        rows = []
+        with f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            generation, offset = self.read_header(f)
+
+            # positions of an older generation start over, because the file was truncated
+            if position != None and position[0] == generation and position[1] > offset:
+                offset = position[1]
+
+            f.seek(offset)
+            for line in f:
+                offset = offset + len(line)
+                rows.append(json.loads(line))
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return (generation, offset), rows
+
+
+    def matches(self, form, read_permission_pattern, row):
+        """checks whether the row is readable and matches the filters of the query"""
+
+        if not Postsai.matches_column(row["repository"], read_permission_pattern, "regexp"):
+            return False
+
+        for column, key in self.column_mapping.items():
+            pattern = form.getfirst(column, "")
+            if pattern == "":
+                continue
+
+            # replace HEAD branch and root with empty string
+            if (column == "branch" and pattern == "HEAD") or (column == "forked_from" and pattern == "-"):
+                pattern = ""
+
+            if not Postsai.matches_column(row[key], pattern, form.getfirst(column + "type", "match")):
+                return False
+        return True
+
+
+    @staticmethod
+    def convert_row_to_array(row):
+        """converts a feed row into the format of a database row of a query"""
+
+        path = (row["dir"] + "/" + row["file"]).lstrip("/")
+        lines = str(row["addedlines"]) + "/" + str(row["removedlines"])
+        return [row["repository"], row["ci_when"], row["who"], path, row["revision"], row["branch"],
+                lines, row["description"], row["repository"], row["hash"], row["forked_from"]]
+
+
+    def extract_matching_commits(self, form, read_permission_pattern, rows):
+        """filters the rows and merges them into commits"""
+
+        matching = []
+        for row in rows:
+            if self.matches(form, read_permission_pattern, row):
+                matching.append(self.convert_row_to_array(row))
+        return Postsai.extract_commits(matching)
+
+
+    @staticmethod
+    def parse_event_id(last_event_id):
+        """returns the position of an event id of the form "generation-offset" or None, if it is invalid"""
+
+        parts = last_event_id.split("-")
+        if len(parts) != 2 or not parts[0].isdigit() or not parts[1].isdigit():
+            return None
+        return int(parts[0]), int(parts[1])
+
+
+    def find_start_offset(self, last_event_id):
+        """resumes after the last event received by a reconnecting client or starts at the end of the feed.
+           Clients, which missed the truncation of the feed, resume at the start of the current generation."""
+
+        try:
+            f = open(self.feed_config["file"], "r")
+        except IOError:
+            return (0, 0)
+
+        with f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            generation, start = self.read_header(f)
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+
+            position = self.parse_event_id(last_event_id)
+            if position != None and position[0] != generation:
+                position = (generation, start)
+            elif position != None and not start <= position[1] <= end:
+                position = None
+            elif position != None and position[1] not in (start, end):
+                # the offset has to be the start of a row
+                f.seek(position[1] - 1)
+                if f.read(1) != "\n":
+                    position = None
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+        if position == None:
+            return (generation, end)
+        return position
+
+
+    @staticmethod
+    def format_event(position, commits):
+        """formats an event, events without commits keep the connection alive and update the resume position"""
+
+        event = "id: " + str(position[0]) + "-" + str(position[1]) + "\n"
+        if commits != None:
+            event = event + "data: " + json.dumps(commits, default=convert_to_builtin_type) + "\n"
+        return event + "\n"
+
+
+    def stream(self, form, read_permission_pattern, last_event_id):
+        """sends matching commits to the client until the maximum duration is reached"""
+
+        poll_interval = self.feed_config.get("poll_interval", 1)
+        heartbeat_interval = self.feed_config.get("heartbeat_interval", 15)
+        max_duration = self.feed_config.get("max_duration", 600)
+
+        position = self.find_start_offset(last_event_id)
+        start = time.time()
+        last_output = start
+        while time.time() - start < max_duration:
+            position, rows = self.read_new_rows(position)
+            commits = self.extract_matching_commits(form, read_permission_pattern, rows)
+            if len(commits) > 0:
+                sys.stdout.write(self.format_event(position, commits))
+                last_output = time.time()
+            elif time.time() - last_output > heartbeat_interval:
+                sys.stdout.write(self.format_event(position, None))
+                last_output = time.time()
+            sys.stdout.flush()
+            time.sleep(poll_interval)
+
+
+    def process(self, form, environ):
+        """processes a subscription request"""
+
+        if not self.is_enabled():
+            print("Status: 404 Not Found\r")
+            print("Content-Type: text/plain; charset='utf-8'\r")
+            print("\r")
+            print("Feed is not configured")
+            return
+
+        postsai = Postsai(self.config)
+        result = postsai.validate_input(form)
+        if result != "":
+            print("Status: 403 Forbidden\r")
+            print("Content-Type: text/plain; charset='utf-8'\r")
+            print("\r")
+            print(result)
+            return
+
+        print("Content-Type: text/event-stream; charset='utf-8'\r")
+        print("Cache-Control: no-cache\r")
+        print("\r")
+        print("retry: " + str(self.feed_config.get("retry", 3000)))
+        print("")
+        sys.stdout.flush()
+
+        try:
+            self.stream(form, Postsai.get_configured_read_permission_pattern(self.config, environ),
+                        environ.get("HTTP_LAST_EVENT_ID", ""))
+        except IOError:
+            # the client has disconnected
+            pass
@@ -0,0 +1,198 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import json
+
+from db import PostsaiDB
+from lookuptable import SharedLookupTable
+from query import Postsai, convert_to_builtin_type
+
+
+class PostsaiFileHistory:
+    """Lists the revisions of a single file, newest first.
+
+       The repository, directory and file are resolved to ids once, so that the
+       query walks the (fileid, dirid, ci_when) index of the checkins table.
+       Pages are continued with the position of the last row instead of an offset,
+       so that late pages of long histories are as fast as the first one."""
+
+    id_queries = {
+        "repository": "SELECT id FROM repositories WHERE repository = %s",
+        "dir": "SELECT id FROM dirs WHERE dir = %s",
+        "file": "SELECT id FROM files WHERE file = %s"
+    }
+
+
+    def __init__(self, config):
+        """Creates a PostsaiFileHistory instance"""
+
+        self.config = config
+
+
+    def resolve_ids(self, db, form):
+        """returns the ids of repository, dir and file or None, if one of them is unknown"""
+
+        lookup_table = SharedLookupTable.open(self.config)
+        ids = {}
+        for column, sql in self.id_queries.items():
+            value = form.getfirst(column, "")
+            if lookup_table != None:
+                ids[column] = lookup_table.get(column, value)
+                if ids[column] != None:
+                    continue
+            rows = db.query(sql, [value])
+            if len(rows) == 0:
+                return None
+            ids[column] = rows[0][0]
+            if lookup_table != None:
+                lookup_table.put(column, value, ids[column])
+        return ids
+
+
+    @staticmethod
+    def parse_cursor(cursor):
+        """parses a cursor of the form "ci_when,id" into its parts, None for the first page"""
+
+        if cursor == None or cursor == "":
+            return None
+        sep = cursor.rfind(",")
+        if sep < 0:
+            return None
+        try:
+            return (cursor[0:sep], int(cursor[sep + 1:]))
+        except ValueError:
+            return None
+
+
+    @staticmethod
+    def create_cursor(row):
+        """creates the cursor, which continues after the row"""
+
+        return str(row[1]) + "," + str(row[0])
+
+
+    def get_limit(self, form):
+        """returns the page size requested by the client, capped by the configuration"""
+
+        maximum = self.config.get("history", {}).get("max_limit", 1000)
+        try:
+            limit = int(form.getfirst("limit", "100"))
+        except ValueError:
+            limit = 100
+        return max(1, min(limit, maximum))
+
+
+    @staticmethod
+    def create_query(ids, cursor, limit):
+        """creates the query for one page of the history"""
+
+        sql = """SELECT checkins.id, checkins.ci_when, people.who, checkins.revision, branches.branch,
+            checkins.type, checkins.addedlines, checkins.removedlines, descs.description, commitids.hash
+            FROM checkins
+            JOIN branches ON checkins.branchid = branches.id
+            JOIN descs ON checkins.descid = descs.id
+            JOIN people ON checkins.whoid = people.id
+            LEFT JOIN commitids ON checkins.commitid = commitids.id
+            WHERE checkins.fileid = %s AND checkins.dirid = %s AND checkins.repositoryid = %s"""
+        data = [ids["file"], ids["dir"], ids["repository"]]
+
+        if cursor != None:
+            sql = sql + " AND (checkins.ci_when < %s OR (checkins.ci_when = %s AND checkins.id < %s))"
+            data.extend([cursor[0], cursor[0], cursor[1]])
+
+        # one more row tells whether there is a next page
+        sql = sql + " ORDER BY checkins.ci_when DESC, checkins.id DESC LIMIT %s"
+        data.append(limit + 1)
+        return sql, data
+
+
+    @staticmethod
+    def convert_row(row):
+        """converts a database row into a revision of the result"""
+
+        return {
+            "revision": row[3],
+            "ci_when": row[1],
+            "who": row[2],
+            "branch": row[4],
+            "type": row[5],
+            "lines": str(row[6]) + "/" + str(row[7]),
+            "description": row[8],
+            "commit": row[9]
+        }
+
+
+    def read_history(self, db, form):
+        """reads one page of the history"""
+
+        ids = self.resolve_ids(db, form)
+        if ids == None:
+            return [], None
+
+        limit = self.get_limit(form)
+        sql, data = self.create_query(ids, self.parse_cursor(form.getfirst("cursor", "")), limit)
+        rows = db.query(sql, data)
+
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[0:limit]
+            cursor = self.create_cursor(rows[-1])
+        return [self.convert_row(row) for row in rows], cursor
+
+
+    def process(self, form):
+        """processes a file history request"""
+
+        result = Postsai(self.config).validate_input(form)
+        if result != "":
+            print("Status: 403 Forbidden\r")
+            print("Content-Type: text/plain; charset='utf-8'\r")
+            print("\r")
+            print(result)
+            return
+
+        repository = form.getfirst("repository", "")
+        pattern = Postsai.get_configured_read_permission_pattern(self.config)
+        if not Postsai.matches_column(repository, pattern, "regexp"):
+            print("Status: 403 Forbidden\r")
+            print("Content-Type: text/plain; charset='utf-8'\r")
+            print("\r")
+            print("Missing permission")
+            return
+
+        db = PostsaiDB(self.config, read_only=True)
+        db.connect()
+        revisions, cursor = self.read_history(db, form)
+        db.disconnect()
+
+        result = {
+            "repository": repository,
+            "dir": form.getfirst("dir", ""),
+            "file": form.getfirst("file", ""),
+            "revisions": revisions,
+            "next": cursor
+        }
+
+        print("Content-Type: text/json; charset='utf-8'\r")
+        print("Cache-Control: max-age=60\r")
+        print("\r")
+        print(json.dumps(result, default=convert_to_builtin_type))
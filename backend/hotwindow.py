@@ -0,0 +1,339 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import array
+import bisect
+import calendar
+import datetime
+import itertools
+import operator
+import re
+import threading
+
+from feed import PostsaiFeed
+from query import Postsai
+
+
+class StringDictionary:
+    """Encodes the distinct values of a column as integer codes"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+
+    def encode(self, value):
+        """returns the code of a value, adding it if it is new"""
+
+        code = self.codes.get(value)
+        if code == None:
+            code = len(self.values)
+            self.codes[value] = code
+            self.values.append(value)
+        return code
+
+
+    def find_codes(self, pattern, matchtype):
+        """returns the codes of all values which match the pattern.
+           The pattern is evaluated once per distinct value instead of once per row."""
+
+        result = set()
+        for code, value in enumerate(self.values):
+            if Postsai.matches_column(value, pattern, matchtype):
+                result.add(code)
+        return result
+
+
+
+class HotWindow:
+    """Keeps the commits of the last days in memory for long-lived server processes.
+
+       Every column is stored in a compact integer array. Strings are dictionary
+       encoded, so filters are evaluated on the distinct values and the scan only
+       looks up integer codes. The positions of the rows are kept in the order of
+       the database query, so a date range is a contiguous part of that order.
+       New commits are read from the feed of the importer."""
+
+    string_columns = ["repository", "who", "dir", "file", "revision", "branch",
+                      "description", "hash", "forked_from"]
+
+    integer_columns = ["ci_when", "addedlines", "removedlines", "branchid", "descid"]
+
+
+    def __init__(self, config):
+        """Creates an empty HotWindow"""
+
+        self.config = config
+        self.days = config.get("hot_window", {}).get("days", 7)
+        self.feed = PostsaiFeed(config)
+        self.feed_position = None
+        self.lock = threading.Lock()
+        self.clear()
+
+
+    def clear(self):
+        """removes all rows"""
+
+        self.dictionaries = {}
+        self.columns = {}
+        for column in self.string_columns:
+            self.dictionaries[column] = StringDictionary()
+            self.columns[column] = array.array("l")
+        for column in self.integer_columns:
+            self.columns[column] = array.array("l")
+        self.keys = set()
+        self.order = array.array("l")
+        self.sorted_when = array.array("l")
+
+
+    @staticmethod
+    def to_timestamp(value):
+        """converts a datetime or a string in database or ISO format into seconds"""
+
+        if not isinstance(value, datetime.datetime):
+            value = datetime.datetime.strptime(str(value)[0:19].replace("T", " "), "%Y-%m-%d %H:%M:%S")
+        return calendar.timegm(value.timetuple())
+
+
+    def add_row(self, row):
+        """adds a row with the keys of a feed row, ignoring duplicates like the database does"""
+
+        codes = {}
+        for column in self.string_columns:
+            value = row[column]
+            if value == None:
+                value = ""
+            codes[column] = self.dictionaries[column].encode(value)
+
+        key = (codes["repository"], codes["branch"], codes["dir"], codes["file"], codes["revision"])
+        if key in self.keys:
+            return
+        self.keys.add(key)
+
+        for column in self.string_columns:
+            self.columns[column].append(codes[column])
+        self.columns["ci_when"].append(self.to_timestamp(row["ci_when"]))
+        for column in self.integer_columns[1:]:
+            # rows of older feed files do not contain the ids
+            self.columns[column].append(int(row.get(column) or 0))
+        self.insert_into_order(len(self.columns["ci_when"]) - 1)
+
+
+    def insert_into_order(self, i):
+        """inserts the position i into the order of the database query.
+           Rows are added in the order of their ids, so a new row goes behind all rows with the same sort key.
+           The database returns the rows in order and new commits are the latest ones, so this is usually an append."""
+
+        when = self.columns["ci_when"][i]
+        branchid = self.columns["branchid"]
+        descid = self.columns["descid"]
+        key = (branchid[i], descid[i])
+        first = bisect.bisect_left(self.sorted_when, when)
+        position = bisect.bisect_right(self.sorted_when, when)
+        while position > first and (branchid[self.order[position - 1]], descid[self.order[position - 1]]) > key:
+            position = position - 1
+        self.order.insert(position, i)
+        self.sorted_when.insert(position, when)
+
+
+    def cutoff(self):
+        """returns the timestamp of the start of the window"""
+
+        return self.to_timestamp(datetime.datetime.now()) - self.days * 86400
+
+
+    def load(self, db):
+        """loads the window from the database"""
+
+        # rows, which are imported while loading, are read from the feed and ignored as duplicates
+        position, rows = self.feed.read_new_rows(None)
+        sql = """SELECT repositories.repository, checkins.ci_when, people.who, dirs.dir, files.file, revision, branches.branch,
+        checkins.addedlines, checkins.removedlines, descs.description, commitids.hash, repositories.forked_from,
+        checkins.branchid, checkins.descid
+        FROM checkins
+        JOIN branches ON checkins.branchid = branches.id
+        JOIN descs ON checkins.descid = descs.id
+        JOIN dirs ON checkins.dirid = dirs.id
+        JOIN files ON checkins.fileid = files.id
+        JOIN people ON checkins.whoid = people.id
+        JOIN repositories ON checkins.repositoryid = repositories.id
+        LEFT JOIN commitids ON checkins.commitid = commitids.id
+        WHERE ci_when >= DATE_SUB(NOW(), INTERVAL %s DAY)
+        ORDER BY checkins.ci_when, checkins.branchid, checkins.descid, checkins.id"""
+        db_rows = db.query(sql, [self.days])
+
+        with self.lock:
+            self.clear()
+            for db_row in db_rows:
+                self.add_row(dict(zip(PostsaiFeed.row_keys, db_row)))
+            self.feed_position = position
+
+
+    def refresh(self):
+        """adds rows which were imported since the last refresh and drops rows which left the window"""
+
+        with self.lock:
+            self.feed_position, rows = self.feed.read_new_rows(self.feed_position)
+            for row in rows:
+                self.add_row(row)
+
+            cutoff = self.cutoff()
+            if len(self.sorted_when) > 0 and self.sorted_when[0] < cutoff:
+                self.compact(cutoff)
+
+
+    def compact(self, cutoff):
+        """removes all rows older than the cutoff"""
+
+        ci_when = self.columns["ci_when"]
+        keep = list(itertools.compress(xrange(len(ci_when)), itertools.imap(operator.le, itertools.repeat(cutoff), ci_when)))
+        for column, values in self.columns.items():
+            self.columns[column] = array.array(values.typecode, itertools.imap(values.__getitem__, keep))
+        self.keys = set(zip(self.columns["repository"], self.columns["branch"],
+                            self.columns["dir"], self.columns["file"], self.columns["revision"]))
+
+        # the remaining rows are the end of the order, they only get new positions
+        positions = dict(itertools.izip(keep, itertools.count()))
+        start = bisect.bisect_left(self.sorted_when, cutoff)
+        self.order = array.array("l", itertools.imap(positions.__getitem__, self.order[start:]))
+        self.sorted_when = self.sorted_when[start:]
+
+
+    def find_date_range(self, form):
+        """returns the date range of the query in seconds or None, if the window does not cover it"""
+
+        now = self.to_timestamp(datetime.datetime.now())
+        datetype = form.getfirst("date", "day")
+        if datetype == "explicit":
+            mindate = Postsai.parse_date(form.getfirst("mindate", ""), None)
+            maxdate = Postsai.parse_date(form.getfirst("maxdate", ""), None)
+            if mindate == None:
+                return None
+            start = self.to_timestamp(mindate)
+            end = now
+            if maxdate != None:
+                end = self.to_timestamp(maxdate)
+        else:
+            days = Postsai.estimate_days(form)
+            if days == float("inf"):
+                return None
+            if datetype == "month":
+                # MySQL uses calendar months
+                days = 31
+            start = now - days * 86400
+            end = now
+
+        if start < self.cutoff():
+            return None
+        return (start, end)
+
+
+    @staticmethod
+    def is_portable(pattern, matchtype):
+        """checks whether Python evaluates the pattern exactly like the database.
+           The collation treats accented characters like unaccented ones and the
+           regular expressions differ for escapes like \\d, classes like [[:alpha:]],
+           groups like (?i) and lazy quantifiers."""
+
+        if any(ord(c) > 127 for c in pattern):
+            return False
+        if Postsai.convert_operator(matchtype) == "=":
+            return True
+        return re.search(r"\\[0-9A-Za-z]|\[[:=.]|\(\?|[*+?}][?+]", pattern) == None
+
+
+    def can_answer(self, form, read_permission_pattern):
+        """checks whether the query can be answered from memory"""
+
+        if not self.is_portable(read_permission_pattern, "regexp"):
+            return False
+
+        for column in PostsaiFeed.column_mapping.keys():
+            pattern = form.getfirst(column, "")
+            matchtype = form.getfirst(column + "type", "match")
+            if pattern == "":
+                continue
+            # the database evaluates search mode using its fulltext index
+            if matchtype == "search" or not self.is_portable(pattern, matchtype):
+                return False
+
+        return (form.getfirst("since", "") == "" and not Postsai.is_tag_query(form)
+                and self.find_date_range(form) != None)
+
+
+    def select(self, column, codes, candidates):
+        """selects the rows whose code is in the set of codes.
+           The codes are looked up in a bytearray, so itertools scans the column without interpreting Python code per row."""
+
+        mask = bytearray(len(self.dictionaries[column].values))
+        for code in codes:
+            mask[code] = 1
+        values = self.columns[column]
+        return list(itertools.compress(candidates, itertools.imap(mask.__getitem__,
+                                                                  itertools.imap(values.__getitem__, candidates))))
+
+
+    def query(self, form, read_permission_pattern):
+        """returns rows in the format of a database query, newest first"""
+
+        with self.lock:
+            (start, end) = self.find_date_range(form)
+            selected = self.order[bisect.bisect_left(self.sorted_when, start):bisect.bisect_right(self.sorted_when, end)]
+
+            codes = self.dictionaries["repository"].find_codes(read_permission_pattern, "regexp")
+            selected = self.select("repository", codes, selected)
+
+            for column, key in PostsaiFeed.column_mapping.items():
+                pattern = form.getfirst(column, "")
+                if pattern == "":
+                    continue
+                if (column == "branch" and pattern == "HEAD") or (column == "forked_from" and pattern == "-"):
+                    pattern = ""
+                codes = self.dictionaries[key].find_codes(pattern, form.getfirst(column + "type", "match"))
+                selected = self.select(key, codes, selected)
+
+            selected.reverse()
+            limit = form.getfirst("limit", None)
+            if limit:
+                selected = selected[0:int(limit)]
+
+            return [self.convert_to_row(i) for i in selected]
+
+
+    def decode(self, column, i):
+        """returns the string value of the column in row i"""
+
+        return self.dictionaries[column].values[self.columns[column][i]]
+
+
+    def convert_to_row(self, i):
+        """converts the row at position i into the format of a database row of a query"""
+
+        path = (self.decode("dir", i) + "/" + self.decode("file", i)).lstrip("/")
+        lines = str(self.columns["addedlines"][i]) + "/" + str(self.columns["removedlines"][i])
+        commit = self.decode("hash", i)
+        if commit == "":
+            commit = None
+        return [self.decode("repository", i), datetime.datetime.utcfromtimestamp(self.columns["ci_when"][i]),
+                self.decode("who", i), path, self.decode("revision", i), self.decode("branch", i),
+                lines, self.decode("description", i), self.decode("repository", i), commit,
+                self.decode("forked_from", i)]
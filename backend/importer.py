@@ -21,10 +21,18 @@
 
 
 import calendar
+import os
 import re
 import datetime
+import subprocess
+import sys
+import time
 
 from db import PostsaiDB
+from feed import PostsaiFeed
+from metrics import Metrics
+from query import Postsai
+from resultcache import QueryResultCache
 
 
 class PostsaiImporter:
@@ -51,12 +59,12 @@ class PostsaiImporter:
 
 
 
-    def check_permission(self, repo_name):
+    def check_permission(self, repo_name, environ=None):
         """checks writes write permissions"""
 
         if not "get_write_permission_pattern" in self.config:
             return True
-        regex = self.config["get_write_permission_pattern"]()
+        regex = Postsai.call_permission_hook(self.config["get_write_permission_pattern"], environ)
         return not re.match(regex, repo_name) == None
 
 
@@ -151,6 +159,30 @@ class PostsaiImporter:
         return branch
 
 
+    def extract_tag(self):
+        """Extracts the tag name of a tag push, None if a branch was pushed."""
+
+        ref = self.data.get("ref", "")
+        if not ref.startswith("refs/tags/"):
+            return None
+        return ref[len("refs/tags/"):]
+
+
+    def extract_tagged_commit(self):
+        """Extracts the hash of the commit a tag points to, None if the tag was deleted."""
+
+        if self.data.get("deleted", False):
+            return None
+        if self.data.get("head_commit"): # github, the commit of annotated tags
+            return self.data["head_commit"]["id"]
+        if "checkout_sha" in self.data: # gitlab
+            return self.data["checkout_sha"]
+        after = self.data.get("after", "")
+        if after.strip("0") == "":
+            return None
+        return after
+
+
     @staticmethod
     def filter_out_folders(files):
         """Sourceforge includes folders in the file list, but we do not want them"""
@@ -287,11 +319,30 @@ class PostsaiImporter:
         return head, rows
 
 
-    def import_from_webhook(self):
+    def refresh_result_cache(self, db, repo_name):
+        """invalidates cached query results and recomputes popular queries in the background"""
+
+        cache = QueryResultCache(self.config)
+        if not cache.is_enabled():
+            return
+
+        cache.invalidate()
+        if db.created_repository:
+            cache.invalidate_repositories()
+
+        # prewarm.py also removes outdated entries, so it runs even if no queries are prewarmed.
+        # The working directory of long-lived servers may differ from the installation folder.
+        folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(os.devnull, "r+") as devnull:
+            subprocess.Popen([sys.executable, os.path.join(folder, "prewarm.py"), repo_name], cwd=folder,
+                             stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True)
+
+
+    def import_from_webhook(self, environ):
         """Import this webhook invokation into the database"""
 
         repo_name = self.extract_repo_name()
-        if not self.check_permission(repo_name):
+        if not self.check_permission(repo_name, environ):
             print("Status: 403 Forbidden\r")
             print("Content-Type: text/html; charset='utf-8'\r")
             print("\r")
@@ -300,7 +351,19 @@ class PostsaiImporter:
         print("Content-Type: text/plain; charset='utf-8'\r")
         print("\r")
 
-        head, rows = self.parse_data()
         db = PostsaiDB(self.config)
-        db.import_data(head, rows)
+        tag = self.extract_tag()
+        if tag != None:
+            # the commits of a tag push have already been imported with their branch
+            db.import_tag(repo_name, tag, self.extract_tagged_commit())
+        else:
+            head, rows = self.parse_data()
+            head["remote_addr"] = environ.get("REMOTE_ADDR", "")
+            head["remote_user"] = environ.get("REMOTE_USER", "")
+            start = time.time()
+            db.import_data(head, rows)
+            Metrics.observe("postsai_import_seconds", time.time() - start)
+            Metrics.increment("postsai_imported_rows_total", len(rows))
+            PostsaiFeed(self.config).publish(rows)
+        self.refresh_result_cache(db, repo_name)
         print("Completed")
@@ -0,0 +1,174 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+# record locks belong to the process, so they do not exclude its other threads
+lock = threading.Lock()
+
+
+class SharedLookupTable:
+    """Maps the values of lookup tables like people or branches to their ids for all processes on this host.
+
+       The table is a fixed-size hash table in a memory-mapped file. Every key hashes
+       to a bucket of a few slots, a full bucket evicts its least recently used slot.
+       Readers do not lock, they check the key of a slot before and after reading the id.
+       Writers lock the byte range of the bucket, so they only wait for writers of the same bucket.
+       Threads of the same process are serialized by the module lock."""
+
+    magic = "PSLT0001"
+    header_format = "<8sI"
+    slot_format = "<16sqI4x"
+    slot_size = struct.calcsize(slot_format)
+    slots_per_bucket = 8
+    empty = "\0" * 16
+
+    # opened tables of long-lived processes
+    opened = {}
+
+
+    def __init__(self, filename, entries, namespace):
+        """maps the file, creating it with space for the number of entries if necessary"""
+
+        self.namespace = namespace
+
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, "r+b")
+        with lock:
+            fcntl.lockf(self.file, fcntl.LOCK_EX)
+            try:
+                header_size = struct.calcsize(self.header_format)
+                if os.fstat(fd).st_size < header_size:
+                    buckets = max(1, entries // self.slots_per_bucket)
+                    self.file.truncate(header_size + buckets * self.slots_per_bucket * self.slot_size)
+                    self.file.seek(0)
+                    self.file.write(struct.pack(self.header_format, self.magic, buckets))
+                    self.file.flush()
+                self.file.seek(0)
+                (magic, self.buckets) = struct.unpack(self.header_format, self.file.read(header_size))
+                if magic != self.magic:
+                    raise ValueError("Not a lookup table: " + filename)
+            finally:
+                fcntl.lockf(self.file, fcntl.LOCK_UN)
+
+        self.header_size = header_size
+        self.map = mmap.mmap(fd, header_size + self.buckets * self.slots_per_bucket * self.slot_size)
+
+
+    @staticmethod
+    def open(config):
+        """returns the table of the configuration or None, if no table is configured"""
+
+        table_config = config.get("lookup_table", {})
+        if table_config.get("file", "") == "":
+            return None
+
+        db_config = config.get("db", {})
+        namespace = db_config.get("host", "") + ":" + str(db_config.get("port", 3306)) + "/" + db_config.get("database", "")
+        key = (table_config["file"], namespace)
+        if not key in SharedLookupTable.opened:
+            SharedLookupTable.opened[key] = SharedLookupTable(table_config["file"], table_config.get("entries", 131072), namespace)
+        return SharedLookupTable.opened[key]
+
+
+    def digest(self, entity_type, key):
+        """returns the digest, which identifies a key of a lookup table"""
+
+        if isinstance(key, unicode):
+            key = key.encode("utf-8")
+        return hashlib.md5(self.namespace + "\0" + entity_type + "\0" + key).digest()
+
+
+    def find_bucket(self, digest):
+        """returns the offset of the bucket of a digest"""
+
+        index = struct.unpack_from("<Q", digest)[0] % self.buckets
+        return self.header_size + index * self.slots_per_bucket * self.slot_size
+
+
+    def get(self, entity_type, key):
+        """returns the id of a key or None, if it is not in the table"""
+
+        if not isinstance(key, basestring):
+            return None
+
+        digest = self.digest(entity_type, key)
+        bucket = self.find_bucket(digest)
+        for offset in range(bucket, bucket + self.slots_per_bucket * self.slot_size, self.slot_size):
+            if self.map[offset:offset + 16] == digest:
+                (value, stamp) = struct.unpack_from("<qI", self.map, offset + 16)
+                # the slot might have been reused while it was read
+                if self.map[offset:offset + 16] == digest:
+                    struct.pack_into("<I", self.map, offset + 24, int(time.time()))
+                    return value
+        return None
+
+
+    def put(self, entity_type, key, value):
+        """stores the id of a key, evicting the least recently used key of its bucket if necessary"""
+
+        if not isinstance(key, basestring):
+            return
+
+        digest = self.digest(entity_type, key)
+        bucket = self.find_bucket(digest)
+        length = self.slots_per_bucket * self.slot_size
+        with lock:
+            fcntl.lockf(self.file, fcntl.LOCK_EX, length, bucket)
+            try:
+                victim = None
+                oldest = None
+                for offset in range(bucket, bucket + length, self.slot_size):
+                    (slot_digest, slot_value, stamp) = struct.unpack_from(self.slot_format, self.map, offset)
+                    if slot_digest == digest:
+                        return
+                    if slot_digest == self.empty:
+                        stamp = -1
+                    if oldest == None or stamp < oldest:
+                        victim = offset
+                        oldest = stamp
+
+                # readers ignore the slot until the new key is written
+                self.map[victim:victim + 16] = self.empty
+                struct.pack_into("<qI", self.map, victim + 16, value, int(time.time()))
+                self.map[victim:victim + 16] = digest
+            finally:
+                fcntl.lockf(self.file, fcntl.LOCK_UN, length, bucket)
+
+
+    def clear(self):
+        """removes all entries, e. g. after the database was replaced"""
+
+        with lock:
+            fcntl.lockf(self.file, fcntl.LOCK_EX)
+            try:
+                for offset in range(self.header_size, len(self.map), self.slot_size):
+                    self.map[offset:offset + 16] = self.empty
+            finally:
+                fcntl.lockf(self.file, fcntl.LOCK_UN)
@@ -0,0 +1,214 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import fcntl
+import hmac
+import json
+import sys
+import threading
+
+
+class Metrics:
+    """Collects counters and latency histograms.
+
+       The values of a process are added to the totals in the metrics file after
+       every request, so that the totals include all processes on this host."""
+
+    # upper bounds of the histogram buckets in seconds
+    buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    # values which were not written to the metrics file yet
+    pending = {"counters": {}, "histograms": {}}
+    lock = threading.Lock()
+
+
+    @staticmethod
+    def format_labels(labels):
+        """converts a dict of labels into the Prometheus format"""
+
+        if labels == None:
+            return ""
+        return ",".join([key + "=\"" + str(labels[key]).replace("\\", "\\\\").replace("\"", "\\\"") + "\""
+                         for key in sorted(labels.keys())])
+
+
+    @staticmethod
+    def increment(name, value=1, labels=None):
+        """adds a value to a counter"""
+
+        series = Metrics.format_labels(labels)
+        with Metrics.lock:
+            counters = Metrics.pending["counters"].setdefault(name, {})
+            counters[series] = counters.get(series, 0) + value
+
+
+    @staticmethod
+    def observe(name, seconds, labels=None):
+        """records a duration in a histogram"""
+
+        series = Metrics.format_labels(labels)
+        with Metrics.lock:
+            histograms = Metrics.pending["histograms"].setdefault(name, {})
+            # one count per bucket, followed by the total count and the sum
+            values = histograms.setdefault(series, [0] * (len(Metrics.buckets) + 2))
+            for i, bound in enumerate(Metrics.buckets):
+                if seconds <= bound:
+                    values[i] = values[i] + 1
+            values[-2] = values[-2] + 1
+            values[-1] = values[-1] + seconds
+
+
+    @staticmethod
+    def take_pending():
+        """returns the values which were not written yet and starts over"""
+
+        with Metrics.lock:
+            pending = Metrics.pending
+            Metrics.pending = {"counters": {}, "histograms": {}}
+        return pending
+
+
+    @staticmethod
+    def merge(totals, pending):
+        """adds the pending values to the totals"""
+
+        for kind in ("counters", "histograms"):
+            for name, series in pending[kind].items():
+                target = totals[kind].setdefault(name, {})
+                for labels, value in series.items():
+                    if kind == "counters":
+                        target[labels] = target.get(labels, 0) + value
+                    else:
+                        previous = target.get(labels, [0] * len(value))
+                        target[labels] = [a + b for (a, b) in zip(previous, value)]
+
+
+    @staticmethod
+    def flush(config):
+        """adds the values of this process to the metrics file"""
+
+        filename = config.get("metrics", {}).get("file", "")
+        pending = Metrics.take_pending()
+        if filename == "":
+            return
+
+        with open(filename, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                totals = json.loads(f.read())
+            except ValueError:
+                totals = {"counters": {}, "histograms": {}}
+            Metrics.merge(totals, pending)
+            f.truncate(0)
+            f.write(json.dumps(totals))
+            f.flush()
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    @staticmethod
+    def read_totals(config):
+        """reads the totals of all processes"""
+
+        try:
+            with open(config.get("metrics", {}).get("file", ""), "r") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {"counters": {}, "histograms": {}}
+
+
+    @staticmethod
+    def format_series(name, labels, extra=""):
+        """returns the name of a time series including its labels"""
+
+        labels = ",".join([label for label in (labels, extra) if label != ""])
+        if labels == "":
+            return name
+        return name + "{" + labels + "}"
+
+
+    @staticmethod
+    def format_text(totals):
+        """converts the totals into the text format of Prometheus"""
+
+        lines = []
+        for name in sorted(totals["counters"].keys()):
+            lines.append("# TYPE " + name + " counter")
+            for labels, value in sorted(totals["counters"][name].items()):
+                lines.append(Metrics.format_series(name, labels) + " " + repr(value))
+
+        for name in sorted(totals["histograms"].keys()):
+            lines.append("# TYPE " + name + " histogram")
+            for labels, values in sorted(totals["histograms"][name].items()):
+                for i, bound in enumerate(Metrics.buckets):
+                    lines.append(Metrics.format_series(name + "_bucket", labels, "le=\"" + repr(bound) + "\"")
+                                 + " " + str(values[i]))
+                lines.append(Metrics.format_series(name + "_bucket", labels, "le=\"+Inf\"") + " " + str(values[-2]))
+                lines.append(Metrics.format_series(name + "_sum", labels) + " " + repr(values[-1]))
+                lines.append(Metrics.format_series(name + "_count", labels) + " " + str(values[-2]))
+        return "\n".join(lines) + "\n"
+
+
+
+class PostsaiMetrics:
+    """Provides the metrics of all processes in the text format of Prometheus"""
+
+    def __init__(self, config):
+        """Creates a PostsaiMetrics instance"""
+
+        self.config = config
+
+
+    @staticmethod
+    def is_client_allowed(section_config, environ):
+        """checks whether the client is in the allowed addresses or sends the configured bearer token.
+           Nobody is allowed by default, because behind a reverse proxy every client seems to be local."""
+
+        if environ.get("REMOTE_ADDR", "") in section_config.get("allowed_addresses", []):
+            return True
+        token = section_config.get("token", "")
+        return token != "" and hmac.compare_digest(environ.get("HTTP_AUTHORIZATION", ""), "Bearer " + token)
+
+
+    def is_allowed(self, environ):
+        """checks whether the client may read the metrics"""
+
+        return self.is_client_allowed(self.config.get("metrics", {}), environ)
+
+
+    def process(self, environ):
+        """processes a metrics request"""
+
+        if not self.is_allowed(environ):
+            print("Status: 403 Forbidden\r")
+            print("Content-Type: text/plain; charset='utf-8'\r")
+            print("\r")
+            print("Missing permission")
+            return
+
+        # include the values of the current request
+        Metrics.flush(self.config)
+        print("Content-Type: text/plain; version=0.0.4; charset='utf-8'\r")
+        print("Cache-Control: no-cache\r")
+        print("\r")
+        sys.stdout.write(Metrics.format_text(Metrics.read_totals(self.config)))
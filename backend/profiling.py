@@ -0,0 +1,184 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import cProfile
+import os
+import pstats
+import re
+import StringIO
+import sys
+import threading
+import time
+import urlparse
+
+from db import PostsaiDB
+from metrics import PostsaiMetrics
+
+
+class RequestProfiler:
+    """Runs a single request under the profiler and stores the call profile and the
+       timings of its SQL statements in the profiling folder.
+
+       Profiling is requested with the parameter profile=1 from an allowed address
+       or for all requests with the environment variable POSTSAI_PROFILE=1.
+       Only the thread of the request is profiled, other requests are not affected."""
+
+    def __init__(self, config):
+        """Creates a RequestProfiler instance"""
+
+        self.profiling_config = config.get("profiling", {})
+        self.folder = self.profiling_config.get("folder", "")
+
+
+    def is_allowed(self, environ):
+        """checks whether the client may profile requests and download profiles"""
+
+        return PostsaiMetrics.is_client_allowed(self.profiling_config, environ)
+
+
+    def is_requested(self, environ):
+        """checks whether the request should be profiled"""
+
+        if self.folder == "":
+            return False
+        if environ.get("POSTSAI_PROFILE", "") == "1":
+            return True
+        params = urlparse.parse_qs(environ.get("QUERY_STRING", ""))
+        return params.get("profile", [""])[0] == "1" and self.is_allowed(environ)
+
+
+    def create_summary(self, profiler, statements, seconds, method, environ):
+        """renders the slowest SQL statements and the functions with the highest cumulative time"""
+
+        top = self.profiling_config.get("top", 30)
+        summary = StringIO.StringIO()
+        summary.write("Method: " + method + "\n")
+        summary.write("Query: " + environ.get("QUERY_STRING", "") + "\n")
+        summary.write("Time: %.1f ms\n\n" % (seconds * 1000))
+
+        summary.write("SQL statements: %d, %.1f ms\n" % (len(statements), sum([s[2] for s in statements]) * 1000))
+        for (sql, data, duration) in sorted(statements, key=lambda s: s[2], reverse=True)[0:top]:
+            summary.write("%10.1f ms  %s %r\n" % (duration * 1000, " ".join(sql.split()), data))
+        summary.write("\n")
+
+        stats = pstats.Stats(profiler, stream=summary)
+        stats.sort_stats("cumulative").print_stats(top)
+        return summary.getvalue()
+
+
+    def remove_old_profiles(self):
+        """keeps only the newest profiles"""
+
+        names = sorted([name[:-4] for name in os.listdir(self.folder) if name.endswith(".txt")])
+        for name in names[0:-self.profiling_config.get("keep", 20)]:
+            for extension in (".txt", ".prof"):
+                try:
+                    os.remove(self.folder + "/" + name + extension)
+                except OSError:
+                    # removed by another process in the meantime
+                    pass
+
+
+    def store(self, profiler, statements, seconds, method, environ):
+        """writes the profile in pstats format and its summary"""
+
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+        name = (time.strftime("%Y%m%d-%H%M%S") + "-" + str(os.getpid()) + "-"
+                + str(threading.current_thread().ident) + "-" + method)
+        profiler.dump_stats(self.folder + "/" + name + ".prof")
+        with open(self.folder + "/" + name + ".txt", "w") as f:
+            f.write(self.create_summary(profiler, statements, seconds, method, environ))
+        self.remove_old_profiles()
+        sys.stderr.write("postsai: stored profile " + name + "\n")
+
+
+    def run(self, method, environ, function, *args):
+        """invokes the function under the profiler"""
+
+        profiler = cProfile.Profile()
+        PostsaiDB.recorded.statements = []
+        start = time.time()
+        try:
+            profiler.runcall(function, *args)
+        finally:
+            seconds = time.time() - start
+            statements = PostsaiDB.recorded.statements
+            PostsaiDB.recorded.statements = None
+            self.store(profiler, statements, seconds, method, environ)
+
+
+
+class PostsaiProfiles:
+    """Lists and downloads the stored profiles"""
+
+    def __init__(self, config):
+        """Creates a PostsaiProfiles instance"""
+
+        self.profiler = RequestProfiler(config)
+
+
+    def process(self, form, environ):
+        """processes a profile request, which returns the list, a summary or a profile in pstats format"""
+
+        if not self.profiler.is_allowed(environ):
+            print("Status: 403 Forbidden\r")
+            print("Content-Type: text/plain; charset='utf-8'\r")
+            print("\r")
+            print("Missing permission")
+            return
+
+        folder = self.profiler.folder
+        name = form.getfirst("name", "")
+        if name == "":
+            names = []
+            if os.path.isdir(folder):
+                names = sorted([entry[:-4] for entry in os.listdir(folder) if entry.endswith(".txt")], reverse=True)
+            print("Content-Type: text/plain; charset='utf-8'\r")
+            print("\r")
+            print("\n".join(names))
+            return
+
+        extension = ".txt"
+        if form.getfirst("format", "") == "prof":
+            extension = ".prof"
+        if re.match(r"^[\w.-]+$", name) == None or not os.path.isfile(folder + "/" + name + extension):
+            print("Status: 404 Not Found\r")
+            print("Content-Type: text/plain; charset='utf-8'\r")
+            print("\r")
+            print("Unknown profile")
+            return
+
+        if extension == ".prof":
+            print("Content-Type: application/octet-stream\r")
+            print("Content-Disposition: attachment; filename=\"" + name + ".prof\"\r")
+        else:
+            print("Content-Type: text/plain; charset='utf-8'\r")
+        print("\r")
+        sys.stdout.flush()
+        with open(folder + "/" + name + extension, "rb") as f:
+            sys.stdout.write(f.read())
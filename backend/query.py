@@ -20,11 +20,19 @@
 # DEALINGS IN THE SOFTWARE.
 
 
-import cgi
+import datetime
+import inspect
 import json
+import os
 import re
+import threading
+import time
 
+from admission import QuerySlots
 from db import PostsaiDB
+from metrics import Metrics
+from resultcache import QueryResultCache
+from slices import SlicedQueryExecutor
 import extension
 
 
@@ -35,19 +43,58 @@ def convert_to_builtin_type(obj):
 
 
 
+class FormOverlay:
+    """a cgi form with some parameters replaced, form may be None to use only the values"""
+
+    def __init__(self, form, values):
+        self.form = form
+        self.values = values
+
+
+    def getfirst(self, key, default=None):
+        if key in self.values:
+            return self.values[key]
+        if self.form == None:
+            return default
+        return self.form.getfirst(key, default)
+
+
+
 class Postsai:
 
+    # long-lived servers may keep the recent commits in memory
+    hot_window = None
+
+    # the environment of the request, which is processed by the current thread
+    request = threading.local()
+
+
     def __init__(self, config):
         """Creates a Postsai api instance"""
 
         self.config = config
-        self.extension_manager = extension.ExtensionManager()
+        self.last_id = None
+        self.read_permission_pattern = None
+        self.extension_manager = extension.ExtensionManager(config)
         self.extension_manager.call_all("query_extension_setup", [config])
 
 
     def validate_input(self, form):
         """filter inputs, e. g. for privacy reasons"""
 
+        timeout = form.getfirst("timeout", "")
+        try:
+            if timeout != "" and not 0 < float(timeout) < float("inf"):
+                return "Invalid value for parameter \"timeout\""
+        except ValueError:
+            return "Invalid value for parameter \"timeout\""
+        since = form.getfirst("since", "")
+        if since != "" and not since.isdigit():
+            return "Invalid value for parameter \"since\""
+        limit = form.getfirst("limit", "")
+        if limit != "" and not limit.isdigit():
+            return "Invalid value for parameter \"limit\""
+
         if not "filter" in self.config:
             return ""
 
@@ -65,18 +112,53 @@ class Postsai:
     def get_read_permission_pattern(self):
         """get read permissions pattern"""
 
-        if not "get_read_permission_pattern" in self.config:
+        # set when queries are executed on behalf of other users
+        if self.read_permission_pattern != None:
+            return self.read_permission_pattern
+        return self.get_configured_read_permission_pattern(self.config)
+
+
+    @staticmethod
+    def get_configured_read_permission_pattern(config, environ=None):
+        """get read permissions pattern of the current user from the configuration"""
+
+        if not "get_read_permission_pattern" in config:
             return ".*"
-        return self.config["get_read_permission_pattern"]()
+        return Postsai.call_permission_hook(config["get_read_permission_pattern"], environ)
+
+
+    @staticmethod
+    def call_permission_hook(hook, environ=None):
+        """calls a permission function of the configuration.
+
+           Functions with a parameter get the environment of the request, which
+           defaults to the request of the current thread. Functions without
+           parameters may only read os.environ in CGI mode."""
+
+        if len(inspect.getargspec(hook).args) == 0:
+            return hook()
+        if environ == None:
+            environ = getattr(Postsai.request, "environ", None) or os.environ
+        return hook(environ)
 
 
     def create_query(self, form):
         """creates the sql statement"""
 
         self.data = [self.get_read_permission_pattern()]
-        self.sql = """SELECT repositories.repository, checkins.ci_when, people.who, trim(leading '/' from concat(concat(dirs.dir, '/'), files.file)),
+        if self.is_grouped_query(form):
+            self.sql = """SELECT repositories.repository, MAX(checkins.ci_when),
+        SUBSTRING_INDEX(GROUP_CONCAT(people.who ORDER BY checkins.ci_when DESC, checkins.id DESC SEPARATOR '\\0'), '\\0', 1),
+        GROUP_CONCAT(trim(leading '/' from concat(concat(dirs.dir, '/'), files.file)) ORDER BY checkins.ci_when DESC, checkins.id DESC SEPARATOR '\\0'),
+        GROUP_CONCAT(revision ORDER BY checkins.ci_when DESC, checkins.id DESC SEPARATOR '\\0'), branches.branch,
+        SUBSTRING_INDEX(GROUP_CONCAT(concat(concat(checkins.addedlines, '/'), checkins.removedlines) ORDER BY checkins.ci_when DESC, checkins.id DESC SEPARATOR '\\0'), '\\0', 1),
+        MAX(descs.description), repositories.repository, commitids.hash, repositories.forked_from """
+        else:
+            self.sql = """SELECT repositories.repository, checkins.ci_when, people.who, trim(leading '/' from concat(concat(dirs.dir, '/'), files.file)),
         revision, branches.branch, concat(concat(checkins.addedlines, '/'), checkins.removedlines), descs.description, 
-        repositories.repository, commitids.hash, repositories.forked_from 
+        repositories.repository, commitids.hash, repositories.forked_from """
+
+        self.sql = self.sql + """
         FROM checkins 
         JOIN branches ON checkins.branchid = branches.id
         JOIN descs ON checkins.descid = descs.id
@@ -97,16 +179,53 @@ class Postsai:
         self.create_where_for_column("commit", form, "commitids.hash")
         self.create_where_for_column("forked_from", form, "forked_from")
 
-        self.create_where_for_date(form)
-
-        self.sql = self.sql + " ORDER BY checkins.ci_when DESC, checkins.branchid DESC, checkins.descid DESC, checkins.id DESC"
+        if self.is_tag_query(form):
+            self.create_where_for_tags(form)
+        else:
+            self.create_where_for_date(form)
+        self.create_where_for_since(form)
+
+        if self.is_grouped_query(form):
+            # rows without commit hash are not merged, same as in are_rows_in_same_commit.
+            # The files of a CVS commit may have different timestamps, so ci_when is not part of the group.
+            self.sql = self.sql + """ GROUP BY checkins.repositoryid, checkins.branchid,
+            checkins.commitid, IF(checkins.commitid IS NULL, checkins.id, 0)
+            ORDER BY MAX(checkins.ci_when) DESC, checkins.branchid DESC, MAX(checkins.id) DESC"""
+        else:
+            self.sql = self.sql + " ORDER BY checkins.ci_when DESC, checkins.branchid DESC, checkins.descid DESC, checkins.id DESC"
         limit = form.getfirst("limit", None)
         if limit:
             self.sql = self.sql + " LIMIT " + str(int(limit))
 
+        # let MySQL >= 5.7 enforce the deadline, even if this process gets killed
+        timeout = self.get_timeout(form)
+        if timeout:
+            self.sql = self.sql.replace("SELECT", "SELECT /*+ MAX_EXECUTION_TIME(" + str(int(timeout * 1000)) + ") */", 1)
+
         self.extension_manager.call_all("query_create_query", [self, form])
 
 
+    @staticmethod
+    def is_grouped_query(form):
+        """checks whether commits should be merged by the database instead of extract_commits.
+           This is not done for queries with a limit, because the limit counts files, not commits.
+
+           Unlike extract_commits, which only merges adjacent rows, the database merges all files
+           of a commit, even if files of other commits have timestamps in between."""
+
+        return form.getfirst("group", "") == "commit" and not form.getfirst("limit", None)
+
+
+    def get_timeout(self, form):
+        """returns the execution deadline of the query in seconds, clients may request a shorter one"""
+
+        timeout = self.config.get("db", {}).get("query_timeout", 0)
+        requested = form.getfirst("timeout", "")
+        if requested != "" and float(requested) > 0 and (not timeout or float(requested) < timeout):
+            timeout = float(requested)
+        return timeout
+
+
     @staticmethod
     def convert_operator(matchtype):
         """convert the operator into a database operator"""
@@ -122,6 +241,25 @@ class Postsai:
         return operator
 
 
+    @staticmethod
+    def matches_column(value, pattern, matchtype):
+        """checks whether a value matches the pattern in the same way the database would do.
+           The collation of the database ignores case and trailing spaces."""
+
+        operator = Postsai.convert_operator(matchtype)
+        if operator == "=":
+            return value.rstrip(" ").lower() == pattern.rstrip(" ").lower()
+
+        try:
+            found = re.search(pattern, value, re.IGNORECASE) != None
+        except re.error:
+            return False
+
+        if operator == "NOT REGEXP":
+            return not found
+        return found
+
+
     def create_where_for_column(self, column, form, internal_column):
         """create the where part for the specified column with data from the request"""
 
@@ -171,6 +309,160 @@ class Postsai:
                 self.data.append(maxdate)
 
 
+    @staticmethod
+    def is_tag_query(form):
+        """checks whether the commits between two tags are requested"""
+
+        return form.getfirst("fromtag", "") != "" or form.getfirst("totag", "") != ""
+
+
+    # id of the last checkin of the commit a tag points to
+    tag_position_sql = """(SELECT MAX(tagged.id) FROM checkins tagged
+        JOIN commitids tagged_commits ON tagged.commitid = tagged_commits.id
+        JOIN committags ON committags.hash = tagged_commits.hash AND committags.repositoryid = tagged.repositoryid
+        JOIN repositories tagged_repositories ON committags.repositoryid = tagged_repositories.id
+        WHERE tagged_repositories.repository = %s AND committags.tag = %s)"""
+
+
+    def create_where_for_tags(self, form):
+        """restricts the query to the checkins after fromtag up to and including totag.
+           Checkins are ordered by their id, so the (repositoryid, branchid) index is used
+           instead of the date."""
+
+        repository = form.getfirst("repository", "")
+        self.sql = self.sql + " AND repositories.repository = %s"
+        self.data.append(repository)
+
+        fromtag = form.getfirst("fromtag", "")
+        if fromtag != "":
+            self.sql = self.sql + " AND checkins.id > " + self.tag_position_sql
+            self.data.extend([repository, fromtag])
+        totag = form.getfirst("totag", "")
+        if totag != "":
+            self.sql = self.sql + " AND checkins.id <= " + self.tag_position_sql
+            self.data.extend([repository, totag])
+
+
+    def create_where_for_since(self, form):
+        """restricts the query to checkins which were added after the specified checkin id"""
+
+        since = form.getfirst("since", "")
+        if since == "":
+            return
+        self.sql = self.sql + " AND checkins.id > %s"
+        self.data.append(int(since))
+
+        # do not return rows which were added after the last_id was determined
+        if self.last_id != None:
+            self.sql = self.sql + " AND checkins.id <= %s"
+            self.data.append(self.last_id)
+
+
+    @staticmethod
+    def parse_date(value, fallback):
+        """parses a date parameter with optional time"""
+
+        for date_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"):
+            try:
+                return datetime.datetime.strptime(value, date_format)
+            except ValueError:
+                pass
+        return fallback
+
+
+    @staticmethod
+    def estimate_days(form):
+        """estimates the number of days covered by the date filter of the query"""
+
+        if Postsai.is_tag_query(form):
+            # the range of ids is found using an index
+            return 0
+
+        datetype = form.getfirst("date", "day")
+        if (datetype == "none"):
+            return 0
+        elif (datetype == "day"):
+            return 1
+        elif (datetype == "week"):
+            return 7
+        elif (datetype == "month"):
+            return 31
+        elif (datetype == "hours"):
+            try:
+                return float(form.getfirst("hours", "0")) / 24
+            except ValueError:
+                return 0
+        elif (datetype == "explicit"):
+            mindate = Postsai.parse_date(form.getfirst("mindate", ""), datetime.datetime.min)
+            maxdate = Postsai.parse_date(form.getfirst("maxdate", ""), datetime.datetime.now())
+            return max(0, (maxdate - mindate).days + 1)
+
+        # no date filter at all
+        return float("inf")
+
+
+    def create_date_slices(self, form):
+        """splits the date range of explicit queries into slices, starting with the newest one.
+           Grouped queries are not split, because the files of a commit may fall into different slices."""
+
+        if form.getfirst("date", "day") != "explicit" or self.is_tag_query(form) or self.is_grouped_query(form):
+            return []
+        mindate = self.parse_date(form.getfirst("mindate", ""), None)
+        if mindate == None:
+            return []
+        maxdate = datetime.datetime.now()
+        if form.getfirst("maxdate", "") != "":
+            maxdate = self.parse_date(form.getfirst("maxdate", ""), None)
+            # the single query passes formats to MySQL, which parse_date does not know
+            if maxdate == None:
+                return []
+
+        slice_length = datetime.timedelta(days=self.config.get("db", {}).get("slice_days", 30))
+        second = datetime.timedelta(seconds=1)
+        slices = []
+        end = maxdate
+        while end >= mindate:
+            start = max(mindate, end - slice_length + second)
+            slices.append((start.strftime("%Y-%m-%d %H:%M:%S"), end.strftime("%Y-%m-%d %H:%M:%S")))
+            end = start - second
+        return slices
+
+
+    def is_expensive_query(self, form):
+        """classifies a query as expensive, if it covers a wide date range without using indexes"""
+
+        admission = self.config.get("admission", {})
+        if self.estimate_days(form) <= admission.get("cheap_days", 7):
+            return False
+
+        for column in ("branch", "dir", "description", "file", "who", "cvsroot", "repository", "commit", "forked_from"):
+            if form.getfirst(column, "") != "" and self.convert_operator(form.getfirst(column + "type", "match")) != "=":
+                return True
+
+        limit = form.getfirst("limit", "")
+        return limit == "" or int(limit) > admission.get("cheap_limit", 1000)
+
+
+    def admit(self, form):
+        """waits for a free slot for expensive queries, returns None if the server is too busy"""
+
+        slots = QuerySlots(self.config)
+        if "admission" in self.config and self.is_expensive_query(form):
+            if not slots.acquire():
+                return None
+        return slots
+
+
+    @staticmethod
+    def read_last_id(db):
+        """reads the id of the newest checkin, which is used as cursor for polling"""
+
+        rows = db.query("SELECT max(id) FROM checkins", [])
+        if len(rows) == 0 or rows[0][0] == None:
+            return 0
+        return rows[0][0]
+
+
     @staticmethod
     def are_rows_in_same_commit(data, pre):
         """determines if both database rows belong to the same SCM commit"""
@@ -215,40 +507,239 @@ class Postsai:
         return result
 
 
-    def process(self):
-        """processes an API request"""
+    @staticmethod
+    def split_grouped_rows(rows):
+        """Converts rows of commits merged by the database into the result of extract_commits"""
+
+        result = []
+        for row in rows:
+            tmp = Postsai.convert_database_row_to_array(row)
+            tmp[3] = tmp[3].split("\0")
+            tmp[4] = tmp[4].split("\0")
+            result.append(tmp)
+        return result
+
+
+    def execute_query(self, db, form):
+        """executes the query, wide date ranges are split into slices which are queried in parallel.
+           Returns the commits and whether the query was cancelled."""
+
+        read_permission_pattern = self.get_read_permission_pattern()
+        if self.hot_window != None and self.hot_window.can_answer(form, read_permission_pattern):
+            self.hot_window.refresh()
+            return self.extract_commits(self.hot_window.query(form, read_permission_pattern)), False
+
+        workers = self.config.get("db", {}).get("parallel_queries", 0)
+        slices = self.create_date_slices(form)
+        if workers > 1 and len(slices) > 1:
+            queries = []
+            for (mindate, maxdate) in slices:
+                self.create_query(FormOverlay(form, {"mindate" : mindate, "maxdate" : maxdate}))
+                queries.append((self.sql, self.data))
+            limit = form.getfirst("limit", None)
+            if limit:
+                limit = int(limit)
+            rows, timeout = SlicedQueryExecutor(self.config, queries, limit, workers, db.read_only).execute()
+        else:
+            self.create_query(form)
+            rows, timeout = db.query_with_timeout(self.sql, self.data, self.get_timeout(form))
+
+        if self.is_grouped_query(form):
+            return self.split_grouped_rows(rows), timeout
+        return self.extract_commits(rows), timeout
+
+
+    def read_repositories(self, db):
+        """reads the configuration of all repositories which may be read"""
+
+        return db.read_repositories(self.get_read_permission_pattern())
+
+
+    def create_core_result(self, db, form, repositories):
+        """executes the query and creates the part of the result, which does not depend on extensions"""
+
+        rows, timeout = self.execute_query(db, form)
+        return {
+            "data" : rows,
+            "repositories": repositories,
+            "last_id": self.last_id,
+            "timeout": timeout
+        }
+
+
+    def read_contribution(self, cache, name, extension, form):
+        """returns the cached contribution of an extension, the cache key and the generation.
+           The key is None, if the extension does not declare the contribution cacheable."""
 
+        key_function = getattr(extension, "query_contribution_key", None)
+        if key_function == None or not cache.is_enabled():
+            return None, None, None
+        key = key_function(self, form)
+        if key == None:
+            return None, None, None
+
+        key = json.dumps(["contribution", name, self.get_read_permission_pattern(), key])
+        if getattr(extension, "query_contribution_invalidation", "import") == "repositories":
+            generation = cache.read_repositories_generation()
+        else:
+            generation = cache.read_generation()
+        return cache.get(key, generation), key, generation
+
+
+    def add_contributions(self, db, form, result):
+        """adds the contributions of extensions to the result.
+
+           An extension contributes with query_contribution(postsai, form, db), which returns a dict for
+           result["extension"]. If it implements query_contribution_key(postsai, form), the contribution is
+           cached under the returned key until the next import, or until a repository is added if its
+           query_contribution_invalidation is "repositories". A key of None disables the cache for the form."""
+
+        hooks = self.extension_manager.get_hooks("query_contribution")
+        if len(hooks) == 0:
+            return
+
+        cache = QueryResultCache(self.config)
+        own_db = None
+        for (name, method_pointer) in hooks:
+            contribution, key, generation = self.read_contribution(
+                cache, name, self.extension_manager.get_extension(name), form)
+            if contribution == None:
+                Metrics.increment("postsai_contribution_cache_total", 1, {"result": "miss"})
+                if db == None:
+                    own_db = PostsaiDB(self.config, read_only=True)
+                    own_db.connect()
+                    db = own_db
+                start = time.time()
+                contribution = method_pointer(self, form, db)
+                self.extension_manager.record_timing(name, "query_contribution", time.time() - start)
+                if key != None:
+                    cache.put(key, generation, contribution)
+            else:
+                Metrics.increment("postsai_contribution_cache_total", 1, {"result": "hit"})
+            result["extension"].update(contribution)
+
+        if own_db != None:
+            own_db.disconnect()
+
+
+    def complete_result(self, db, form, result):
+        """adds the configuration and the contributions of extensions to the result"""
+
+        ui = {}
+        if "ui" in self.config:
+            ui = self.config['ui']
+
+        result["config"] = ui
+        result["extension"] = {}
+        result["additional_scripts"] = self.extension_manager.list_extension_files("query.js")
+        self.add_contributions(db, form, result)
+        self.extension_manager.call_all("query_post_process_result", [self, form, db, result])
+        return result
+
+
+    def create_result(self, db, form, repositories):
+        """executes the query and creates the result including the contributions of extensions"""
+
+        return self.complete_result(db, form, self.create_core_result(db, form, repositories))
+
+
+    def is_affected_by_import(self, form, repositories):
+        """checks whether the result of a query may have been changed by an import into the repositories"""
+
+        for column in ("repository", "cvsroot"):
+            pattern = form.getfirst(column, "")
+            if pattern == "":
+                continue
+            matchtype = form.getfirst(column + "type", "match")
+            if not [repository for repository in repositories if self.matches_column(repository, pattern, matchtype)]:
+                return False
+        return True
+
+
+    def prewarm(self, repositories):
+        """recomputes the cached results of popular queries after an import into the repositories"""
+
+        cache = QueryResultCache(self.config)
+        cache.remove_outdated()
+        generation = cache.read_generation()
+        previous_generation = cache.read_previous_generation()
+        db = None
+        for key in cache.find_popular_queries():
+            self.read_permission_pattern, params = cache.parse_key(key)
+            form = FormOverlay(None, params)
+            if not self.is_affected_by_import(form, repositories):
+                cache.carry_over(key, previous_generation, generation)
+                continue
+
+            if db == None:
+                db = PostsaiDB(self.config)
+                db.connect()
+            self.last_id = self.read_last_id(db)
+            result = self.create_core_result(db, form, self.read_repositories(db))
+            if not result["timeout"]:
+                cache.put(key, generation, result)
+
+        if db != None:
+            db.disconnect()
+
+
+    def print_busy_response(self):
+        """tells the client to retry later because too many expensive queries are running"""
+
+        print("Status: 503 Service Unavailable\r")
+        print("Retry-After: " + str(self.config["admission"].get("retry_after", 30)) + "\r")
         print("Content-Type: text/json; charset='utf-8'\r")
-        print("Cache-Control: max-age=60\r")
         print("\r")
-        form = cgi.FieldStorage()
+        print(json.dumps("The server is busy with expensive queries, please try again later."))
+
+
+    def process(self, form):
+        """processes an API request"""
 
         result = self.validate_input(form)
 
         if result == "":
-            self.create_query(form)
-
-            db = PostsaiDB(self.config)
-            db.connect()
-            rows = self.extract_commits(db.query(self.sql, self.data))
-            repositories = db.query_as_double_map(
-                "SELECT id, repository, base_url, file_url, commit_url, tracker_url, icon_url FROM repositories WHERE repositories.repository REGEXP %s",
-                "repository",
-                [self.get_read_permission_pattern()])
-
-            ui = {}
-            if "ui" in self.config:
-                ui = self.config['ui']
-
-            result = {
-                "config" : ui,
-                "data" : rows,
-                "repositories": repositories,
-                "extension": {},
-                "additional_scripts": self.extension_manager.list_extension_files("query.js")
-            }
-            self.extension_manager.call_all("query_post_process_result", [self, form, db, result])
+            cache = QueryResultCache(self.config)
+            key = cache.create_key(form, self.get_read_permission_pattern())
+            # polls for new commits are not worth prewarming, their since parameter changes with every import
+            if form.getfirst("since", "") == "":
+                cache.record(key)
+            generation = cache.read_generation()
+
+            db = None
+            result = cache.get(key, generation)
+            if result == None:
+                Metrics.increment("postsai_result_cache_total", 1, {"result": "miss"})
+                slots = self.admit(form)
+                if slots == None:
+                    Metrics.increment("postsai_rejected_queries_total")
+                    self.print_busy_response()
+                    return
+
+                try:
+                    db = PostsaiDB(self.config, read_only=True)
+                    db.connect()
+                    self.last_id = self.read_last_id(db)
+                    result = self.create_core_result(db, form, self.read_repositories(db))
+                finally:
+                    slots.release()
+                # results of a lagging replica might miss the last import
+                if not result["timeout"] and db.replica_lag == 0:
+                    cache.put(key, generation, result)
+                if result["timeout"]:
+                    Metrics.increment("postsai_query_timeouts_total")
+            else:
+                Metrics.increment("postsai_result_cache_total", 1, {"result": "hit"})
+                if self.extension_manager.has_method("query_post_process_result"):
+                    # extensions may use the database
+                    db = PostsaiDB(self.config, read_only=True)
+                    db.connect()
 
-            db.disconnect()
+            result = self.complete_result(db, form, result)
+            if db != None:
+                db.disconnect()
 
+        print("Content-Type: text/json; charset='utf-8'\r")
+        print("Cache-Control: max-age=60\r")
+        print("\r")
         print(json.dumps(result, default=convert_to_builtin_type))
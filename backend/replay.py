@@ -0,0 +1,106 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import base64
+import fcntl
+import json
+import StringIO
+import time
+
+
+class ReplayLog:
+    """Records the query strings and webhook bodies of requests, so that loadtest.py
+       can replay the real mix of queries and imports against a test instance."""
+
+    # streams and administrative requests are not part of the load
+    ignored_methods = ["feed", "metrics", "profile"]
+
+
+    def __init__(self, config):
+        """Creates a ReplayLog instance"""
+
+        self.replay_config = config.get("replay_log", {})
+        self.filename = self.replay_config.get("file", "")
+
+
+    def is_enabled(self):
+        """checks whether a replay log file is configured"""
+
+        return self.filename != ""
+
+
+    @staticmethod
+    def buffer_body(environ, stdin):
+        """reads the body of POST requests, returns it and a replacement for stdin"""
+
+        if environ.get("REQUEST_METHOD", "") != "POST":
+            return None, stdin
+        body = stdin.read()
+        return body, StringIO.StringIO(body)
+
+
+    def record(self, method, environ, body):
+        """appends a request to the log"""
+
+        if not self.is_enabled() or method in self.ignored_methods:
+            return
+
+        # bodies are stored as base64, because they do not have to be valid UTF-8
+        if body != None:
+            body = base64.b64encode(body)
+        try:
+            entry = json.dumps({
+                "time": time.time(),
+                "method": method,
+                "query": environ.get("QUERY_STRING", ""),
+                "body": body
+            })
+        except UnicodeDecodeError:
+            # the query string is not valid UTF-8 and cannot be replayed
+            return
+        with open(self.filename, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(entry + "\n")
+            f.flush()
+
+            # keep the newer half of the log
+            if f.tell() > self.replay_config.get("max_size", 104857600):
+                with open(self.filename, "r") as r:
+                    lines = r.readlines()
+                f.truncate(0)
+                f.writelines(lines[len(lines) // 2:])
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    @staticmethod
+    def read_entries(filename):
+        """returns the recorded requests in the order of their arrival"""
+
+        entries = []
+        with open(filename, "r") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # incomplete line of a request, which was recorded while the log was read
+                    pass
+        return entries
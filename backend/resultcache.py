@@ -0,0 +1,271 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import time
+
+
+def convert_to_builtin_type(obj):
+    """return a string representation for JSON conversation"""
+
+    return str(obj)
+
+
+class QueryResultCache:
+    """Caches query results in files, which are shared by all processes on this host.
+
+       Every import starts a new generation, which invalidates all cached results.
+       The keys of executed queries are logged to find popular queries."""
+
+    # parameters which do not influence the result
+    ignored_parameters = ["_", "method"]
+
+
+    def __init__(self, config):
+        """Creates a QueryResultCache instance"""
+
+        self.cache_config = config.get("result_cache", {})
+        self.folder = self.cache_config.get("folder", "")
+
+
+    def is_enabled(self):
+        """checks whether a cache folder is configured"""
+
+        return self.folder != ""
+
+
+    def create_folder(self):
+        """creates the cache folder, if it does not exist"""
+
+        if not os.path.isdir(self.folder):
+            try:
+                os.makedirs(self.folder)
+            except OSError:
+                # created by another process in the meantime
+                pass
+
+
+    def create_key(self, form, read_permission_pattern):
+        """creates the cache key from the read permission and the query parameters"""
+
+        params = []
+        for key in sorted(form.keys()):
+            if not key in self.ignored_parameters:
+                params.append([key, form.getfirst(key, "")])
+        return json.dumps([read_permission_pattern, params])
+
+
+    @staticmethod
+    def parse_key(key):
+        """returns the read permission pattern and the query parameters of a cache key"""
+
+        (read_permission_pattern, params) = json.loads(key)
+        return read_permission_pattern, dict(params)
+
+
+    def filename(self, key):
+        """returns the name of the file for the cache key"""
+
+        return self.folder + "/" + hashlib.md5(key.encode("utf-8")).hexdigest() + ".json"
+
+
+    def read_generation(self):
+        """returns the current generation, which changes on every import"""
+
+        try:
+            return os.path.getmtime(self.folder + "/generation")
+        except OSError:
+            return 0
+
+
+    def invalidate(self):
+        """starts a new generation"""
+
+        if not self.is_enabled():
+            return
+        self.create_folder()
+        previous = self.read_generation()
+        with open(self.folder + "/generation", "w") as f:
+            f.write(repr(previous))
+        now = time.time()
+        if now <= previous:
+            # the file system might only store full seconds
+            now = previous + 1
+        os.utime(self.folder + "/generation", (now, now))
+
+
+    def read_repositories_generation(self):
+        """returns the generation of the repositories table, which changes when repositories are added"""
+
+        try:
+            return os.path.getmtime(self.folder + "/repositories")
+        except OSError:
+            return 0
+
+
+    def invalidate_repositories(self):
+        """marks the repositories table as changed"""
+
+        if not self.is_enabled():
+            return
+        self.create_folder()
+        previous = self.read_repositories_generation()
+        open(self.folder + "/repositories", "a").close()
+        now = time.time()
+        if now <= previous:
+            now = previous + 1
+        os.utime(self.folder + "/repositories", (now, now))
+
+
+    def read_previous_generation(self):
+        """returns the generation before the last import"""
+
+        try:
+            with open(self.folder + "/generation", "r") as f:
+                return float(f.read())
+        except (IOError, ValueError):
+            return 0
+
+
+    def read_entry(self, key):
+        """reads a cache entry including its meta data"""
+
+        try:
+            with open(self.filename(key), "r") as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if entry["key"] != key:
+            return None
+        return entry
+
+
+    def write_entry(self, entry):
+        """writes a cache entry, so that readers never see a partial file"""
+
+        self.create_folder()
+        filename = self.filename(entry["key"])
+        temp_filename = filename + "." + str(os.getpid())
+        with open(temp_filename, "w") as f:
+            json.dump(entry, f, default=convert_to_builtin_type)
+        os.rename(temp_filename, filename)
+
+
+    def get(self, key, generation):
+        """returns the cached result, if it belongs to the generation and is not too old"""
+
+        if not self.is_enabled():
+            return None
+        entry = self.read_entry(key)
+        if entry == None or entry["generation"] != generation:
+            return None
+        if time.time() - entry["created"] > self.cache_config.get("max_age", 300):
+            return None
+        return entry["result"]
+
+
+    def put(self, key, generation, result):
+        """stores a result, which was computed in the specified generation"""
+
+        if not self.is_enabled():
+            return
+
+        self.write_entry({
+            "key": key,
+            "generation": generation,
+            "created": time.time(),
+            "result": result
+        })
+
+
+    def remove_outdated(self):
+        """removes entries, which are never read again, because they belong to an older generation
+           or are past max_age. Entries of the previous generation are kept for carry_over."""
+
+        if not self.is_enabled() or not os.path.isdir(self.folder):
+            return
+
+        # entries are written after the start of their generation
+        previous_generation = self.read_previous_generation()
+        oldest = time.time() - self.cache_config.get("max_age", 300)
+        for name in os.listdir(self.folder):
+            if re.match(r"^[0-9a-f]{32}\.json", name) == None:
+                continue
+            try:
+                modified = os.path.getmtime(self.folder + "/" + name)
+                if modified < previous_generation or modified < oldest:
+                    os.remove(self.folder + "/" + name)
+            except OSError:
+                # removed by another process in the meantime
+                pass
+
+
+    def carry_over(self, key, previous_generation, generation):
+        """moves an entry, which is not affected by an import, into the new generation"""
+
+        entry = self.read_entry(key)
+        if entry != None and entry["generation"] == previous_generation:
+            entry["generation"] = generation
+            self.write_entry(entry)
+
+
+    def record(self, key):
+        """logs the execution of a query to find popular queries"""
+
+        if not self.is_enabled() or self.cache_config.get("prewarm", 0) == 0:
+            return
+
+        self.create_folder()
+        with open(self.folder + "/queries.log", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(key + "\n")
+            f.flush()
+
+            # keep the newer half of the log
+            if f.tell() > self.cache_config.get("max_log_size", 1048576):
+                with open(self.folder + "/queries.log", "r") as r:
+                    lines = r.readlines()
+                f.truncate(0)
+                f.writelines(lines[len(lines) // 2:])
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def find_popular_queries(self):
+        """returns the keys of the most frequently executed queries"""
+
+        try:
+            with open(self.folder + "/queries.log", "r") as f:
+                lines = f.readlines()
+        except IOError:
+            return []
+
+        counts = {}
+        for line in lines:
+            key = line.rstrip("\n")
+            counts[key] = counts.get(key, 0) + 1
+        popular = sorted(counts.keys(), key=lambda key: counts[key], reverse=True)
+        return popular[0:self.cache_config.get("prewarm", 0)]
@@ -0,0 +1,228 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import Queue
+import StringIO
+import sys
+import threading
+import traceback
+
+from db import ConnectionPool, PostsaiDB
+from extension import ExtensionManager
+from feed import PostsaiFeed
+from hotwindow import HotWindow
+from query import Postsai
+from suggest import PostsaiSuggestions, SuggestionIndex
+
+
+class ThreadLocalOutput:
+    """Replaces sys.stdout, so that every request thread writes into its own response"""
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+
+    def set_target(self, target):
+        """redirects the output of the current thread, None restores the default"""
+
+        self.local.target = target
+
+
+    def target(self):
+        """returns the stream of the current thread"""
+
+        return getattr(self.local, "target", None) or self.default
+
+
+    def write(self, data):
+        self.target().write(data)
+
+
+    def flush(self):
+        self.target().flush()
+
+
+
+class ResponseWriter:
+    """Collects the output of a request and passes it to the server on every flush"""
+
+    def __init__(self):
+        self.chunks = Queue.Queue()
+        self.buffer = []
+        self.closed = False
+
+
+    def write(self, data):
+        if self.closed:
+            raise IOError("client disconnected")
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.buffer.append(data)
+
+
+    def flush(self):
+        if self.closed:
+            raise IOError("client disconnected")
+        if len(self.buffer) > 0:
+            self.chunks.put("".join(self.buffer))
+            self.buffer = []
+
+
+    def finish(self, error=None):
+        """sends the remaining output and marks the end of the response"""
+
+        if len(self.buffer) > 0:
+            self.chunks.put("".join(self.buffer))
+            self.buffer = []
+        self.chunks.put(error)
+
+
+
+class PostsaiApplication:
+    """Serves requests as WSGI application in a long-lived server.
+
+       Configuration and extensions are loaded once and database connections
+       are kept in a pool. Requests are processed by the same code as in
+       CGI mode, in a thread of their own, so that streamed responses like the
+       feed are passed on as soon as they are flushed."""
+
+    def __init__(self, config, dispatch):
+        """Creates a PostsaiApplication instance, dispatch processes a request in CGI mode"""
+
+        self.config = config
+        self.dispatch = dispatch
+        ExtensionManager.keep_loaded = True
+        ExtensionManager(config)
+        PostsaiDB.pool = ConnectionPool(config, PostsaiDB(config).open_session)
+        PostsaiDB.replica_pools = []
+        for replica in config.get("db", {}).get("replicas", []):
+            db = PostsaiDB(config)
+            db.server = db.get_replica_config(replica)
+            PostsaiDB.replica_pools.append(ConnectionPool(config, db.open_session))
+        if not isinstance(sys.stdout, ThreadLocalOutput):
+            sys.stdout = ThreadLocalOutput(sys.stdout)
+
+        # the window is updated from the feed, so it requires the feed
+        if "hot_window" in config and PostsaiFeed(config).is_enabled():
+            hot_window = HotWindow(config)
+            db = PostsaiDB(config)
+            db.connect()
+            hot_window.load(db)
+            db.disconnect()
+            Postsai.hot_window = hot_window
+
+        if "suggestions" in config:
+            PostsaiSuggestions.index = SuggestionIndex(config)
+
+
+    @staticmethod
+    def create_cgi_environ(environ):
+        """converts the WSGI environment into the environment of a CGI request"""
+
+        cgi_environ = {}
+        for key, value in environ.items():
+            if isinstance(value, str):
+                cgi_environ[key] = value
+        return cgi_environ
+
+
+    def process(self, environ, stdin, writer):
+        """processes a request in the current thread"""
+
+        sys.stdout.set_target(writer)
+        Postsai.request.environ = environ
+        try:
+            self.dispatch(self.config, environ, stdin)
+            writer.finish()
+        except IOError:
+            # the client has disconnected
+            writer.finish()
+        except Exception as err:
+            traceback.print_exc(file=sys.stderr)
+            writer.finish(err)
+        finally:
+            sys.stdout.set_target(None)
+            Postsai.request.environ = None
+            PostsaiDB.release_thread()
+
+
+    @staticmethod
+    def parse_headers(header):
+        """parses the CGI headers into a WSGI status and header list"""
+
+        status = "200 OK"
+        headers = []
+        for line in header.split("\r\n"):
+            if line.strip() == "":
+                continue
+            (name, value) = line.split(":", 1)
+            if name.lower() == "status":
+                status = value.strip()
+            else:
+                headers.append((name, value.strip()))
+        return status, headers
+
+
+    def __call__(self, environ, start_response):
+        """processes a WSGI request"""
+
+        length = environ.get("CONTENT_LENGTH", "")
+        body = ""
+        if length.isdigit():
+            body = environ["wsgi.input"].read(int(length))
+
+        writer = ResponseWriter()
+        thread = threading.Thread(target=self.process,
+                                  args=(self.create_cgi_environ(environ), StringIO.StringIO(body), writer))
+        thread.daemon = True
+        thread.start()
+
+        # the CGI output starts with the headers
+        output = ""
+        while output.find("\r\n\r\n") < 0:
+            chunk = writer.chunks.get()
+            if chunk == None or isinstance(chunk, Exception):
+                start_response("500 Internal Server Error", [("Content-Type", "text/plain")])
+                return ["Internal Server Error"]
+            output = output + chunk
+        (header, output) = output.split("\r\n\r\n", 1)
+        status, headers = self.parse_headers(header)
+        start_response(status, headers)
+        return self.stream_body(writer, output)
+
+
+    @staticmethod
+    def stream_body(writer, output):
+        """passes on the output of the request thread"""
+
+        try:
+            if output != "":
+                yield output
+            while True:
+                chunk = writer.chunks.get()
+                if chunk == None or isinstance(chunk, Exception):
+                    return
+                yield chunk
+        finally:
+            # stops the request thread on its next output, if the client has disconnected
+            writer.closed = True
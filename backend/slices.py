@@ -0,0 +1,142 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import threading
+
+from db import PostsaiDB
+
+
+class SlicedQueryExecutor:
+    """Executes the queries for consecutive time slices on several database connections.
+
+       The queries have to be ordered from the newest to the oldest slice, so
+       concatenating their results keeps the order of a single query."""
+
+    def __init__(self, config, queries, limit, workers, read_only=False):
+        """Creates a SlicedQueryExecutor for a list of (sql, data) tuples"""
+
+        self.config = config
+        self.read_only = read_only
+        self.queries = queries
+        self.limit = limit
+        self.workers = workers
+        self.results = {}
+        self.next_index = 0
+        self.stopped = False
+        self.running = {}
+        self.condition = threading.Condition()
+
+
+    def take_next_index(self):
+        """returns the index of the next query to execute, or None if there is nothing left to do"""
+
+        with self.condition:
+            if self.stopped or self.next_index >= len(self.queries):
+                return None
+            index = self.next_index
+            self.next_index = self.next_index + 1
+            return index
+
+
+    def work(self):
+        """executes queries until all of them are done or the executor was stopped"""
+
+        db = PostsaiDB(self.config, self.read_only)
+        try:
+            db.connect()
+        except Exception as err:
+            # report the failure as result of a query, so that nobody waits for it forever
+            index = self.take_next_index()
+            if index != None:
+                with self.condition:
+                    self.results[index] = err
+                    self.condition.notify_all()
+            return
+
+        try:
+            index = self.take_next_index()
+            while index != None:
+                with self.condition:
+                    self.running[index] = db
+                sql, data = self.queries[index]
+                try:
+                    result = db.query(sql, data)
+                except Exception as err:
+                    result = err
+                with self.condition:
+                    del self.running[index]
+                    self.results[index] = result
+                    self.condition.notify_all()
+                index = self.take_next_index()
+        finally:
+            db.disconnect()
+
+
+    def stop(self):
+        """stops the execution of further queries and cancels running ones"""
+
+        with self.condition:
+            self.stopped = True
+            running = self.running.values()
+        for db in running:
+            try:
+                db.kill_query()
+            except Exception:
+                # the query might have completed in the meantime
+                pass
+
+
+    def wait_for_result(self, index):
+        """waits for the result of the query with the specified index"""
+
+        with self.condition:
+            while not index in self.results:
+                # wait with a timeout, so that signals are processed
+                self.condition.wait(0.1)
+            return self.results[index]
+
+
+    def execute(self):
+        """executes the queries and returns the merged rows and whether the deadline was exceeded.
+           Stops as soon as the limit is reached."""
+
+        for i in range(min(self.workers, len(self.queries))):
+            thread = threading.Thread(target=PostsaiDB.record_in_thread(self.work))
+            thread.daemon = True
+            thread.start()
+
+        rows = []
+        for index in range(len(self.queries)):
+            result = self.wait_for_result(index)
+            if isinstance(result, Exception):
+                self.stop()
+                # return the rows of the newer slices, if the deadline was exceeded
+                args = getattr(result, "args", None) or [None]
+                if args[0] in (PostsaiDB.ER_QUERY_INTERRUPTED, PostsaiDB.ER_QUERY_TIMEOUT):
+                    return rows, True
+                raise result
+            rows.extend(result)
+            if self.limit and len(rows) >= self.limit:
+                self.stop()
+                return rows[0:self.limit], False
+
+        return rows, False
@@ -0,0 +1,264 @@
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import bisect
+import json
+import threading
+import time
+
+from db import PostsaiDB
+from query import FormOverlay, Postsai
+
+
+class PrefixIndex:
+    """A sorted array of the values of a lookup table for case insensitive prefix searches"""
+
+    def __init__(self):
+        self.keys = []
+        self.entries = []
+
+
+    def add(self, rows):
+        """adds (id, value) rows"""
+
+        if len(rows) == 0:
+            return
+        self.entries.extend([(value.lower(), value, id) for (id, value) in rows if value != None])
+        # new values are appended in id order, so this is mostly a merge of two sorted runs
+        self.entries.sort()
+        self.keys = [entry[0] for entry in self.entries]
+
+
+    def find(self, prefix, accept, limit):
+        """returns up to limit values, which start with the prefix and whose id is accepted"""
+
+        prefix = prefix.lower()
+        result = []
+        i = bisect.bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(result) < limit and self.keys[i].startswith(prefix):
+            if accept(self.entries[i][2]):
+                result.append(self.entries[i][1])
+            i = i + 1
+        return result
+
+
+
+class SuggestionIndex:
+    """Keeps the lookup tables in memory for long-lived server processes.
+
+       For every value the ids of the repositories it was used in are remembered,
+       so that suggestions can be filtered by the read permission. The index is
+       updated incrementally with the rows, which were added since the last refresh."""
+
+    # column: (lookup table, column in the checkins table)
+    columns = {
+        "repository": ("repositories", "repositoryid"),
+        "who": ("people", "whoid"),
+        "branch": ("branches", "branchid"),
+        "dir": ("dirs", "dirid"),
+        "file": ("files", "fileid")
+    }
+
+
+    def __init__(self, config):
+        """Creates an empty SuggestionIndex"""
+
+        self.refresh_interval = config.get("suggestions", {}).get("refresh_interval", 10)
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.indexes = {}
+        self.repositories_of = {}
+        self.last_ids = {}
+        for column in self.columns.keys():
+            self.indexes[column] = PrefixIndex()
+            self.repositories_of[column] = {}
+            self.last_ids[column] = 0
+        self.repository_names = {}
+        self.permitted = {}
+        self.last_checkin_id = 0
+        self.refreshed = 0
+
+
+    def add_values(self, column, rows):
+        """adds (id, value) rows of a lookup table"""
+
+        with self.lock:
+            self.indexes[column].add(rows)
+            for (id, value) in rows:
+                self.last_ids[column] = max(self.last_ids[column], id)
+                if column == "repository":
+                    self.repository_names[id] = value
+                    self.repositories_of[column][id] = set([id])
+                    self.permitted = {}
+
+
+    def add_usage(self, column, rows):
+        """adds (value id, repository id) rows, which tell in which repositories a value was used"""
+
+        with self.lock:
+            repositories_of = self.repositories_of[column]
+            for (id, repositoryid) in rows:
+                repositories_of.setdefault(id, set()).add(repositoryid)
+
+
+    def is_refresh_due(self):
+        """checks whether the last refresh is older than the refresh interval"""
+
+        return time.time() - self.refreshed >= self.refresh_interval
+
+
+    def refresh(self, db):
+        """reads the rows, which were added since the last refresh"""
+
+        # concurrent refreshes would add the same rows twice
+        with self.refresh_lock:
+            self.refreshed = time.time()
+            for column, (table, id_column) in self.columns.items():
+                rows = db.query("SELECT id, " + column + " FROM " + table + " WHERE id > %s", [self.last_ids[column]])
+                self.add_values(column, rows)
+
+            rows = db.query("SELECT MAX(id) FROM checkins", [])
+            last_checkin_id = rows[0][0] or 0
+            for column, (table, id_column) in self.columns.items():
+                if column != "repository":
+                    rows = db.query("SELECT DISTINCT " + id_column + ", repositoryid FROM checkins WHERE id > %s AND id <= %s",
+                                    [self.last_checkin_id, last_checkin_id])
+                    self.add_usage(column, rows)
+            self.last_checkin_id = last_checkin_id
+
+
+    def find_permitted_repositories(self, read_permission_pattern):
+        """returns the ids of the repositories, which may be read"""
+
+        permitted = self.permitted.get(read_permission_pattern)
+        if permitted == None:
+            permitted = set()
+            for id, name in self.repository_names.items():
+                if Postsai.matches_column(name, read_permission_pattern, "regexp"):
+                    permitted.add(id)
+            self.permitted[read_permission_pattern] = permitted
+        return permitted
+
+
+    def query(self, column, prefix, read_permission_pattern, limit):
+        """returns values starting with the prefix, which were used in readable repositories"""
+
+        with self.lock:
+            permitted = self.find_permitted_repositories(read_permission_pattern)
+            repositories_of = self.repositories_of[column]
+            accept = lambda id: not permitted.isdisjoint(repositories_of.get(id, ()))
+            return self.indexes[column].find(prefix, accept, limit)
+
+
+
+class PostsaiSuggestions:
+    """Suggests values for the fields of the search form.
+
+       Long-lived servers set an in memory SuggestionIndex, otherwise the
+       unique indexes of the lookup tables are searched with LIKE."""
+
+    # set by long-lived servers
+    index = None
+
+
+    def __init__(self, config):
+        """Creates a PostsaiSuggestions instance"""
+
+        self.config = config
+
+
+    @staticmethod
+    def escape_like(value):
+        """escapes the wildcards of LIKE"""
+
+        return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+    @staticmethod
+    def get_limit(form):
+        """returns the number of suggestions requested by the client, between 1 and 100"""
+
+        try:
+            limit = int(form.getfirst("limit", "20"))
+        except ValueError:
+            limit = 20
+        return max(1, min(limit, 100))
+
+
+    def query_database(self, db, column, prefix, read_permission_pattern, limit):
+        """searches the lookup table of the column"""
+
+        (table, id_column) = SuggestionIndex.columns[column]
+        sql = "SELECT " + column + " FROM " + table + " WHERE " + column + " LIKE %s"
+        data = [self.escape_like(prefix) + "%"]
+        if column == "repository":
+            sql = sql + " AND repository REGEXP %s"
+            data.append(read_permission_pattern)
+        elif read_permission_pattern != ".*":
+            sql = sql + """ AND EXISTS (SELECT 1 FROM checkins JOIN repositories ON checkins.repositoryid = repositories.id
+                WHERE checkins.""" + id_column + " = " + table + ".id AND repositories.repository REGEXP %s)"
+            data.append(read_permission_pattern)
+        sql = sql + " ORDER BY " + column + " LIMIT %s"
+        data.append(limit)
+        return [row[0] for row in db.query(sql, data)]
+
+
+    def suggest(self, column, prefix, limit):
+        """returns the suggestions for a prefix"""
+
+        if not column in SuggestionIndex.columns or prefix == "":
+            return []
+
+        read_permission_pattern = Postsai.get_configured_read_permission_pattern(self.config)
+        if self.index != None and not self.index.is_refresh_due():
+            return self.index.query(column, prefix, read_permission_pattern, limit)
+
+        db = PostsaiDB(self.config)
+        db.connect()
+        if self.index != None:
+            self.index.refresh(db)
+            result = self.index.query(column, prefix, read_permission_pattern, limit)
+        else:
+            result = self.query_database(db, column, prefix, read_permission_pattern, limit)
+        db.disconnect()
+        return result
+
+
+    def process(self, form):
+        """processes a suggestion request"""
+
+        # the prefix is checked like a query on its column
+        column = form.getfirst("column", "")
+        result = Postsai(self.config).validate_input(FormOverlay(form, {column: form.getfirst("prefix", "")}))
+        if result != "":
+            print("Status: 403 Forbidden\r")
+            print("Content-Type: text/plain; charset='utf-8'\r")
+            print("\r")
+            print(result)
+            return
+
+        suggestions = self.suggest(column, form.getfirst("prefix", ""), self.get_limit(form))
+
+        print("Content-Type: text/json; charset='utf-8'\r")
+        print("Cache-Control: max-age=60\r")
+        print("\r")
+        print(json.dumps({"column": column, "suggestions": suggestions}))
@@ -0,0 +1,85 @@
+#! /usr/bin/python
+
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import subprocess
+import sys
+import time
+
+
+# modules which api.py imports for each method
+handlers = [
+    ["query", ["cgi", "backend.query"]],
+    ["bootstrap", ["cgi", "backend.bootstrap"]],
+    ["activity", ["cgi", "backend.activity"]],
+    ["history", ["cgi", "backend.history"]],
+    ["suggest", ["cgi", "backend.suggest"]],
+    ["feed", ["cgi", "backend.feed"]],
+    ["commit", ["cgi", "backend.cvs"]],
+    ["metrics", ["cgi", "backend.metrics"]],
+    ["profile", ["cgi", "backend.profiling"]],
+    ["batch", ["json", "urlparse", "backend.batch"]],
+    ["import", ["json", "urlparse", "backend.importer"]],
+    ["database driver", ["MySQLdb"]]
+]
+
+# executed in a new interpreter, so that nothing is imported yet
+measure = """
+import sys
+import time
+start = time.time()
+before = set(sys.modules.keys())
+import api
+for name in sys.argv[1:]:
+    __import__(name)
+print("%f %d" % (time.time() - start, len(set(sys.modules.keys()) - before)))
+"""
+
+
+def run(modules):
+    """returns the import time in milliseconds, the total time of the process and the number of imported modules"""
+
+    start = time.time()
+    output = subprocess.check_output([sys.executable, "-c", measure] + modules)
+    total = (time.time() - start) * 1000
+    (seconds, count) = output.split()
+    return float(seconds) * 1000, total, int(count)
+
+
+def median(values):
+    """returns the median of a list of numbers"""
+
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+# measures the cold start of api.py for every method, like CGI does on every request
+if __name__ == '__main__':
+    repetitions = 20
+    if len(sys.argv) > 1:
+        repetitions = int(sys.argv[1])
+
+    print("%-16s %10s %10s %8s" % ("method", "import ms", "total ms", "modules"))
+    for (method, modules) in handlers:
+        results = [run(modules) for i in range(repetitions)]
+        print("%-16s %10.1f %10.1f %8d" % (method, median([result[0] for result in results]),
+                                            median([result[1] for result in results]), results[0][2]))
@@ -45,7 +45,13 @@ db = {
     "host" : "localhost",
     "user" : "postsaiuser",
     "password" : "postsaipassword",
-    "database" : "postsaidb"
+    "database" : "postsaidb",
+    # "query_timeout" : 30, # seconds
+    # "import_lock_timeout" : 60, # seconds an import waits for concurrent imports
+    # "parallel_queries" : 4, # split explicit date ranges into slices of "slice_days" days
+    # "pool" : { "max_size" : 10, "max_idle" : 300 }, # connections kept by wsgi.py and serve.py
+    # "replicas" : [{ "host" : "replica1" }, { "host" : "replica2" }], # for queries, other parameters default to the primary
+    # "max_replica_lag" : 30 # seconds, the replica user needs the REPLICATION CLIENT privilege
 }
 
 ui = {
@@ -54,6 +60,58 @@ ui = {
     "trim_email" : True
 }
 
+# admission = {
+#     "max_expensive_queries" : 2 # wide regexp queries executed at the same time
+# }
+
+# result_cache = {
+#     "folder" : "/var/tmp/postsai-cache",
+#     "prewarm" : 10 # number of popular queries to recompute after an import
+# }
+
+# feed = {
+#     "file" : "/var/tmp/postsai-feed.json" # enables api.py?method=feed
+# }
+
+# metrics = {
+#     "file" : "/var/tmp/postsai-metrics.json", # enables api.py?method=metrics for Prometheus
+#     "allowed_addresses" : [], # e.g. ["127.0.0.1"], but behind a reverse proxy every client seems local
+#     "token" : "" # a long random secret, clients send "Authorization: Bearer <token>"
+# }
+
+# profiling = {
+#     "folder" : "/var/tmp/postsai-profiles", # enables profile=1 and api.py?method=profile
+#     "allowed_addresses" : [], # e.g. ["127.0.0.1"], but behind a reverse proxy every client seems local
+#     "token" : "", # a long random secret, clients send "Authorization: Bearer <token>"
+#     "top" : 30, # functions and SQL statements in the summary
+#     "keep" : 20 # number of stored profiles
+# }
+
+# replay_log = {
+#     "file" : "/var/tmp/postsai-replay.log", # records queries and webhooks for loadtest.py
+#     "max_size" : 104857600 # bytes
+# }
+
+# lookup_table = {
+#     "file" : "/var/tmp/postsai-lookup", # ids of people, branches, ... shared by all processes
+#     "entries" : 131072 # fixed when the file is created
+# }
+
+# extensions = {
+#     "slow_hook_ms" : 1000 # logs slower extension methods to the error log of the web server
+# }
+
+# only used by the long-lived servers in wsgi.py and serve.py
+# server = {
+#     "workers" : 8 # threads for database queries of serve.py
+# }
+# hot_window = {
+#     "days" : 7 # keeps recent commits in memory, requires the feed
+# }
+# suggestions = {
+#     "refresh_interval" : 10 # seconds
+# }
+
 
 def normalize_repository_name(repo):
     \"""allows to overwrite the repository names\"""
@@ -65,17 +123,22 @@ def setup_repository(data, base_url, repository_url, file_url, commit_url, track
     return (base_url, repository_url, file_url, commit_url, tracker_url, icon_url)
 
 
-def get_read_permission_pattern():
+# The permission functions get the CGI environment of the current request.
+# Functions without the environ parameter still work in CGI mode, but the
+# long-lived servers (wsgi.py, serve.py) process many requests in one
+# process, so they must not read os.environ.
+
+def get_read_permission_pattern(environ):
     \"""return a regular expression of repository names that may be read\"""
 
-    # return os.environ.get("AUTHENTICATE_POSTSAI_READ_PATTERN", "^$")
+    # return environ.get("AUTHENTICATE_POSTSAI_READ_PATTERN", "^$")
     return ".*"
 
 
-def get_write_permission_pattern():
+def get_write_permission_pattern(environ):
     \"""return a regular expression of repository names that may be written to\"""
 
-    # return os.environ.get("AUTHENTICATE_POSTSAI_WRITE_PATTERN", "^$")
+    # return environ.get("AUTHENTICATE_POSTSAI_WRITE_PATTERN", "^$")
     return ".*"
 """
         print(help_config_file)
@@ -222,6 +285,12 @@ AND table_schema = %s AND character_set_name != 'utf8'"""
         if not self.has_index("checkins", "domainid"):
             self.db.query(self.db.rewrite_sql("ALTER TABLE checkins ADD UNIQUE KEY `domainid` (`repositoryid`, `branchid`, `dirid`, `fileid`, `revision`)"), [])
 
+        if not self.has_index("checkins", "file_history"):
+            self.db.query(self.db.rewrite_sql("ALTER TABLE checkins ADD KEY `file_history` (`fileid`, `dirid`, `ci_when`)"), [])
+
+        if not self.has_index("checkins", "repository_branch"):
+            self.db.query(self.db.rewrite_sql("ALTER TABLE checkins ADD KEY `repository_branch` (`repositoryid`, `branchid`)"), [])
+
         if not self.has_index("descs", "i_description"):
             try:
                 self.db.query("CREATE FULLTEXT INDEX `i_description` ON `descs` (`description`)", [])
@@ -263,7 +332,9 @@ CREATE TABLE IF NOT EXISTS `checkins` (
   KEY `dirid` (`dirid`),
   KEY `fileid` (`fileid`),
   KEY `branchid` (`branchid`),
-  KEY `descid` (`descid`)
+  KEY `descid` (`descid`),
+  KEY `file_history` (`fileid`, `dirid`, `ci_when`),
+  KEY `repository_branch` (`repositoryid`, `branchid`)
 );
 CREATE TABLE IF NOT EXISTS `importactions` (
   `id` mediumint(9) NOT NULL AUTO_INCREMENT,
@@ -326,6 +397,23 @@ CREATE TABLE IF NOT EXISTS `tags` (
   KEY `fileid` (`fileid`),
   KEY `branchid` (`branchid`)
 );
+CREATE TABLE IF NOT EXISTS `committags` (
+  `id` mediumint(9) NOT NULL AUTO_INCREMENT,
+  `repositoryid` mediumint(9) NOT NULL,
+  `tag` varchar(254) NOT NULL,
+  `hash` varchar(60) NOT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `tag` (`repositoryid`, `tag`)
+);
+CREATE TABLE IF NOT EXISTS `latestactivity` (
+  `repositoryid` mediumint(9) NOT NULL,
+  `branchid` mediumint(9) NOT NULL,
+  `ci_when` timestamp NOT NULL DEFAULT current_timestamp,
+  `whoid` mediumint(9) NOT NULL,
+  `descid` mediumint(9) NOT NULL,
+  `commitid` mediumint(9),
+  PRIMARY KEY (`repositoryid`, `branchid`)
+);
 CREATE TABLE IF NOT EXISTS `commitids` (
   `id` mediumint(9) NOT NULL AUTO_INCREMENT,
   `hash` varchar(60),
@@ -399,6 +487,28 @@ CREATE TABLE IF NOT EXISTS `commitids` (
         print("OK: Converted CVS legacy entries")
 
 
+    def fill_latest_activity(self):
+        """fills the latest activity table from the existing checkins"""
+
+        rows = self.db.query("SELECT count(*) FROM latestactivity", [])
+        if rows[0][0] > 0:
+            return
+
+        # same rule as the importer: the newest checkin wins, the last imported one on ties
+        self.db.query("""INSERT INTO latestactivity (repositoryid, branchid, ci_when, whoid, descid, commitid)
+            SELECT checkins.repositoryid, checkins.branchid, checkins.ci_when, checkins.whoid, checkins.descid, checkins.commitid
+            FROM checkins
+            JOIN (SELECT checkins.repositoryid, checkins.branchid, MAX(checkins.id) AS id
+                FROM checkins
+                JOIN (SELECT repositoryid, branchid, MAX(ci_when) AS ci_when FROM checkins GROUP BY repositoryid, branchid) newest
+                ON checkins.repositoryid = newest.repositoryid AND checkins.branchid = newest.branchid
+                AND checkins.ci_when = newest.ci_when
+                GROUP BY checkins.repositoryid, checkins.branchid) latest
+            ON checkins.id = latest.id""", [])
+        self.db.conn.commit()
+        print("OK: Filled latest activity")
+
+
     def main(self):
         """executes the installer"""
 
@@ -407,8 +517,19 @@ CREATE TABLE IF NOT EXISTS `commitids` (
         self.connect()
         self.create_database_structure()
         self.synthesize_cvs_commit_ids()
+        self.fill_latest_activity()
         self.extension_manager.call_all("install_post", [])
 
+        # the structure of the repositories table might have changed
+        from backend.resultcache import QueryResultCache
+        QueryResultCache(self.config).invalidate_repositories()
+
+        # the database might have been recreated with new ids
+        from backend.lookuptable import SharedLookupTable
+        lookup_table = SharedLookupTable.open(self.config)
+        if lookup_table != None:
+            lookup_table.clear()
+
 
 if __name__ == '__main__':
     PostsaiInstaller().main()
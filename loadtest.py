@@ -0,0 +1,143 @@
+#! /usr/bin/python
+
+# The MIT License (MIT)
+# Copyright (c) 2016-2018 Postsai
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+import argparse
+import base64
+import Queue
+import threading
+import time
+import urllib2
+
+from backend.replay import ReplayLog
+
+
+class LoadTest:
+    """Replays recorded requests against a test instance and measures their latency"""
+
+    def __init__(self, url, entries, concurrency, speedup):
+        """Creates a LoadTest instance, speedup 0 sends the requests without pauses"""
+
+        self.url = url
+        self.entries = entries
+        self.concurrency = concurrency
+        self.speedup = speedup
+        self.results = []
+        self.lock = threading.Lock()
+
+
+    def send(self, entry):
+        """sends a request and returns whether it was successful"""
+
+        url = self.url
+        if entry["query"] != "":
+            url = url + "?" + entry["query"]
+        body = entry["body"]
+        if body != None:
+            body = base64.b64decode(body)
+        request = urllib2.Request(url, body, {"Content-Type": "application/json"})
+        try:
+            response = urllib2.urlopen(request, timeout=300)
+            response.read()
+            return True
+        except (urllib2.URLError, IOError):
+            return False
+
+
+    def work(self, tasks, start):
+        """sends requests from the queue, when they are due"""
+
+        while True:
+            try:
+                entry = tasks.get_nowait()
+            except Queue.Empty:
+                return
+
+            if self.speedup > 0:
+                delay = start + (entry["time"] - self.entries[0]["time"]) / self.speedup - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            sent = time.time()
+            success = self.send(entry)
+            with self.lock:
+                self.results.append((entry["method"], time.time() - sent, success))
+
+
+    def run(self):
+        """replays all requests and returns the duration in seconds"""
+
+        tasks = Queue.Queue()
+        for entry in self.entries:
+            tasks.put(entry)
+
+        start = time.time()
+        threads = []
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self.work, args=(tasks, start))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+
+    @staticmethod
+    def percentile(values, fraction):
+        """returns the percentile of a sorted list"""
+
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+    def report(self, duration):
+        """prints throughput, latency percentiles and error rate per method"""
+
+        print("%-10s %8s %8s %8s %8s %8s %8s %8s" % ("method", "requests", "req/s", "errors", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        for method in sorted(set([result[0] for result in self.results])):
+            results = [result for result in self.results if result[0] == method]
+            latencies = sorted([result[1] * 1000 for result in results])
+            errors = len([result for result in results if not result[2]])
+            print("%-10s %8d %8.1f %7.1f%% %8.1f %8.1f %8.1f %8.1f" % (method, len(results), len(results) / duration,
+                  100.0 * errors / len(results), self.percentile(latencies, 0.5), self.percentile(latencies, 0.9),
+                  self.percentile(latencies, 0.99), latencies[-1]))
+
+
+
+# replays a log, which api.py records if replay_log is configured, against a test instance.
+# The test instance should use a copy of the production database, because imports are replayed, too.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replays recorded requests and reports their latency")
+    parser.add_argument("url", help="url of api.py on the test instance")
+    parser.add_argument("log", help="replay log recorded by api.py")
+    parser.add_argument("--concurrency", type=int, default=8, help="number of parallel requests")
+    parser.add_argument("--speedup", type=float, default=1, help="speedup of the recorded pace, 0 for no pauses")
+    parser.add_argument("--methods", default="", help="comma separated list of methods to replay, e. g. query,commit,import")
+    args = parser.parse_args()
+
+    entries = ReplayLog.read_entries(args.log)
+    if args.methods != "":
+        entries = [entry for entry in entries if entry["method"] in args.methods.split(",")]
+    if len(entries) == 0:
+        print("No requests to replay")
+    else:
+        load_test = LoadTest(args.url, entries, args.concurrency, args.speedup)
+        load_test.report(load_test.run())
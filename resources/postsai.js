@@ -82,7 +82,7 @@ function loadAdditionalScripts(scripts) {
  * initializes a data list for auto complete
  */
 function repositoryDatalist() {
-	$.getJSON( "api.py?date=none", function( data ) {
+	$.getJSON( "api.py?method=bootstrap", function( data ) {
 		var list = [];
 		for (var repo in data.repositories) {
 			if (data.repositories.hasOwnProperty(repo)) {
@@ -101,6 +101,26 @@ function repositoryDatalist() {
 	});
 }
 
+/**
+ * fills the data lists of fields with suggestions while the user is typing
+ */
+function initSuggestions() {
+	$("input[data-suggest]").on("input", function() {
+		var column = $(this).attr("data-suggest");
+		var prefix = $(this).val();
+		if (prefix.length < 2) {
+			return;
+		}
+		$.getJSON("api.py", {"method": "suggest", "column": column, "prefix": prefix}, function(data) {
+			var temp = "";
+			for (var i = 0; i < data.suggestions.length; i++) {
+				temp = temp + '<option value="' + escapeHtml(data.suggestions[i]) + '">';
+			}
+			document.getElementById(column + "list").innerHTML = temp;
+		});
+	});
+}
+
 /**
  * Is this a primary paramter or a sub-paramter of a selected parent?
  */
@@ -109,6 +129,8 @@ function isQueryParameterImportant(vars, key) {
 		return (vars["date"] === "hours");
 	} else if (key === "mindate" || key === "maxdate") {
 		return (vars["date"] === "explicit");
+	} else if (key === "date") {
+		return !vars["fromtag"] && !vars["totag"];
 	}
 	return true;
 }
@@ -131,7 +153,7 @@ function typeToOperator(type) {
  */
 function renderQueryParameters() {
 	$(".search-parameter").each(function() {
-		var params = ["Repository", "Branch", "When", "Who", "Dir", "File", "Rev", "Description", "Commit", "Forked_from", "Date", "Hours", "MinDate", "MaxDate"];
+		var params = ["Repository", "Branch", "When", "Who", "Dir", "File", "Rev", "Description", "Commit", "Forked_from", "FromTag", "ToTag", "Date", "Hours", "MinDate", "MaxDate"];
 		var text = "";
 		var title = "";
 		var vars = getUrlVars();
@@ -454,6 +476,10 @@ function initTable() {
 				alert(data);
 				return;
 			}
+			if (data.timeout) {
+				$("span.waitmessage").text("The query took too long and was cancelled. Please narrow down your search.");
+				return;
+			}
 			$("span.waitmessage").text("Please stand by while the browser is working.");
 			window.config = data.config;
 			window.repositories = data.repositories;
@@ -478,6 +504,11 @@ function initTable() {
 			$(".spinner").addClass("hidden");
 		},
 		error: function(jqXHR, textStatus, errorThrown) {
+			if (jqXHR.status === 503) {
+				$("span.waitmessage").text("The server is busy with expensive queries, please try again in "
+					+ (jqXHR.getResponseHeader("Retry-After") || "a few") + " seconds.");
+				return;
+			}
 			$("span.waitmessage").text("An error occurred on communication with the backend.");
 		}
 	});
@@ -503,6 +534,7 @@ $("ready", function() {
 	} else {
 		addValuesFromURLs();
 		repositoryDatalist();
+		initSuggestions();
 	}
 });
 }());